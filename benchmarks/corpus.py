@@ -0,0 +1,56 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Synthetic sparse corpora"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import numpy as np
+import scipy.sparse
+
+
+def make_corpus(num_records, num_features, density, skew=1.0, num_topics=20,
+                seed=0):
+    """Generate documents as a sparse matrix of term weights.
+
+    Every document belongs to one of num_topics topics. The features of a
+    document are drawn from a Zipf-like distribution over the features
+    whose ranking depends on its topic, so documents of the same topic
+    share their popular features.
+
+    Args:
+        num_records: Number of documents (rows).
+        num_features: Number of features (columns).
+        density: Average fraction of the features set in a document.
+        skew: Exponent of the feature popularity distribution, feature i
+            (by rank) is drawn with probability proportional to
+            1 / i ** skew. 0 draws features uniformly.
+        num_topics: Number of topics.
+        seed: Seed of the random numbers.
+    Returns:
+        A csr_matrix of shape (num_records, num_features).
+    """
+    rng = np.random.RandomState(seed)
+    row_nnz = np.maximum(
+        rng.poisson(density * num_features, size=num_records), 1)
+
+    popularity = np.arange(1, num_features + 1, dtype=np.float64) ** -skew
+    popularity /= popularity.sum()
+    rankings = np.array([rng.permutation(num_features)
+                         for _ in range(num_topics)])
+    topics = rng.randint(num_topics, size=num_records)
+
+    rows = np.repeat(np.arange(num_records), row_nnz)
+    ranks = rng.choice(num_features, size=len(rows), p=popularity)
+    cols = rankings[topics[rows], ranks]
+    data = rng.rand(len(rows))
+    # features drawn twice for a document are summed
+    corpus = scipy.sparse.csr_matrix((data, (rows, cols)),
+                                     shape=(num_records, num_features))
+    corpus.sum_duplicates()
+    return corpus
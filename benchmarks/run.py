@@ -0,0 +1,309 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Benchmark index configurations against a brute force search.
+
+For every synthetic corpus (see benchmarks.corpus) and configuration the
+index is built and searched in its own process and the build time, peak
+memory (RSS), throughput (QPS of one batch of queries), latency
+percentiles (of queries searched one at a time) and recall@k (against a
+brute force CosineDistance search) are reported.
+
+Usage:
+    python -m benchmarks.run --num-records 10000 100000 --skew 0 1 \\
+        --output results.json
+    # compare with the results of another version
+    python -m benchmarks.run --output new.json --baseline results.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import timeit
+import numpy as np
+import scipy
+import pysparnn.cluster_pruning as cp
+from pysparnn.matrix_distance import CosineDistance
+from pysparnn.tuning import recall
+from benchmarks.corpus import make_corpus
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# name: (index class, build arguments)
+CONFIGS = collections.OrderedDict([
+    ('brute-force', (None, {})),
+    ('cluster', (cp.ClusterIndex, {})),
+    ('cluster-kmeans', (cp.ClusterIndex, dict(clustering='kmeans'))),
+    ('multi-2', (cp.MultiClusterIndex, dict(num_indexes=2))),
+    ('multi-4', (cp.MultiClusterIndex, dict(num_indexes=4))),
+])
+
+# metrics compared by --baseline and whether larger is better
+METRICS = collections.OrderedDict([
+    ('build_s', False),
+    ('peak_rss_mb', False),
+    ('index_rss_mb', False),
+    ('qps', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('recall', True),
+])
+
+
+def _rss_mb():
+    """Current resident memory of the process in MB, None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf(str('SC_PAGE_SIZE')) / 1024 ** 2
+
+
+def _peak_rss_mb():
+    """Largest resident memory of the process in MB, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def _searcher(name, features, records):
+    """Build the index of a configuration.
+
+    Returns:
+        A function of (queries, k, k_clusters) that returns the records
+        found for each query.
+    """
+    cls, kwargs = CONFIGS[name]
+    if cls is None:
+        index = CosineDistance(features, records)
+        return lambda queries, k, k_clusters: [
+            [record for _, record in res]
+            for res in index.nearest_search(queries, k=k)]
+    index = cls(features, records, **kwargs)
+    return lambda queries, k, k_clusters: index.search(
+        queries, k=k, k_clusters=k_clusters, return_distance=False)
+
+
+def _measure(name, features, queries, truth, k, k_clusters_list, seed):
+    """Build and search one configuration.
+
+    Returns:
+        A list with a dict of metrics for every k_clusters.
+    """
+    records = np.arange(features.shape[0])
+    # the leaders are sampled, seed them so runs pick the same ones
+    random.seed(seed)
+    np.random.seed(seed)
+    rss_before = _rss_mb()
+    start = timeit.default_timer()
+    search = _searcher(name, features, records)
+    build_s = timeit.default_timer() - start
+    rss_after = _rss_mb()
+
+    ret = []
+    if CONFIGS[name][0] is None:
+        # k_clusters does not apply to a brute force search
+        k_clusters_list = [None]
+    for k_clusters in k_clusters_list:
+        start = timeit.default_timer()
+        results = search(queries, k, k_clusters)
+        batch_s = timeit.default_timer() - start
+
+        latencies = []
+        for i in range(queries.shape[0]):
+            start = timeit.default_timer()
+            search(queries[i], k, k_clusters)
+            latencies.append(timeit.default_timer() - start)
+
+        ret.append(dict(
+            config=name,
+            k_clusters=k_clusters,
+            build_s=build_s,
+            index_rss_mb=None if rss_before is None
+            else rss_after - rss_before,
+            qps=queries.shape[0] / batch_s,
+            p50_ms=1000 * np.percentile(latencies, 50),
+            p99_ms=1000 * np.percentile(latencies, 99),
+            recall=recall(results, truth),
+        ))
+    peak_rss_mb = _peak_rss_mb()
+    for result in ret:
+        result['peak_rss_mb'] = peak_rss_mb
+    return ret
+
+
+def _measure_child(queue, *args):
+    """Run _measure and send its results (or error) to the parent."""
+    try:
+        queue.put(_measure(*args))
+    except Exception as e:  # pylint: disable=broad-except
+        queue.put(e)
+        raise
+
+
+def measure(name, features, queries, truth, k, k_clusters_list, seed=0,
+            isolate=True):
+    """Build and search one configuration, see _measure.
+
+    Args:
+        isolate: Run in a new process so the peak memory is that of the
+            configuration alone.
+    """
+    args = (name, features, queries, truth, k, k_clusters_list, seed)
+    if not isolate:
+        return _measure(*args)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_child,
+                                      args=(queue,) + args)
+    process.start()
+    ret = queue.get()
+    process.join()
+    if isinstance(ret, Exception):
+        raise ret
+    return ret
+
+
+def _round(value):
+    """Round a metric to 4 significant digits so results diff cleanly."""
+    if isinstance(value, float):
+        return float('{:.4g}'.format(value))
+    return value
+
+
+def _key(result):
+    """Identify a result across runs."""
+    return json.dumps(dict((name, result[name]) for name in
+                           ['corpus', 'config', 'k', 'k_clusters']),
+                      sort_keys=True)
+
+
+def run(args):
+    """Run every benchmark of the arguments.
+
+    Returns:
+        A dict with the environment and a list of results.
+    """
+    results = []
+    corpora = itertools.product(args.num_records, args.density, args.skew)
+    for num_records, density, skew in corpora:
+        corpus = dict(num_records=num_records,
+                      num_features=args.num_features, density=density,
+                      skew=skew, seed=args.seed)
+        features = make_corpus(num_records + args.num_queries,
+                               args.num_features, density, skew,
+                               seed=args.seed)
+        queries = features[num_records:]
+        features = features[:num_records]
+        truth = [[record for _, record in res] for res in
+                 CosineDistance(features, np.arange(num_records))
+                 .nearest_search(queries, k=args.k)]
+
+        for name in args.configs:
+            for result in measure(name, features, queries, truth, args.k,
+                                  args.k_clusters, seed=args.seed,
+                                  isolate=not args.in_process):
+                result.update(corpus=corpus, k=args.k)
+                result = dict((key, _round(value))
+                              for key, value in result.items())
+                results.append(result)
+                print(_format(result))
+                sys.stdout.flush()
+
+    return dict(
+        environment=dict(python=platform.python_version(),
+                         numpy=np.__version__, scipy=scipy.__version__,
+                         platform=platform.platform()),
+        num_queries=args.num_queries,
+        results=sorted(results, key=_key),
+    )
+
+
+def _label(result):
+    """The corpus and configuration of a result."""
+    return ('n={num_records} density={density} skew={skew} '
+            '{config} k_clusters={k_clusters}'.format(
+                config=result['config'], k_clusters=result['k_clusters'],
+                **result['corpus']))
+
+
+def _format(result):
+    """One line summary of a result."""
+    return _label(result) + ': ' + ' '.join(
+        '{}={}'.format(name, result[name]) for name in METRICS)
+
+
+def compare(results, baseline):
+    """Print the change of every metric from the baseline results."""
+    old = dict((_key(result), result) for result in baseline['results'])
+    for result in results['results']:
+        previous = old.get(_key(result))
+        if previous is None:
+            continue
+        changes = []
+        for name, larger_is_better in METRICS.items():
+            if not result.get(name) or not previous.get(name):
+                continue
+            change = result[name] / previous[name] - 1
+            better = (change > 0) == larger_is_better
+            changes.append('{}={:+.1%}{}'.format(
+                name, change, '' if abs(change) < 0.05
+                else (' (better)' if better else ' (worse)')))
+        print(_label(result) + ': ' + ' '.join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-records', type=int, nargs='+',
+                        default=[10000])
+    parser.add_argument('--num-features', type=int, default=20000)
+    parser.add_argument('--density', type=float, nargs='+',
+                        default=[0.001],
+                        help='average fraction of the features set')
+    parser.add_argument('--skew', type=float, nargs='+', default=[1.0],
+                        help='exponent of the Zipf-like feature popularity,'
+                        ' 0 for uniform')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--k-clusters', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS),
+                        default=list(CONFIGS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--in-process', action='store_true',
+                        help='do not run each configuration in its own '
+                        'process (the peak memory is then of the run)')
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--baseline',
+                        help='json results to compare the results with')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
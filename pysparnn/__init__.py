@@ -4,4 +4,5 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
-from cluster_pruning import ClusterIndex, MultiClusterIndex
+from pysparnn.cluster_pruning import ClusterIndex, MultiClusterIndex
+from pysparnn.flat_index import FlatClusterIndex
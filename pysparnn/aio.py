@@ -0,0 +1,117 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Batches concurrent asyncio searches, see ClusterIndex.asearch.
+
+Requires python 3.7.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import asyncio
+import functools
+import scipy.sparse
+
+
+class _Batch(object):
+    """Requests waiting to be searched together."""
+
+    def __init__(self, loop, kwargs):
+        self.loop = loop
+        self.kwargs = kwargs
+        self.features = []
+        self.futures = []
+        self.num_rows = 0
+        self.timer = None
+
+
+class MicroBatcher(object):
+    """Collects the queries of concurrent requests into batches.
+
+    The first request of a batch starts a timer. The batch is searched once
+    the timer expires (after max_delay seconds) or max_batch_size queries
+    have been collected, whichever is first. The search runs on an executor
+    so the event loop keeps accepting requests, and every request's future
+    is resolved with the results of its own queries. Only requests with the
+    same search arguments are batched together.
+    """
+
+    def __init__(self, search, max_batch_size=64, max_delay=0.002,
+                 executor=None):
+        """
+        Args:
+            search: Function of (csr_matrix, **kwargs) that returns a list
+                with the results of each query, e.g. an index's search.
+            max_batch_size: Most queries per batch.
+            max_delay: Most seconds the first request of a batch waits for
+                others.
+            executor: A concurrent.futures executor to search on. Defaults
+                to the event loop's default executor.
+        """
+        self.search = search
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self._pending = {}
+
+    def submit(self, sparse_features, kwargs):
+        """Add queries to the current batch. Must be called from a
+        coroutine (or callback) of a running event loop.
+
+        Args:
+            sparse_features: A csr_matrix of queries (usually one row).
+            kwargs: Keyword arguments of search.
+        Returns:
+            An asyncio future of the results of the queries.
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), repr(sorted(kwargs.items())))
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch(loop, kwargs)
+            batch.timer = loop.call_later(self.max_delay, self._flush, key)
+
+        future = loop.create_future()
+        sparse_features = scipy.sparse.csr_matrix(sparse_features)
+        batch.features.append(sparse_features)
+        batch.futures.append(future)
+        batch.num_rows += sparse_features.shape[0]
+        if batch.num_rows >= self.max_batch_size:
+            batch.timer.cancel()
+            self._flush(key)
+        return future
+
+    def _flush(self, key):
+        """Search the batch key on the executor."""
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        features = scipy.sparse.vstack(batch.features).tocsr()
+        search = batch.loop.run_in_executor(
+            self.executor,
+            functools.partial(self.search, features, **batch.kwargs))
+        search.add_done_callback(functools.partial(self._resolve, batch))
+
+    @staticmethod
+    def _resolve(batch, search):
+        """Resolve the future of every request of a searched batch."""
+        if search.cancelled():
+            for future in batch.futures:
+                future.cancel()
+            return
+        error = search.exception()
+        start = 0
+        for features, future in zip(batch.features, batch.futures):
+            stop = start + features.shape[0]
+            if future.cancelled():
+                pass
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(search.result()[start:stop])
+            start = stop
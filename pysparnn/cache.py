@@ -0,0 +1,154 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Defines a bounded cache of search results"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import hashlib
+import sys
+import threading
+import scipy.sparse
+
+
+def _result_size(result):
+    """Approximate number of bytes used by a list of (distance, record)
+    tuples."""
+    size = sys.getsizeof(result)
+    for item in result:
+        size += sys.getsizeof(item) + sum(sys.getsizeof(x) for x in item)
+    return size
+
+
+class QueryCache(object):
+    """Least recently used cache of the results of single queries.
+
+    Results are keyed by a hash of the query row (its feature indices and
+    values) and of the search parameters. An index with a cache (see
+    ClusterIndex.cache) only searches the queries of a batch that miss it
+    and clears it whenever records are inserted or deleted.
+
+    Usage:
+        index.cache = QueryCache(max_bytes=64 * 1024 ** 2)
+        index.search(features)
+        index.cache.hits, index.cache.misses
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2):
+        """
+        Args:
+            max_bytes: Approximate limit on the memory used by the cached
+                results. The least recently used results are evicted first.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drop every cached result (the counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    @staticmethod
+    def keys(sparse_features, params):
+        """Cache key of every query.
+
+        Args:
+            sparse_features: A csr_matrix of queries.
+            params: Dict of the search parameters that change the results.
+        Returns:
+            A list of keys.
+        """
+        sparse_features = scipy.sparse.csr_matrix(sparse_features)
+        if not sparse_features.has_sorted_indices:
+            sparse_features = sparse_features.copy()
+            sparse_features.sort_indices()
+        prefix = repr(sorted(params.items())).encode('utf-8') + \
+                str(sparse_features.dtype).encode('utf-8')
+        indptr = sparse_features.indptr
+        ret = []
+        for i in range(sparse_features.shape[0]):
+            start, stop = indptr[i], indptr[i + 1]
+            digest = hashlib.sha1(prefix)
+            digest.update(sparse_features.indices[start:stop].tobytes())
+            digest.update(sparse_features.data[start:stop].tobytes())
+            ret.append(digest.digest())
+        return ret
+
+    def get(self, key):
+        """The cached result for key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, key, result):
+        """Cache result, evicting the least recently used results to stay
+        within max_bytes."""
+        size = _result_size(result) + len(key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.num_bytes -= old[1]
+            while self._entries and self.num_bytes + size > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.num_bytes -= old_size
+            self._entries[key] = (list(result), size)
+            self.num_bytes += size
+
+    def search(self, sparse_features, search, params):
+        """Results of every query, searching only the ones that miss.
+
+        Args:
+            sparse_features: A csr_matrix of queries.
+            search: Function of a csr_matrix of queries that returns a list
+                with the results of each query.
+            params: Dict of the search parameters, see keys.
+        Returns:
+            A list with the results of each query.
+        """
+        keys = self.keys(sparse_features, params)
+        results = [self.get(key) for key in keys]
+
+        # repeated queries of the batch are only searched once
+        first = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                first.setdefault(key, i)
+        if first:
+            found = search(sparse_features[list(first.values())])
+            for key, result in zip(first, found):
+                self.put(key, result)
+                first[key] = result
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    results[i] = list(first[key])
+        return results
@@ -10,11 +10,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
-import collections
+import multiprocessing.pool
 import random
 import numpy as np
+import scipy.sparse
 from scipy.sparse import vstack
+import pysparnn.cache
+import pysparnn.kmeans
 import pysparnn.matrix_distance
+import pysparnn.parallel
+import pysparnn.stats
+import pysparnn.storage
 
 def k_best(tuple_list, k):
     """For a list of tuples [(distance, value), ...] - Get the k-best tuples by 
@@ -57,6 +63,354 @@ def filter_distance(results, return_distance):
         return list([x for y, x in results])
 
 
+def group_by(keys, values):
+    """Group values by their corresponding key.
+    Args:
+        keys: numpy array of keys.
+        values: numpy array of values, same length as keys.
+    Yields:
+        (key, values) for each distinct key in ascending key order. Values
+        keep their original relative order.
+    """
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    stops = np.r_[starts[1:], len(keys)]
+    for start, stop in zip(starts, stops):
+        yield keys[start], values[start:stop]
+
+
+def _nearest_cluster(args):
+    """Find the nearest clusters for each record in a chunk of records.
+
+    Args:
+        args: A tuple of (MatrixMetricSearch over the cluster leaders,
+            csr_matrix of records, number of clusters per record, largest
+            distance gap to the nearest cluster or None).
+    Returns:
+        A tuple of (distances, nearest) arrays with a row per record.
+        nearest are the indexes of its nearest leaders, nearest first.
+        Leaders further than the gap are -1.
+    """
+    root, records, num_assignments, assignment_gap = args
+    distances, nearest = root.nearest_search(records, k=num_assignments,
+                                             return_arrays=True,
+                                             prepared=True)
+    if assignment_gap is not None:
+        far = distances - distances[:, :1] > assignment_gap
+        far[:, 0] = False
+        nearest[far] = -1
+    return distances, nearest
+
+
+def _build_cluster(args):
+    """Build a child ClusterIndex. Runs in a worker when building in
+    parallel.
+
+    Args:
+        args: A tuple of (sparse_features, records_data, distance_type,
+            matrix_size, seed, row_ids, options). options is a dict of
+            build options, see ClusterIndex._build_options.
+    Returns:
+        A ClusterIndex without a parent. If row_ids is not None it still
+        has to be attached to its store, see ClusterIndex._attach_store.
+    """
+    (sparse_features, records_data, distance_type, matrix_size, seed,
+     row_ids, options) = args
+    random.seed(seed)
+    return ClusterIndex(sparse_features, records_data,
+                        distance_type=distance_type, matrix_size=matrix_size,
+                        row_ids=row_ids, _prepared=True, **options)
+
+
+def _append_delta(delta, distance_type, sparse_features, records_data):
+    """Add records to a delta (see ClusterIndex.insert_batch).
+
+    Args:
+        delta: A distance_type search structure or None if it is empty.
+        distance_type: Class that defines the distance measure to use.
+        sparse_features: A csr_matrix with a row per record.
+        records_data: records to return as the result of a search.
+    Returns:
+        The new delta.
+    """
+    if delta is None:
+        return distance_type(sparse_features, records_data)
+    delta.append(sparse_features, records_data)
+    return delta
+
+
+def _search_delta(results, delta, sparse_features, k, max_distance,
+                  stats=None):
+    """Merge the results of searching a delta into the results of a
+    search.
+
+    Args:
+        results: For each query, a list of (distance, record) tuples.
+        delta: A search structure or None if it is empty.
+        sparse_features: see ClusterIndex.search
+        k: see ClusterIndex.search
+        max_distance: see ClusterIndex.search
+        stats: see ClusterIndex.search
+    """
+    if delta is None:
+        return results
+    delta_results = delta.nearest_search(sparse_features, k=k,
+                                         max_distance=max_distance,
+                                         stats=stats, prepared=True)
+    with pysparnn.stats.timer(stats, 'merge_time'):
+        return [k_best(res + delta_res, k)
+                for res, delta_res in zip(results, delta_results)]
+
+
+def _compact_store(store, indexes):
+    """Remove the deleted records from a shared store.
+
+    Args:
+        store: A search structure or None.
+        indexes: The ClusterIndexes that share store. Their leaves are
+            renumbered and pointed at the new store.
+    Returns:
+        The new store.
+    """
+    if store is None or store.tombstones is None:
+        return store
+    live = ~store.tombstones
+    new_ids = np.cumsum(live) - 1
+    new_store = store.drop_deleted()
+    for index in indexes:
+        index._renumber_rows(live, new_ids)
+        index._attach_store(new_store)
+    return new_store
+
+
+def _order_store(store, indexes):
+    """Reorder a shared store so that the records of every leaf of the
+    first index are a contiguous range of it. Those leaves are then
+    searched in place instead of gathering their rows, see
+    MatrixMetricSubset. A record in several leaves is placed with the
+    first of them.
+
+    Args:
+        store: A search structure.
+        indexes: The ClusterIndexes that share store. Their leaves are
+            renumbered and pointed at the new store.
+    Returns:
+        The new store.
+    """
+    num_records = store.matrix.shape[0]
+    rows = np.concatenate([leaf.root.rows
+                           for leaf in indexes[0]._all_leaves()] +
+                          [np.arange(num_records)])
+    _, first = np.unique(rows, return_index=True)
+    order = rows[np.sort(first)]
+    if (order == np.arange(num_records)).all():
+        return store
+    new_ids = np.empty(num_records, dtype=np.intp)
+    new_ids[order] = np.arange(num_records)
+    new_store = store.take(order)
+    for index in indexes:
+        for leaf in index._all_leaves():
+            leaf.root.rows = new_ids[leaf.root.rows]
+        index._attach_store(new_store)
+    return new_store
+
+
+# indexes shared with the processes of a search pool, see _search_indexes
+_worker_indexes = []
+
+
+def _set_worker_indexes(indexes):
+    """Process pool initializer for _search_indexes."""
+    global _worker_indexes
+    _worker_indexes = indexes
+
+
+def _search_batch(args):
+    """Search one batch of queries against one index.
+
+    Args:
+        args: A tuple of (index, sparse_features, search_kwargs,
+            collect_stats). index is either a ClusterIndex or its position
+            in _worker_indexes.
+    Returns:
+        A tuple of (results, SearchStats of the batch or None).
+    """
+    index, sparse_features, search_kwargs, collect_stats = args
+    if not isinstance(index, ClusterIndex):
+        index = _worker_indexes[index]
+    stats = pysparnn.stats.SearchStats() if collect_stats else None
+    return index._search(sparse_features, stats=stats, **search_kwargs), stats
+
+
+class _SearchPool(object):
+    """A process pool whose workers got some indexes once, when they
+    started. See ClusterIndex.search_pool."""
+
+    def __init__(self, indexes, n_jobs=None):
+        self.indexes = list(indexes)
+        self.num_workers = pysparnn.parallel.num_workers(
+            -1 if n_jobs is None else n_jobs)
+        self._pool = multiprocessing.Pool(self.num_workers,
+                                          _set_worker_indexes,
+                                          (self.indexes,))
+
+    def targets(self, indexes):
+        """Positions of indexes in the indexes of the workers."""
+        ids = [id(index) for index in self.indexes]
+        try:
+            return [ids.index(id(index)) for index in indexes]
+        except ValueError:
+            raise ValueError('The workers of the pool do not have the '
+                             'index, see search_pool')
+
+    def map(self, func, iterable):
+        return self._pool.map(func, iterable)
+
+    def close(self):
+        """Stop the workers."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _search_indexes(indexes, sparse_features, search_kwargs, n_jobs=None,
+                    backend='thread', executor=None, stats=None,
+                    batch_size=1000):
+    """Search every index with every batch of queries, possibly in parallel.
+
+    Args:
+        indexes: List of ClusterIndexes.
+        sparse_features: A csr_matrix of queries.
+        search_kwargs: Keyword arguments for ClusterIndex._search.
+        n_jobs: Number of workers, see pysparnn.parallel.num_workers.
+        backend: 'thread' or 'process'.
+        executor: An existing pool to use instead of n_jobs. The workers of
+            a _SearchPool search the indexes they already have.
+        stats: A pysparnn.stats.SearchStats to add the stats of every batch
+            to, or None.
+        batch_size: Most queries searched at once.
+    Returns:
+        For each index, the _search results of every query.
+    """
+    num_queries = sparse_features.shape[0]
+    if isinstance(executor, _SearchPool):
+        workers = executor.num_workers
+    else:
+        workers = pysparnn.parallel.num_workers(n_jobs)
+
+    # search no more than batch_size records at once
+    # helps keap the matrix multiplies small
+    # but make enough batches to keep every worker busy
+    min_batches = -(-workers // len(indexes))
+    batch_size = max(1, min(batch_size, -(-num_queries // min_batches)))
+    ranges = [(rng, min(rng + batch_size, num_queries))
+              for rng in range(0, num_queries, batch_size)]
+
+    if isinstance(executor, _SearchPool):
+        targets = executor.targets(indexes)
+    elif backend == 'process' and executor is None and workers > 1:
+        # every worker got the indexes once, from _set_worker_indexes
+        targets = range(len(indexes))
+    else:
+        targets = indexes
+    tasks = [(target, sparse_features[rng:max_rng], search_kwargs,
+              stats is not None)
+             for target in targets for rng, max_rng in ranges]
+
+    with pysparnn.parallel.get_executor(n_jobs, backend, executor,
+                                        _set_worker_indexes,
+                                        (indexes,)) as pool:
+        batch_results = pool.map(_search_batch, tasks)
+
+    if stats is not None:
+        stats.num_batches += len(tasks)
+        for _, batch_stats in batch_results:
+            stats.merge(batch_stats)
+    batch_results = [res for res, _ in batch_results]
+    ret = []
+    for i in range(len(indexes)):
+        results = []
+        for res in batch_results[i * len(ranges):(i + 1) * len(ranges)]:
+            results.extend(res)
+        ret.append(results)
+    return ret
+
+
+def _batches(sparse_features, batch_size):
+    """Split queries into batches of batch_size rows.
+
+    Args:
+        sparse_features: A matrix (anything with a shape that can be
+            sliced by rows, e.g. a csr_matrix) that is sliced one batch at
+            a time, or an iterable of csr_matrix chunks of any size.
+        batch_size: Number of rows per batch. The last batch can be
+            smaller.
+    Yields:
+        csr_matrix batches.
+    """
+    if hasattr(sparse_features, 'shape'):
+        for start in range(0, sparse_features.shape[0], batch_size):
+            yield scipy.sparse.csr_matrix(
+                sparse_features[start:start + batch_size])
+        return
+
+    # only buffer the rows of one batch and one chunk
+    pending, num_pending = [], 0
+    for chunk in sparse_features:
+        pending.append(scipy.sparse.csr_matrix(chunk))
+        num_pending += chunk.shape[0]
+        if num_pending < batch_size:
+            continue
+        rows = vstack(pending).tocsr()
+        stop = rows.shape[0] - rows.shape[0] % batch_size
+        for start in range(0, stop, batch_size):
+            yield rows[start:start + batch_size]
+        pending, num_pending = [rows[stop:]], rows.shape[0] - stop
+    if num_pending > 0:
+        yield vstack(pending).tocsr()
+
+
+def _search_iter(search, sparse_features, batch_size, prefetch):
+    """Search batches of queries one at a time, see
+    ClusterIndex.search_iter.
+
+    Args:
+        search: Function that searches a csr_matrix of queries.
+        sparse_features: see _batches
+        batch_size: see _batches
+        prefetch: Search the next batch in a thread while the results of
+            the current one are used.
+    Yields:
+        The results of each batch.
+    """
+    batches = _batches(sparse_features, batch_size)
+    if not prefetch:
+        for batch in batches:
+            yield search(batch)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(1)
+    try:
+        pending = None
+        for batch in batches:
+            result = pool.apply_async(search, (batch,))
+            if pending is not None:
+                yield pending.get()
+            pending = result
+        if pending is not None:
+            yield pending.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class ClusterIndex(object):
     """Search structure which gives speedup at slight loss of recall.
 
@@ -76,12 +430,53 @@ class ClusterIndex(object):
 
            This generalizes to h levels. The runtime becomes:
                O(h * h_root(K))
+
+       Inserted records are searched by brute force until delta_size of them
+       have been inserted; see insert_batch.
     """
 
+    # records inserted since the last flush, see insert_batch
+    delta = None
+    # number of records the delta holds before it is flushed
+    delta_size = 1000
+    # how the leaders of each level are picked, see __init__
+    clustering = 'random'
+    # largest leaf when balancing, see __init__
+    max_cluster_size = None
+    # when balancing, clusters with fewer than this fraction of
+    # max_cluster_size records are merged into their nearest sibling
+    min_cluster_ratio = 0.1
+    # number of clusters each record is assigned to, see __init__
+    num_assignments = 1
+    # most tasks the records of a level are split into to assign them to
+    # clusters, see _build. every task carries (pickles) the leaders so the
+    # chunks are made much larger than the leaders
+    assignment_tasks = 64
+    assignment_gap = None
+    # largest distance from the leader of each child to any record under
+    # it, see _bounded_search
+    radii = None
+    # name of the dtype the matrices are stored as, see __init__
+    dtype = None
+    # pysparnn.cache.QueryCache of search results, see search
+    cache = None
+    # function called with the pysparnn.stats.SearchStats of every search
+    stats_callback = None
+    # most queries searched at once, see search_iter
+    batch_size = 1000
+    # batching of concurrent asearch requests, see asearch
+    asearch_batch_size = 64
+    asearch_delay = 0.002
+    asearch_executor = None
+    _batcher = None
+
     def __init__(self, sparse_features, records_data,
                  distance_type=pysparnn.matrix_distance.CosineDistance,
                  matrix_size=None,
-                 parent=None):
+                 parent=None, n_jobs=None, executor=None, store=None,
+                 row_ids=None, clustering=None, max_cluster_size=None,
+                 num_assignments=None, assignment_gap=None, dtype=None,
+                 _prepared=False):
         """Create a search index composed of recursively defined sparse
         matricies. Does recursive KNN search. See class docstring for a 
         description of the method.
@@ -96,13 +491,86 @@ class ClusterIndex(object):
             matrix_size: Ideal size for matrix multiplication. This controls
                 the depth of the tree. Defaults to 2 levels (approx). Highly
                 reccomended that the default value is used.
+            n_jobs: Number of processes used to assign records to clusters
+                and to build the child clusters. Defaults to 1 (no pool);
+                -1 uses every cpu.
+            executor: An existing pool to use instead of n_jobs. Anything
+                with a map(func, iterable) method, e.g. multiprocessing.Pool.
+            store: A distance_type search structure over every record (see
+                MultiClusterIndex). The leaves then only keep the positions
+                of their records in store instead of copies of their
+                features and records.
+            row_ids: Positions in store of the rows of sparse_features.
+                Defaults to all of the store's records in order.
+            clustering: How the leaders (cluster representatives) of each
+                level are picked. 'random' (default) samples matrix_size
+                records. 'kmeans' seeds matrix_size centroids with
+                k-means++ and refines them with a few iterations of
+                mini-batch k-means (spherical for cosine distance), see
+                pysparnn.kmeans. It takes longer to build but the clusters
+                are more even and recall at a given k_clusters is higher.
+            max_cluster_size: Balance the clusters. Leaves with more
+                records are split (recursively) and clusters with fewer than
+                min_cluster_ratio * max_cluster_size records are merged into
+                the cluster with the nearest leader. This bounds the time
+                spent searching a leaf. See also rebalance.
+            num_assignments: Assign each record to its num_assignments
+                nearest leaves (default 1) instead of only the nearest.
+                Records near the edge of a cluster are found with a smaller
+                k_clusters at the cost of a slower build and up to
+                num_assignments positions of every record in the leaves.
+                The upper levels assign each record to one cluster so the
+                copies do not multiply. The leaves keep positions in a
+                store of the records (see store), created if none is given,
+                so a record found in several leaves is returned once.
+                Inserted records go to one leaf.
+            assignment_gap: Only assign a record to one of its further
+                clusters if the distance to its leader is at most
+                assignment_gap more than the distance to the nearest leader.
+                Defaults to any distance.
+            dtype: Store the feature values and norms of the matrices as
+                dtype (e.g. 'float32' or 'float16') and their index arrays
+                as int32. Defaults to the dtype of sparse_features (usually
+                float64). See MatrixMetricSearch._set_dtype.
+            _prepared: sparse_features already went through
+                distance_type._prepare, e.g. in the levels below the top
+                one, so it is not copied again.
         """
 
+        if clustering is not None:
+            if clustering not in ('random', 'kmeans'):
+                raise ValueError('Unknown clustering: {}'.format(clustering))
+            self.clustering = clustering
+        if max_cluster_size is not None:
+            self.max_cluster_size = int(max_cluster_size)
+        if num_assignments is not None:
+            self.num_assignments = int(num_assignments)
+        if assignment_gap is not None:
+            self.assignment_gap = assignment_gap
+        if dtype is not None:
+            self.dtype = np.dtype(dtype).name
+        if not _prepared:
+            sparse_features = distance_type._prepare(sparse_features)
+        if sparse_features.dtype == np.float16:
+            # e.g. rebuilt from a float16 store; scipy can not gather or
+            # multiply float16 rows, the nodes are cast back to dtype
+            sparse_features = sparse_features.astype(np.float32)
+        num_records = sparse_features.shape[0]
+        own_store = self.num_assignments > 1 and store is None and \
+                row_ids is None
+        if own_store:
+            # the leaves of a record share its row of the store, which
+            # tells copies of a record apart from other equal records
+            store = distance_type(sparse_features, records_data)
+            store._set_dtype(self.dtype)
+        if store is not None and row_ids is None:
+            row_ids = np.arange(store.matrix.shape[0])
         self.is_terminal = False
         self.parent = parent
+        self.store = store
+        self.row_ids = row_ids
         self.distance_type = distance_type
         self.desired_matrix_size = matrix_size
-        num_records = sparse_features.shape[0]
 
         if matrix_size is None:
             matrix_size = max(int(np.sqrt(num_records)), 100)
@@ -111,87 +579,549 @@ class ClusterIndex(object):
 
         self.matrix_size = matrix_size
 
-        num_levels = np.log(num_records)/np.log(self.matrix_size)
+        if self._is_leaf_size(num_records, self.matrix_size):
+            self._set_terminal(sparse_features, records_data)
+        else:
+            with pysparnn.parallel.get_executor(n_jobs,
+                                                executor=executor) as pool:
+                self._build(sparse_features, records_data, pool)
+        # the rows are only needed while building
+        del self.row_ids
+        if own_store:
+            _order_store(self.store, [self])
+
+    def _is_leaf_size(self, num_records, matrix_size):
+        """True if a tree of num_records records is a single leaf."""
+        if self.max_cluster_size is not None and \
+                num_records > self.max_cluster_size:
+            return False
+        num_levels = np.log(num_records)/np.log(matrix_size)
+        return num_levels <= 1.4
+
+    def _set_terminal(self, sparse_features, records_data):
+        """Make this node a leaf that brute force searches its records."""
+        self.is_terminal = True
+        if self.row_ids is None:
+            self.root = self.distance_type(sparse_features, records_data)
+            self.root._set_dtype(self.dtype)
+        else:
+            self.root = pysparnn.matrix_distance.MatrixMetricSubset(
+                self.store, self.row_ids)
 
-        if num_levels <= 1.4:
-            self.is_terminal = True
-            self.root = distance_type(sparse_features,
-                                      records_data)
+    def _attach_store(self, store):
+        """Point every node of a tree built with row_ids at store."""
+        self.store = store
+        if self.is_terminal:
+            self.root.store = store
         else:
-            self.is_terminal = False
-            records_data = np.array(records_data)
-
-            records_index = np.arange(sparse_features.shape[0])
-            clusters_size = min(self.matrix_size, num_records)
-            clusters_selection = random.sample(records_index, clusters_size)
-            clusters_selection = sparse_features[clusters_selection]
-
-            item_to_clusters = collections.defaultdict(list)
-
-            root = distance_type(clusters_selection,
-                                 np.arange(clusters_selection.shape[0]))
-
-            rng_step = self.matrix_size
-            for rng in range(0, sparse_features.shape[0], rng_step):
-                max_rng = min(rng + rng_step, sparse_features.shape[0])
-                records_rng = sparse_features[rng:max_rng]
-                for i, clstrs in enumerate(root.nearest_search(records_rng, k=1)):
-                    for _, cluster in clstrs:
-                        item_to_clusters[cluster].append(i + rng)
-
-            clusters = []
-            cluster_keeps = []
-            for k, clust_sel in enumerate(clusters_selection):
-                clustr = item_to_clusters[k]
-                if len(clustr) > 0:
-                    index = ClusterIndex(vstack(sparse_features[clustr]),
-                                         records_data[clustr],
-                                         distance_type=distance_type,
-                                         matrix_size=self.matrix_size, 
-                                         parent=self)
-                    clusters.append(index)
-                    cluster_keeps.append(clust_sel)
-
-            cluster_keeps = vstack(cluster_keeps)
-            clusters = np.array(clusters)
-
-            self.root = distance_type(cluster_keeps, clusters)
+            for index in self.root.records_data:
+                index._attach_store(store)
+
+    def _build(self, sparse_features, records_data, pool):
+        """Pick the clusters and build the next level of the tree.
+
+        Args:
+            sparse_features: see __init__
+            records_data: see __init__
+            pool: Object with a map method used to run the assignment of
+                records to clusters and the child builds.
+        """
+        self.is_terminal = False
+        distance_type = self.distance_type
+        num_records = sparse_features.shape[0]
+        records_data = np.array(records_data)
+
+        clusters_size = min(self.matrix_size, num_records)
+        if np.log(num_records)/np.log(self.matrix_size) <= 1.4:
+            # only split because of max_cluster_size; aim for clusters of
+            # about half the max size instead of matrix_size tiny clusters
+            clusters_size = min(clusters_size, max(2, int(np.ceil(
+                2.0 * num_records / self.max_cluster_size))))
+        clusters_selection = self._leaders(sparse_features, clusters_size)
+
+        root = distance_type(clusters_selection,
+                             np.arange(clusters_selection.shape[0]))
+
+        rng_step = max(self.matrix_size,
+                       -(-num_records // self.assignment_tasks))
+        chunks = [(root, sparse_features[rng:rng + rng_step],
+                   self.num_assignments, self.assignment_gap)
+                  for rng in range(0, num_records, rng_step)]
+        assignments = pool.map(_nearest_cluster, chunks)
+        distances = np.concatenate([dist for dist, _ in assignments])
+        nearest = np.concatenate([near for _, near in assignments])
+
+        cluster_ids, radii = self._assign(nearest, distances)
+        if nearest.shape[1] > 1 and \
+                not all(self._is_leaf_size(len(clustr), self.matrix_size)
+                        for _, clustr in cluster_ids):
+            # only assign records to several clusters just above the
+            # leaves. copies at every level would multiply and the
+            # children may not shrink (e.g. duplicates that are equally
+            # near to several leaders) so the split would never end
+            cluster_ids, radii = self._assign(nearest[:, :1],
+                                              distances[:, :1])
+        if self.max_cluster_size is not None:
+            cluster_ids = self._merge_small(clusters_selection, cluster_ids,
+                                            sparse_features, radii)
+
+        if len(cluster_ids) < 2:
+            # every record is closest to the same leader (i.e. the
+            # records are duplicates). splitting again would recurse
+            # forever so fall back to a brute force matrix
+            self._set_terminal(sparse_features, records_data)
+            return
+
+        tasks = [(sparse_features[clustr], records_data[clustr],
+                  distance_type, self.matrix_size, random.getrandbits(32),
+                  None if self.row_ids is None else self.row_ids[clustr],
+                  self._build_options())
+                 for _, clustr in cluster_ids]
+        clusters = pool.map(_build_cluster, tasks)
+        for index in clusters:
+            index.parent = self
+            if self.row_ids is not None:
+                # children built by a worker have their own copy (or no
+                # copy) of the store
+                index._attach_store(self.store)
+
+        keys = [k for k, _ in cluster_ids]
+        cluster_keeps = clusters_selection[keys]
+        clusters_array = np.empty(len(clusters), dtype=object)
+        clusters_array[:] = clusters
+
+        self.root = distance_type(cluster_keeps, clusters_array)
+        self.root._set_dtype(self.dtype)
+        self.radii = radii[keys]
+
+    def _assign(self, nearest, distances):
+        """Group the records by cluster.
+
+        Args:
+            nearest: Array with a row per record of the indexes of the
+                clusters it is assigned to, -1 for none.
+            distances: Distances from the records to those clusters.
+        Returns:
+            A tuple of (list of (leader, records) tuples, array with the
+            radius of the cluster of every leader).
+        """
+        assigned = nearest >= 0
+        radii = np.zeros(nearest.max() + 1)
+        np.maximum.at(radii, nearest[assigned], distances[assigned])
+        records_index, _ = np.nonzero(assigned)
+        return list(group_by(nearest[assigned], records_index)), radii
+
+    def _min_cluster_size(self):
+        """Clusters with fewer records are merged when balancing."""
+        return int(self.min_cluster_ratio * self.max_cluster_size)
+
+    def _merge_small(self, leaders, cluster_ids, sparse_features, radii):
+        """Move the records of every small cluster (see _min_cluster_size)
+        to their nearest leader among the other clusters.
 
+        Args:
+            leaders: A csr_matrix of the leaders.
+            cluster_ids: List of (leader, records) tuples.
+            sparse_features: A csr_matrix of the records.
+            radii: Radius of the cluster of every leader, updated in place.
+        Returns:
+            The merged list of (leader, records) tuples.
+        """
+        sizes = np.array([len(clustr) for _, clustr in cluster_ids])
+        small = sizes < self._min_cluster_size()
+        if np.count_nonzero(~small) < 2 or not small.any():
+            # merging would leave a single cluster
+            return cluster_ids
+
+        large = [cluster_ids[i] for i in np.flatnonzero(~small)]
+        moved = np.concatenate([cluster_ids[i][1]
+                                for i in np.flatnonzero(small)])
+        keys = np.array([k for k, _ in large])
+        nearest, distances = self._nearest_leaders(leaders[keys],
+                                                   sparse_features[moved])
+        np.maximum.at(radii, keys[nearest], distances)
+        merged = [[clustr] for _, clustr in large]
+        for i, records in group_by(nearest, moved):
+            merged[i].append(records)
+        # records assigned to several clusters are only added once
+        return [(key, np.unique(np.concatenate(clustrs)))
+                for (key, _), clustrs in zip(large, merged)]
+
+    def _nearest_leaders(self, leaders, sparse_features):
+        """Position of and distance to the nearest leader of every record.
+        Records that can not be compared to any leader go to the first
+        leader (at an infinite distance)."""
+        root = self.distance_type(leaders, np.arange(leaders.shape[0]))
+        distances, nearest = root.nearest_search(sparse_features, k=1,
+                                                 return_arrays=True,
+                                                 prepared=True)
+        return np.maximum(nearest[:, 0], 0), distances[:, 0]
+
+    def _leaders(self, sparse_features, clusters_size):
+        """Pick the leaders of the next level, see clustering.
+
+        Returns:
+            A csr_matrix with a row per leader.
+        """
+        num_records = sparse_features.shape[0]
+        if self.clustering == 'kmeans':
+            rng = np.random.RandomState(random.getrandbits(32))
+            return pysparnn.kmeans.minibatch_kmeans(
+                self.distance_type, sparse_features, clusters_size, rng)
+        selection = random.sample(range(num_records), clusters_size)
+        return sparse_features[selection]
+
+    def _build_options(self):
+        """Keyword arguments of __init__ that every node of the tree
+        shares."""
+        return dict(clustering=self.clustering,
+                    max_cluster_size=self.max_cluster_size,
+                    num_assignments=self.num_assignments,
+                    assignment_gap=self.assignment_gap,
+                    dtype=self.dtype)
+
+    def _clear_cache(self):
+        """Drop the cached search results once the records change."""
+        if self.cache is not None:
+            self.cache.clear()
 
     def insert(self, sparse_feature, record):
-        """Insert a single record into the index.
+        """Insert a single record into the index. See insert_batch.
         
         Args:
             sparse_feature: sparse feature vector
             record: record to return as the result of a search
         """
-        
-        nearest = self
-        while not nearest.is_terminal:
-            nearest = nearest.root.nearest_search(sparse_feature, k=1)
-            _, nearest = nearest[0][0]
-
-        cluster_index = nearest
-        parent_index = cluster_index.parent
-        while parent_index and cluster_index.matrix_size * 2 < \
-                len(cluster_index.root.get_records()):
-            cluster_index = parent_index
-            parent_index = cluster_index.parent
-       
-        cluster_index._reindex(sparse_feature, record)
+        self.insert_batch(sparse_feature, [record])
 
-        
+    def insert_batch(self, sparse_features, records_data):
+        """Insert records into the index.
+
+        The records are added to a brute force search structure (the delta)
+        that is searched alongside the tree. Once the delta holds
+        delta_size records it is flushed (see flush) so the cost of an
+        insert stays close to the number of records inserted instead of
+        the size of the tree.
+
+        Args:
+            sparse_features: A csr_matrix with a row per record.
+            records_data: records to return as the result of a search.
+        """
+        self._clear_cache()
+        self.delta = _append_delta(self.delta, self.distance_type,
+                                   sparse_features, records_data)
+        if self.delta.matrix.shape[0] >= self.delta_size:
+            self.flush()
+
+    def flush(self):
+        """Move the records of the delta into the tree. Every record is
+        appended to its nearest leaf and only the leaves that grow past the
+        size at which they would have been split are rebuilt."""
+        if self.delta is None:
+            return
+        self._clear_cache()
+        delta = self.delta.drop_deleted()
+        self.delta = None
+        features = delta.get_feature_matrix()
+        records = delta.get_records()
+        row_ids = None
+        if self.store is not None:
+            row_ids = self.store.append(features, records)
+        self._add_records(features, records, row_ids)
+
+    def _add_records(self, sparse_features, records_data, row_ids=None):
+        """Append records to their nearest leaves.
+
+        Args:
+            sparse_features: A csr_matrix with a row per record.
+            records_data: numpy array of records.
+            row_ids: Positions of the records in the shared store, if the
+                index has one. The records must already be appended to it.
+        """
+        rows = np.arange(sparse_features.shape[0])
+        for leaf, leaf_rows in self._leaves(sparse_features, rows):
+            if row_ids is None:
+                leaf.root.append(sparse_features[leaf_rows],
+                                 records_data[leaf_rows])
+            else:
+                leaf.root.rows = np.concatenate([leaf.root.rows,
+                                                 row_ids[leaf_rows]])
+
+            if leaf._is_full():
+                leaf._rebuild()
+
+    def _leaves(self, sparse_features, rows):
+        """Find the nearest leaf of records.
+
+        Args:
+            sparse_features: A csr_matrix of records.
+            rows: The rows of sparse_features to route.
+        Yields:
+            (leaf ClusterIndex, rows) tuples.
+        """
+        if self.is_terminal:
+            yield self, rows
+            return
+        distances, nearest = self.root.nearest_search(
+            sparse_features[rows], k=1, return_arrays=True, prepared=True)
+        # records that can not be compared to any leader go to the first
+        nearest = np.maximum(nearest[:, 0], 0)
+        self._grow_radii(nearest, distances[:, 0])
+        for cluster_id, cluster_rows in group_by(nearest, rows):
+            cluster = self.root.records_data[cluster_id]
+            for leaf in cluster._leaves(sparse_features, cluster_rows):
+                yield leaf
+
+    def delete(self, records_data):
+        """Delete records from the index. The records are marked as deleted
+        (tombstoned) and no longer returned by searches; compact removes
+        them from the matrices.
+
+        Args:
+            records_data: Records to delete. Every record of the index equal
+                to one of them is deleted.
+        """
+        self._clear_cache()
+        if self.delta is not None:
+            self.delta.delete(records_data)
+        self._delete(records_data)
+
+    def _delete(self, records_data):
+        """Mark records of the tree (not the delta) as deleted."""
+        if self.store is not None:
+            self.store.delete(records_data)
+        else:
+            for leaf in self._all_leaves():
+                leaf.root.delete(records_data)
+
+    def update(self, record, sparse_feature):
+        """Replace the features of a record.
+
+        Args:
+            record: The record to update.
+            sparse_feature: Its new sparse feature vector.
+        """
+        self.delete([record])
+        self.insert(sparse_feature, record)
+
+    def compact(self, max_dead_ratio=0.3):
+        """Remove the deleted records from the matrices. Subtrees where
+        more than max_dead_ratio of the records are deleted are rebuilt
+        (reclustered) from the remaining records.
+
+        Args:
+            max_dead_ratio: Fraction of deleted records above which a
+                subtree is rebuilt. 1.0 only removes the records.
+        """
+        self._clear_cache()
+        if self.delta is not None:
+            self.delta = self.delta.drop_deleted()
+        self._compact(max_dead_ratio)
+        self.store = _compact_store(self.store, [self])
+
+    def _compact(self, max_dead_ratio):
+        """Remove the deleted records of the tree, see compact.
+
+        Returns:
+            The number of records left in the tree.
+        """
+        num_records, num_deleted = self._count_deleted()
+        num_live = num_records - num_deleted
+        if num_deleted == 0 or num_live == 0:
+            # the parent drops empty clusters
+            return num_live
+
+        if self.is_terminal:
+            if self.store is None:
+                self.root = self.root.drop_deleted()
+            else:
+                self.root.rows = self.root.rows[~self._deleted()]
+        elif num_deleted > max_dead_ratio * num_records:
+            self._rebuild()
+        else:
+            live = [index._compact(max_dead_ratio) > 0
+                    for index in self.root.records_data]
+            if not all(live):
+                self._take_children(np.flatnonzero(live))
+        return num_live
+
+    def _count_deleted(self):
+        """Number of records and deleted records in the tree."""
+        if self.is_terminal:
+            deleted = self._deleted()
+            return len(deleted), np.count_nonzero(deleted)
+        num_records, num_deleted = 0, 0
+        for index in self.root.records_data:
+            counts = index._count_deleted()
+            num_records += counts[0]
+            num_deleted += counts[1]
+        return num_records, num_deleted
+
+    def _deleted(self):
+        """Boolean array marking the deleted records of a leaf."""
+        if self.store is None:
+            tombstones = self.root.tombstones
+            num_records = len(self.root.records_data)
+        else:
+            tombstones = self.store.tombstones
+            if tombstones is not None:
+                tombstones = tombstones[self.root.rows]
+            num_records = len(self.root.rows)
+        if tombstones is None:
+            return np.zeros(num_records, dtype=bool)
+        return tombstones
+
+    def _renumber_rows(self, live, new_ids):
+        """Map the store positions of the leaves to the positions of a
+        store without its deleted records.
+
+        Args:
+            live: Boolean array, True for the records of the store that are
+                kept.
+            new_ids: New position of every record of the store.
+        """
+        for leaf in self._all_leaves():
+            rows = leaf.root.rows
+            leaf.root.rows = new_ids[rows[live[rows]]]
+
+    def _all_leaves(self):
+        """Yield every leaf of the tree."""
+        if self.is_terminal:
+            yield self
+            return
+        for index in self.root.records_data:
+            for leaf in index._all_leaves():
+                yield leaf
+
+    def _is_full(self):
+        """True for a leaf that would be split if it was rebuilt."""
+        num_records = len(self.root.get_records())
+        matrix_size = self.desired_matrix_size
+        if matrix_size is None:
+            matrix_size = max(int(np.sqrt(num_records)), 100)
+        return not self._is_leaf_size(num_records, int(matrix_size))
+
+    def rebalance(self, max_cluster_size=None):
+        """Balance the clusters of an existing index (e.g. after inserts
+        and deletes). Leaves with more than max_cluster_size records are
+        split and small leaves are merged into the sibling leaf with the
+        nearest leader. See __init__.
+
+        Args:
+            max_cluster_size: Largest leaf. Defaults to the
+                max_cluster_size the index was built with. It is kept for
+                later inserts and rebuilds.
+        """
+        if max_cluster_size is not None:
+            for node in self._all_nodes():
+                node.max_cluster_size = int(max_cluster_size)
+        if self.max_cluster_size is None:
+            raise ValueError('max_cluster_size is required to rebalance')
+        self._clear_cache()
+        self._rebalance()
+
+    def _rebalance(self):
+        """Split the large leaves and merge the small leaves of the tree.
+        """
+        if self.is_terminal:
+            if self._is_full():
+                self._rebuild()
+            return
+
+        for index in self.root.records_data:
+            index._rebalance()
+
+        children = self.root.records_data
+        sizes = np.array([len(index.root.get_records()) if index.is_terminal
+                          else -1 for index in children])
+        small = (sizes >= 0) & (sizes < self._min_cluster_size())
+        if not small.any() or np.count_nonzero(~small) < 2:
+            # merging would leave a single child
+            return
+
+        # move the records of the small leaves to their nearest leader
+        # among the other children, like _merge_small does at build time
+        keep = np.flatnonzero(~small)
+        leaders = self.root.get_feature_matrix()[keep]
+        for i in np.flatnonzero(small):
+            features, records = children[i]._get_child_data()
+            features, records = features[0], records[0]
+            row_ids = None
+            if self.store is not None:
+                row_ids = children[i]._get_child_rows()[0]
+            nearest, distances = self._nearest_leaders(leaders, features)
+            self._grow_radii(keep[nearest], distances)
+            for target, moved in group_by(nearest,
+                                          np.arange(features.shape[0])):
+                children[keep[target]]._add_records(
+                    features[moved], records[moved],
+                    None if row_ids is None else row_ids[moved])
+        self._take_children(keep)
+
+    def _grow_radii(self, children, distances):
+        """Grow the radii of children to cover records added to them.
+
+        Args:
+            children: Array with the child of every added record.
+            distances: Distances from the records to the leaders of those
+                children.
+        """
+        if self.radii is not None:
+            self.radii = self.radii.copy()
+            np.maximum.at(self.radii, children, distances)
+
+    def _take_children(self, children):
+        """Keep only some of the children of an internal node."""
+        self.root = self.root.take(children)
+        if self.radii is not None:
+            self.radii = self.radii[children]
+
+    def _all_nodes(self):
+        """Yield every node of the tree."""
+        yield self
+        if not self.is_terminal:
+            for index in self.root.records_data:
+                for node in index._all_nodes():
+                    yield node
+
+    def save(self, path):
+        """Save the index to a directory as flat binary arrays. See
+        pysparnn.storage. Inserted records are flushed into the tree and
+        deleted records are removed (see compact) first.
+
+        Args:
+            path: Directory to write to. Created if it does not exist.
+        """
+        self.flush()
+        self.compact(max_dead_ratio=1.0)
+        pysparnn.storage.save(path, [self], 'ClusterIndex')
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index written by save.
+
+        Args:
+            path: Directory the index was saved to.
+            mmap: Memory map the feature matrices, norms and records instead
+                of reading them into memory. Processes that memory map the
+                same index share its pages.
+        """
+        kind, indexes = pysparnn.storage.load(path, mmap)
+        if kind != 'ClusterIndex':
+            raise ValueError('{} is a saved {}'.format(path, kind))
+        return indexes[0]
 
     def _get_child_data(self):
         """Get all of the features and corresponding records represented in the
-        full tree structure.
+        full tree structure. Deleted records are left out.
         
         Returns:
             A tuple of (list(features), list(records)). 
         """
 
         if self.is_terminal:
-            return [self.root.get_feature_matrix()], [self.root.get_records()]
+            root = self.root.drop_deleted()
+            return [root.get_feature_matrix()], [root.get_records()]
         else:
             result_features = []
             result_records = []
@@ -204,6 +1134,47 @@ class ClusterIndex(object):
     
             return result_features, result_records 
     
+    def _get_child_rows(self):
+        """Get the positions in the store of all of the records represented
+        in the full tree structure of an index with a shared store. Deleted
+        records are left out.
+
+        Returns:
+            A list of arrays of positions.
+        """
+        if self.is_terminal:
+            return [self.root.rows[~self._deleted()]]
+        result_rows = []
+        for c in self.root.get_records():
+            result_rows.extend(c._get_child_rows())
+        return result_rows
+
+    def _rebuild(self):
+        """Rebuild the subtree from its records that are not deleted."""
+        if self.store is None:
+            self._reindex()
+        else:
+            self._reindex_rows()
+
+    def _reindex_rows(self, row_ids=None):
+        """Rebuild the search index of an index with a shared store.
+        Optionally add records that were appended to the store.
+
+        Args:
+            row_ids: Positions of the records to add in the store.
+        """
+        rows = self._get_child_rows()
+        if row_ids is not None:
+            rows.append(row_ids)
+        # records assigned to several clusters are gathered once
+        rows = np.unique(np.concatenate(rows))
+        records = self.store.take(rows)
+
+        self.__init__(records.get_feature_matrix(), records.get_records(),
+                      self.distance_type, self.desired_matrix_size,
+                      self.parent, store=self.store, row_ids=rows,
+                      _prepared=True, **self._build_options())
+
     def _reindex(self, sparse_feature=None, record=None):
         """Rebuild the search index. Optionally add a record. This is used
         when inserting records to the index.
@@ -219,16 +1190,18 @@ class ClusterIndex(object):
         for x in records:
             flat_rec.extend(x)
 
-        if sparse_feature <> None and record <> None:
-            features.append(sparse_feature)
+        if sparse_feature is not None and record is not None:
+            features.append(self.distance_type._prepare(sparse_feature))
             flat_rec.append(record)
 
         self.__init__(vstack(features), flat_rec, self.distance_type, 
-                self.desired_matrix_size, self.parent)
+                self.desired_matrix_size, self.parent, _prepared=True,
+                **self._build_options())
 
 
     def _search(self, sparse_features, k=1, 
-                max_distance=None, k_clusters=1):
+                max_distance=None, k_clusters=1, radius_scale=None,
+                bounds=None, stats=None, return_rows=False):
         """Find the closest item(s) for each feature_list in.
 
         Args:
@@ -246,6 +1219,12 @@ class ClusterIndex(object):
                     each level. 
                     This means each search will fully traverse at least one
                     (but at most k_clusters) clusters at each level.
+            radius_scale: Visit the clusters adaptively, see search.
+            bounds: Array with, for each query, the distance that results
+                must beat (used with radius_scale).
+            stats: A pysparnn.stats.SearchStats to add to, or None.
+            return_rows: Return the positions of the records in the store
+                instead of the records.
 
         Returns:
             For each element in features_list, return the k-nearest items
@@ -254,29 +1233,158 @@ class ClusterIndex(object):
              [(score2_1, item2_1), ..., (score2_k, item2_k)], ...]
         """
         if self.is_terminal:
-            return self.root.nearest_search(sparse_features, k=k,
-                                            max_distance=max_distance)
+            if not return_rows:
+                return self.root.nearest_search(sparse_features, k=k,
+                                                max_distance=max_distance,
+                                                stats=stats, prepared=True)
+            distances, indices = self.root.nearest_search(
+                sparse_features, k=k, max_distance=max_distance,
+                return_arrays=True, stats=stats, prepared=True)
+            found = indices >= 0
+            return [list(zip(distances[i][found[i]],
+                             self.root.rows[indices[i][found[i]]]))
+                    for i in range(indices.shape[0])]
+
+        # a record assigned to several leaves is told apart from equal
+        # records by its position in the store
+        by_row = return_rows or \
+                (self.num_assignments > 1 and self.store is not None)
+        if radius_scale is not None:
+            ret = self._bounded_search(sparse_features, k, max_distance,
+                                       k_clusters, radius_scale, bounds,
+                                       stats, by_row)
         else:
-            ret = []
-            nearest = self.root.nearest_search(sparse_features, k=k_clusters)
-
-            for i, nearest_clusters in enumerate(nearest):
-                curr_ret = []
-                for distance, cluster in nearest_clusters:
+            ret = [[] for _ in range(sparse_features.shape[0])]
+            _, nearest = self.root.nearest_search(sparse_features,
+                                                  k=k_clusters,
+                                                  return_arrays=True,
+                                                  stats=stats, prepared=True)
+
+            # route every query to its chosen clusters and search each
+            # cluster once with all of the queries that were routed to it
+            query_ids, _ = np.nonzero(nearest >= 0)
+            cluster_ids = nearest[nearest >= 0]
+            if stats is not None:
+                stats.visit(self._depth(), len(cluster_ids))
+            for cluster_id, queries in group_by(cluster_ids, query_ids):
+                cluster = self.root.records_data[cluster_id]
+                cluster_items = cluster._search(sparse_features[queries],
+                                                k=k,
+                                                k_clusters=k_clusters,
+                                                max_distance=max_distance,
+                                                stats=stats,
+                                                return_rows=by_row)
+
+                for query, elements in zip(queries, cluster_items):
+                    ret[query].extend(elements)
+
+            with pysparnn.stats.timer(stats, 'merge_time'):
+                ret = [self._k_best(curr_ret, k) for curr_ret in ret]
+
+        if by_row and not return_rows:
+            records = self.store.records_data
+            ret = [[(distance, records[row]) for distance, row in res]
+                   for res in ret]
+        return ret
 
-                    cluster_items = cluster.\
-                            search(sparse_features[i], k=k,
-                                   k_clusters=k_clusters,
-                                   max_distance=max_distance)
+    def _depth(self):
+        """Number of levels above this node."""
+        depth, node = 0, self.parent
+        while node is not None:
+            depth, node = depth + 1, node.parent
+        return depth
+
+    def _k_best(self, tuple_list, k):
+        """k_best of the results of several clusters."""
+        if self.num_assignments > 1:
+            # a record can be found in several clusters. the results are
+            # positions in the store (see _search) so equal records stay
+            return filter_unique(k_best(tuple_list, len(tuple_list)))[:k]
+        return k_best(tuple_list, k)
+
+    def _bounded_search(self, sparse_features, k, max_distance, k_clusters,
+                        radius_scale, bounds, stats=None, return_rows=False):
+        """Search the children of an internal node in rounds, see search.
+
+        Every query visits its children in order of the lower bound of the
+        distance to their records (see MatrixMetricSearch._lower_bound) and
+        stops at the first child whose bound is more than max_distance or
+        the distance of its k-th best result so far. Each round searches
+        every child at most once, with all of the queries that visit it.
 
-                    for elements in cluster_items:
-                        if len(elements) > 0:
-                            curr_ret.extend(elements)
-                ret.append(k_best(curr_ret, k))
-            return ret
+        Args:
+            see _search
+        Returns:
+            see _search
+        """
+        num_queries = sparse_features.shape[0]
+        children = self.root.records_data
+        distances, nearest = self.root.nearest_search(
+            sparse_features, k=len(children), return_arrays=True,
+            stats=stats, prepared=True)
+
+        radii = self.radii
+        if radii is None:
+            # e.g. an index saved before radii were kept; no pruning
+            radii = np.full(len(children), np.inf)
+        lower = self.distance_type._lower_bound(
+            distances, radii[np.maximum(nearest, 0)] * radius_scale)
+        lower[np.isnan(lower)] = -np.inf
+        lower[nearest < 0] = np.inf
+        order = np.argsort(lower, axis=1, kind='mergesort')
+        query_rows = np.arange(num_queries)[:, np.newaxis]
+        nearest = nearest[query_rows, order]
+        lower = lower[query_rows, order]
+
+        if bounds is None:
+            bounds = np.full(num_queries, np.inf)
+        else:
+            bounds = np.array(bounds, dtype=float)
+        if max_distance is not None:
+            bounds = np.minimum(bounds, max_distance)
+
+        num_visits = len(children)
+        if k_clusters is not None:
+            num_visits = min(k_clusters, num_visits)
+
+        ret = [[] for _ in range(num_queries)]
+        # the rounds visit 1, 1, 2, 4, ... more children per query so that
+        # queries that need most of the children take few rounds
+        start, width = 0, 1
+        while start < num_visits:
+            stop = min(start + width, num_visits)
+            # lower is sorted so each query visits a prefix of the window
+            query_ids, visits = np.nonzero(
+                lower[:, start:stop] <= bounds[:, np.newaxis])
+            if len(query_ids) == 0:
+                break
+            if stats is not None:
+                stats.visit(self._depth(), len(query_ids))
+            for cluster_id, pairs in group_by(
+                    nearest[query_ids, start + visits],
+                    np.arange(len(query_ids))):
+                cluster_queries = query_ids[pairs]
+                cluster_items = children[cluster_id]._search(
+                    sparse_features[cluster_queries], k=k,
+                    max_distance=max_distance, k_clusters=k_clusters,
+                    radius_scale=radius_scale,
+                    bounds=bounds[cluster_queries], stats=stats,
+                    return_rows=return_rows)
+                for query, elements in zip(cluster_queries, cluster_items):
+                    ret[query].extend(elements)
+
+            with pysparnn.stats.timer(stats, 'merge_time'):
+                for query in np.unique(query_ids):
+                    ret[query] = self._k_best(ret[query], k)
+                    if len(ret[query]) == k:
+                        bounds[query] = min(bounds[query],
+                                            ret[query][-1][0])
+            start, width = stop, 2 * width
+        return ret
 
     def search(self, sparse_features, k=1, max_distance=None, k_clusters=1, 
-            return_distance=True):
+            return_distance=True, n_jobs=None, backend='thread',
+            executor=None, radius_scale=None, stats=None):
         """Find the closest item(s) for each feature_list in the index.
 
         Args:
@@ -295,6 +1403,39 @@ class ClusterIndex(object):
 
                     This means each search will fully traverse at least one
                     (but at most k_clusters) clusters at each level.
+            n_jobs: Number of workers used to search batches of queries
+                concurrently. Defaults to 1; -1 uses every cpu.
+            backend: 'thread' (default) or 'process'. Threads share the
+                index; most of the search time is spent in numpy/scipy code
+                that releases the GIL. A process pool is started for the
+                call and every process gets the indexes once. For
+                repeated searches pass a pool from search_pool as executor,
+                or see pysparnn.serving.WorkerPool.
+            executor: An existing pool to use instead of n_jobs. Anything
+                with a map(func, iterable) method, e.g. a ThreadPool or a
+                pool from search_pool.
+            radius_scale: Visit the clusters adaptively instead of always
+                k_clusters of them. Every cluster keeps its radius (the
+                largest distance from its leader to its records) which
+                bounds the distance from a query to the records of the
+                cluster. A query visits the clusters of each level in order
+                of that bound and stops once the bound is more than
+                max_distance or the distance of its k-th best result. With
+                a radius_scale of 1.0 and a metric distance (see
+                MatrixMetricSearch._lower_bound) this finds every result
+                within max_distance. Smaller values shrink the radii: fewer
+                clusters are visited at the cost of recall, 0.0 only
+                compares the leaders. k_clusters is then the most clusters
+                visited at each level; None for no limit.
+            stats: A pysparnn.stats.SearchStats to add the clusters
+                visited, distances computed and time spent by the search
+                to. Set stats_callback to a function to call it with the
+                stats of every search instead; searches without either
+                do not collect stats.
+
+        Set cache to a pysparnn.cache.QueryCache to keep the results of
+        recent queries. Only the queries that are not cached are searched
+        and the cache is cleared when records are inserted or deleted.
 
         Returns:
             For each element in features_list, return the k-nearest items
@@ -306,29 +1447,113 @@ class ClusterIndex(object):
             [[item1_1, ..., item1_k],
              [item2_1, ..., item2_k], ...]
         """
-        
-        # search no more than 1k records at once
-        # helps keap the matrix multiplies small
-        batch_size = 1000
-        results = []
-        rng_step = batch_size
-        for rng in range(0, sparse_features.shape[0], rng_step):
-            max_rng = min(rng + rng_step, sparse_features.shape[0])
-            records_rng = sparse_features[rng:max_rng]
+        if stats is None and self.stats_callback is not None:
+            stats = pysparnn.stats.SearchStats()
+        sparse_features = self.distance_type._prepare(sparse_features)
+        search_kwargs = dict(k=k, max_distance=max_distance,
+                             k_clusters=k_clusters, radius_scale=radius_scale)
+
+        def search(features):
+            if stats is not None:
+                stats.num_queries += features.shape[0]
+            results = _search_indexes([self], features, search_kwargs,
+                                      n_jobs, backend, executor, stats,
+                                      self.batch_size)[0]
+            return _search_delta(results, self.delta, features, k,
+                                 max_distance, stats)
+
+        with pysparnn.stats.timer(stats, 'total_time'):
+            if self.cache is None:
+                results = search(sparse_features)
+            else:
+                results = self.cache.search(sparse_features, search,
+                                            search_kwargs)
+
+        if self.stats_callback is not None:
+            self.stats_callback(stats)
+        return [filter_distance(res, return_distance) for res in results]
 
-            results.extend(self._search(sparse_features=records_rng,
-                                        k=k,
-                                        max_distance=max_distance,
-                                        k_clusters=k_clusters))
+    def search_pool(self, n_jobs=None):
+        """Start a process pool for repeated searches. Every worker gets a
+        copy of the index once, instead of once per search with
+        backend='process'. The workers search the index as it was when the
+        pool started (except for inserted records that are not flushed
+        yet), so start a new pool after changing it. To share one memory
+        mapped copy of a saved index between the workers see
+        pysparnn.serving.WorkerPool.
 
-        return [filter_distance(res, return_distance) for res in results]
+        Usage:
+            with index.search_pool(n_jobs=8) as pool:
+                index.search(features, k=5, executor=pool)
+
+        Args:
+            n_jobs: Number of worker processes, see
+                pysparnn.parallel.num_workers. Defaults to every cpu.
+        Returns:
+            A pool to pass to search as executor. Close it (or use it as a
+            context manager) to stop the workers.
+        """
+        return _SearchPool([self], n_jobs)
+
+    def search_iter(self, sparse_features, batch_size=None, prefetch=False,
+                    **kwargs):
+        """Search a stream of queries one batch at a time.
+
+        Only one batch of queries and its results (two with prefetch) are
+        in memory at once, so this can search more queries than fit in
+        memory.
+
+        Args:
+            sparse_features: A matrix with a row per query that is sliced
+                one batch at a time (e.g. a csr_matrix or a memory mapped
+                matrix), or an iterable of csr_matrix chunks with any number
+                of rows.
+            batch_size: Number of queries per batch. Defaults to
+                batch_size.
+            prefetch: Search the next batch in a background thread while
+                the results of the current batch are used.
+            kwargs: Arguments of search.
+        Yields:
+            For each batch, the search results of its queries, see search.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        return _search_iter(lambda batch: self.search(batch, **kwargs),
+                            sparse_features, int(batch_size), prefetch)
+
+    def asearch(self, sparse_features, **kwargs):
+        """Search from asyncio code. Concurrent requests are searched
+        together: the queries of the requests made within asearch_delay
+        seconds of each other (up to asearch_batch_size queries) are
+        stacked into one batch, which is searched on asearch_executor
+        (defaults to the event loop's executor). Must be called from a
+        coroutine of a running event loop. Requires python 3.7.
+
+        Usage:
+            results = await index.asearch(features[0], k=5)
+
+        Args:
+            sparse_features: A csr_matrix of queries, usually one row.
+            kwargs: Arguments of search. Only requests with the same
+                arguments are batched together.
+        Returns:
+            An asyncio future of the search results of sparse_features,
+            see search.
+        """
+        if self._batcher is None:
+            # asyncio is only available on python 3
+            import pysparnn.aio
+            self._batcher = pysparnn.aio.MicroBatcher(
+                self.search, self.asearch_batch_size, self.asearch_delay,
+                self.asearch_executor)
+        return self._batcher.submit(sparse_features, kwargs)
         
     def _print_structure(self, tabs=''):
         """Pretty print the tree index structure's matrix sizes"""
-        print(tabs + str(self.root.matrix.shape[0]))
+        print(tabs + str(len(self.root.records_data)))
         if not self.is_terminal:
             for index in self.root.records_data:
-                index.print_structure(tabs + '  ')
+                index._print_structure(tabs + '  ')
 
     def _max_depth(self):
         """Yield the max depth of the tree index"""
@@ -409,11 +1634,40 @@ class MultiClusterIndex(object):
 
             Scenario 1 will be much faster than Scenario 2 for large data. 
             Scenario 2 will have better recall than Scenario 1. 
+
+       The indexes share one copy of the features, norms and records (the
+       store). Each index only keeps the leaders of its clusters and, in
+       its leaves, the positions of their records in the store, so extra
+       indexes mostly cost routing structure. The store is ordered by the
+       leaves of the first index so they search their rows in place; the
+       leaves of the other indexes gather their rows from the store when
+       they are searched.
+
+       Inserted records are searched by brute force until delta_size of them
+       have been inserted; see insert_batch.
     """
 
+    # records inserted since the last flush, see insert_batch
+    delta = None
+    # number of records the delta holds before it is flushed
+    delta_size = 1000
+    # pysparnn.cache.QueryCache of search results, see ClusterIndex.search
+    cache = None
+    # function called with the pysparnn.stats.SearchStats of every search
+    stats_callback = None
+    # most queries searched at once, see ClusterIndex.search_iter
+    batch_size = 1000
+    # batching of concurrent asearch requests, see ClusterIndex.asearch
+    asearch_batch_size = 64
+    asearch_delay = 0.002
+    asearch_executor = None
+    _batcher = None
+
     def __init__(self, sparse_features, records_data,
                  distance_type=pysparnn.matrix_distance.CosineDistance,
-                 matrix_size=None, num_indexes=2):
+                 matrix_size=None, num_indexes=2, n_jobs=None,
+                 executor=None, clustering=None, max_cluster_size=None,
+                 num_assignments=None, assignment_gap=None, dtype=None):
         """Create a search index composed of multtiple ClusterIndexes. See 
         class docstring for a description of the method.
 
@@ -429,13 +1683,92 @@ class MultiClusterIndex(object):
                 reccomended that the default value is used.
             num_indexes: Number of ClusterIndexes to construct. Improves recall
                 at the cost of memory.
+            n_jobs: Number of processes used to build the indexes. When there
+                are at least as many indexes as processes each index is built
+                by one process, otherwise the indexes are built one at a time
+                and share the processes (see ClusterIndex). Defaults to 1
+                (no pool); -1 uses every cpu.
+            executor: An existing pool to use instead of n_jobs. Anything
+                with a map(func, iterable) method, e.g. multiprocessing.Pool.
+            clustering: How the leaders of each level are picked, see
+                ClusterIndex.
+            max_cluster_size: Largest leaf when balancing the clusters, see
+                ClusterIndex.
+            num_assignments: Number of clusters each record is assigned to,
+                see ClusterIndex.
+            assignment_gap: see ClusterIndex.
+            dtype: dtype the matrices are stored as, see ClusterIndex.
         """
 
+        sparse_features = distance_type._prepare(sparse_features)
+        self.store = distance_type(sparse_features, records_data)
+        self.store._set_dtype(dtype)
+        options = dict(clustering=clustering,
+                       max_cluster_size=max_cluster_size,
+                       num_assignments=num_assignments,
+                       assignment_gap=assignment_gap,
+                       dtype=dtype)
+        row_ids = np.arange(sparse_features.shape[0])
+
+        with pysparnn.parallel.get_executor(n_jobs,
+                                            executor=executor) as pool:
+            if executor is None and num_indexes > 1 and \
+                    num_indexes >= pysparnn.parallel.num_workers(n_jobs):
+                tasks = [(sparse_features, records_data, distance_type,
+                          matrix_size, random.getrandbits(32), row_ids,
+                          options)
+                         for _ in range(num_indexes)]
+                self.indexes = pool.map(_build_cluster, tasks)
+                for index in self.indexes:
+                    index._attach_store(self.store)
+            else:
+                self.indexes = []
+                for _ in range(num_indexes):
+                    self.indexes.append((ClusterIndex(sparse_features,
+                                                      records_data,
+                                                      distance_type,
+                                                      matrix_size,
+                                                      executor=pool,
+                                                      store=self.store,
+                                                      row_ids=row_ids,
+                                                      _prepared=True,
+                                                      **options)))
+        self.store = _order_store(self.store, self.indexes)
+
+    def save(self, path):
+        """Save the index to a directory as flat binary arrays. See
+        pysparnn.storage. Inserted records are flushed into the tree and
+        deleted records are removed (see compact) first.
 
-        self.indexes = []
-        for _ in range(num_indexes):
-            self.indexes.append((ClusterIndex(sparse_features, records_data,
-                                              distance_type, matrix_size)))
+        Args:
+            path: Directory to write to. Created if it does not exist.
+        """
+        self.flush()
+        self.compact(max_dead_ratio=1.0)
+        pysparnn.storage.save(path, self.indexes, 'MultiClusterIndex')
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index written by save.
+
+        Args:
+            path: Directory the index was saved to.
+            mmap: Memory map the feature matrices, norms and records instead
+                of reading them into memory. Processes that memory map the
+                same index share its pages.
+        """
+        kind, indexes = pysparnn.storage.load(path, mmap)
+        if kind != 'MultiClusterIndex':
+            raise ValueError('{} is a saved {}'.format(path, kind))
+        index = cls.__new__(cls)
+        index.indexes = indexes
+        index.store = indexes[0].store
+        return index
+
+    def _clear_cache(self):
+        """Drop the cached search results once the records change."""
+        if self.cache is not None:
+            self.cache.clear()
 
     def insert(self, sparse_feature, record):
         """Insert a single record into the index.
@@ -444,11 +1777,92 @@ class MultiClusterIndex(object):
             sparse_feature: sparse feature vector
             record: record to return as the result of a search
         """
+        self.insert_batch(sparse_feature, [record])
+
+    def insert_batch(self, sparse_features, records_data):
+        """Insert records into the index. The records are kept in one
+        delta for all of the indexes; see ClusterIndex.insert_batch.
+
+        Args:
+            sparse_features: A csr_matrix with a row per record.
+            records_data: records to return as the result of a search.
+        """
+        self._clear_cache()
+        self.delta = _append_delta(self.delta, self.indexes[0].distance_type,
+                                   sparse_features, records_data)
+        if self.delta.matrix.shape[0] >= self.delta_size:
+            self.flush()
+
+    def flush(self):
+        """Move the records of the delta into every index. The records are
+        appended to the store once. See ClusterIndex.flush."""
+        if self.delta is None:
+            return
+        self._clear_cache()
+        delta = self.delta.drop_deleted()
+        self.delta = None
+        features = delta.get_feature_matrix()
+        records = delta.get_records()
+        row_ids = None
+        if self.store is not None:
+            row_ids = self.store.append(features, records)
         for ind in self.indexes:
-            ind.insert(sparse_feature, record)
+            ind._add_records(features, records, row_ids)
+
+    def delete(self, records_data):
+        """Delete records from every index. See ClusterIndex.delete.
+
+        Args:
+            records_data: Records to delete.
+        """
+        self._clear_cache()
+        if self.delta is not None:
+            self.delta.delete(records_data)
+        if self.store is not None:
+            self.store.delete(records_data)
+        else:
+            for ind in self.indexes:
+                ind._delete(records_data)
+
+    def update(self, record, sparse_feature):
+        """Replace the features of a record.
+
+        Args:
+            record: The record to update.
+            sparse_feature: Its new sparse feature vector.
+        """
+        self.delete([record])
+        self.insert(sparse_feature, record)
+
+    def compact(self, max_dead_ratio=0.3):
+        """Remove the deleted records from every index. See
+        ClusterIndex.compact.
+
+        Args:
+            max_dead_ratio: Fraction of deleted records above which a
+                subtree is rebuilt.
+        """
+        self._clear_cache()
+        if self.delta is not None:
+            self.delta = self.delta.drop_deleted()
+        for ind in self.indexes:
+            ind._compact(max_dead_ratio)
+        self.store = _compact_store(self.store, self.indexes)
+
+    def rebalance(self, max_cluster_size=None):
+        """Balance the clusters of every index. See ClusterIndex.rebalance.
+
+        Args:
+            max_cluster_size: Largest leaf.
+        """
+        self._clear_cache()
+        for ind in self.indexes:
+            ind.rebalance(max_cluster_size)
 
     def search(self, sparse_features, k=1, max_distance=None, k_clusters=1, 
-               return_distance=True, num_indexes=None):
+               return_distance=True, num_indexes=None, n_jobs=None,
+               backend='thread', executor=None, radius_scale=None,
+               stats=None):
         """Find the closest item(s) for each feature_list in the index.
 
         Args:
@@ -472,6 +1886,19 @@ class MultiClusterIndex(object):
                 the cost of some speed. Can not be larger than the number of 
                 num_indexes that was specified in the constructor. Defaults to
                 searching all indexes.
+            n_jobs: Number of workers used to search the indexes and batches
+                of queries concurrently. Defaults to 1; -1 uses every cpu.
+            backend: 'thread' (default) or 'process'. See
+                ClusterIndex.search.
+            executor: An existing pool to use instead of n_jobs. Anything
+                with a map(func, iterable) method, e.g. a ThreadPool or a
+                pool from search_pool.
+            radius_scale: Visit the clusters adaptively, see
+                ClusterIndex.search.
+            stats: A pysparnn.stats.SearchStats to add to, see
+                ClusterIndex.search and stats_callback.
+
+        Results are cached in cache, see ClusterIndex.search.
 
         Returns:
             For each element in features_list, return the k-nearest items
@@ -483,19 +1910,87 @@ class MultiClusterIndex(object):
             [[item1_1, ..., item1_k],
              [item2_1, ..., item2_k], ...]
         """
-        results = []
         if num_indexes is None:
             num_indexes = len(self.indexes)
-        for ind in self.indexes[:num_indexes]:
-            results.append(ind.search(sparse_features, k, max_distance,
-                                      k_clusters, True))
-        ret = []
-        for r in np.hstack(results):
-            ret.append(
-                filter_distance(
-                    k_best(filter_unique(r), k), 
-                    return_distance
-                )
-            )
-
-        return ret 
+        if stats is None and self.stats_callback is not None:
+            stats = pysparnn.stats.SearchStats()
+        sparse_features = self.indexes[0].distance_type._prepare(
+            sparse_features)
+        search_kwargs = dict(k=k, max_distance=max_distance,
+                             k_clusters=k_clusters, radius_scale=radius_scale)
+
+        def search(features):
+            if stats is not None:
+                stats.num_queries += features.shape[0]
+            results = _search_indexes(self.indexes[:num_indexes], features,
+                                      search_kwargs, n_jobs, backend,
+                                      executor, stats, self.batch_size)
+            if self.delta is not None:
+                results.append(self.delta.nearest_search(
+                    features, k=k, max_distance=max_distance, stats=stats,
+                    prepared=True))
+            ret = []
+            with pysparnn.stats.timer(stats, 'merge_time'):
+                for query_results in zip(*results):
+                    r = [item for res in query_results for item in res]
+                    ret.append(k_best(filter_unique(r), k))
+            return ret
+
+        with pysparnn.stats.timer(stats, 'total_time'):
+            if self.cache is None:
+                results = search(sparse_features)
+            else:
+                results = self.cache.search(
+                    sparse_features, search,
+                    dict(search_kwargs, num_indexes=num_indexes))
+
+        if self.stats_callback is not None:
+            self.stats_callback(stats)
+        return [filter_distance(res, return_distance) for res in results]
+
+    def search_pool(self, n_jobs=None):
+        """Start a process pool whose workers each get a copy of the
+        indexes once, for repeated searches. See ClusterIndex.search_pool.
+
+        Args:
+            n_jobs: Number of worker processes. Defaults to every cpu.
+        Returns:
+            A pool to pass to search as executor.
+        """
+        return _SearchPool(self.indexes, n_jobs)
+
+    def search_iter(self, sparse_features, batch_size=None, prefetch=False,
+                    **kwargs):
+        """Search a stream of queries one batch at a time. See
+        ClusterIndex.search_iter.
+
+        Args:
+            sparse_features: A matrix or an iterable of csr_matrix chunks.
+            batch_size: Number of queries per batch.
+            prefetch: Search the next batch while the current one is used.
+            kwargs: Arguments of search.
+        Yields:
+            For each batch, the search results of its queries.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        return _search_iter(lambda batch: self.search(batch, **kwargs),
+                            sparse_features, int(batch_size), prefetch)
+
+    def asearch(self, sparse_features, **kwargs):
+        """Search from asyncio code, batching concurrent requests. See
+        ClusterIndex.asearch.
+
+        Args:
+            sparse_features: A csr_matrix of queries, usually one row.
+            kwargs: Arguments of search.
+        Returns:
+            An asyncio future of the search results of sparse_features.
+        """
+        if self._batcher is None:
+            # asyncio is only available on python 3
+            import pysparnn.aio
+            self._batcher = pysparnn.aio.MicroBatcher(
+                self.search, self.asearch_batch_size, self.asearch_delay,
+                self.asearch_executor)
+        return self._batcher.submit(sparse_features, kwargs)
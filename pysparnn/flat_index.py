@@ -0,0 +1,254 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Defines a cluster pruning search structure stored in flat arrays"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import random
+import numpy as np
+import scipy.sparse
+import pysparnn.matrix_distance
+from pysparnn.cluster_pruning import filter_distance
+from pysparnn.cluster_pruning import group_by
+
+
+class FlatClusterIndex(object):
+    """Search structure which gives speedup at slight loss of recall.
+
+       Same cluster pruning structure as ClusterIndex (see its
+       documentation) with a different memory layout. Instead of a tree of
+       ClusterIndex objects that each own a matrix, there is:
+
+         * One matrix with all of the records, reordered so that the
+           records under every node of the tree are a contiguous range of
+           rows.
+         * One matrix with the leader (representative) of every node. The
+           children of a node have consecutive node ids so the leaders a
+           node searches are also a contiguous range of rows.
+         * Integer arrays with the row ranges, child ranges and parent of
+           every node.
+
+       Every node is searched through zero copy slices of the two matrices
+       and the row stats (norms) are computed once for each matrix. The
+       number of Python objects does not grow with the size of the index.
+
+       The index is searched level by level: all of the queries routed to
+       the same node are searched with one matrix multiply.
+    """
+
+    def __init__(self, sparse_features, records_data,
+                 distance_type=pysparnn.matrix_distance.CosineDistance,
+                 matrix_size=None):
+        """Create a search index. See class docstring for a description of
+        the method.
+
+        Args:
+            sparse_features: A csr_matrix with rows that represent records
+                (corresponding to the elements in records_data) and columns
+                that describe a point in space for each row.
+            records_data: Data to return when a doc is matched. Index of
+                corresponds to records_features.
+            distance_type: Class that defines the distance measure to use.
+            matrix_size: Ideal size for matrix multiplication. This controls
+                the depth of the tree. Defaults to 2 levels (approx). Highly
+                reccomended that the default value is used.
+        """
+        sparse_features = distance_type._prepare(
+            scipy.sparse.csr_matrix(sparse_features))
+        num_records = sparse_features.shape[0]
+
+        if matrix_size is None:
+            matrix_size = max(int(np.sqrt(num_records)), 100)
+        self.matrix_size = int(matrix_size)
+        self.distance_type = distance_type
+
+        # row order of the records; split in place as the tree is built
+        order = np.arange(num_records)
+        parent, leader = [-1], [-1]
+        row_start, row_stop = [0], [num_records]
+        child_start, child_stop = [0], [0]
+
+        # breadth first so the children of a node get consecutive ids
+        node = 0
+        while node < len(parent):
+            ids = order[row_start[node]:row_stop[node]]
+            split = self._split(sparse_features, ids)
+            if split is not None:
+                leaders, assignment = split
+                by_cluster = np.argsort(assignment, kind='mergesort')
+                order[row_start[node]:row_stop[node]] = ids[by_cluster]
+                counts = np.bincount(assignment, minlength=len(leaders))
+
+                child_start[node] = len(parent)
+                first_row = row_start[node]
+                for cluster in np.flatnonzero(counts):
+                    parent.append(node)
+                    leader.append(leaders[cluster])
+                    row_start.append(first_row)
+                    first_row += counts[cluster]
+                    row_stop.append(first_row)
+                    child_start.append(0)
+                    child_stop.append(0)
+                child_stop[node] = len(parent)
+            node += 1
+
+        self.node_parent = np.array(parent)
+        self.node_row_start = np.array(row_start)
+        self.node_row_stop = np.array(row_stop)
+        self.node_child_start = np.array(child_start)
+        self.node_child_stop = np.array(child_stop)
+        self.is_terminal = self.node_child_start == self.node_child_stop
+
+        # record_ids[row] is the position in records_data / sparse_features
+        # of a row of the reordered records
+        self.record_ids = order
+        self.records = distance_type(sparse_features[order],
+                                     np.array(records_data)[order])
+        self.records_data = self.records.get_records()
+
+        # the root has no leader; give it an empty row
+        leaders = scipy.sparse.vstack([
+            scipy.sparse.csr_matrix((1, sparse_features.shape[1]),
+                                    dtype=sparse_features.dtype),
+            sparse_features[leader[1:]]]).tocsr()
+        self.leaders = distance_type(leaders, np.arange(len(parent)))
+
+    def _split(self, sparse_features, ids):
+        """Pick leaders for the records ids and assign every record to its
+        nearest leader.
+
+        Returns:
+            None if the records should be a leaf. Otherwise a tuple of
+            (leader record ids, index of the nearest leader of every record).
+        """
+        num_records = len(ids)
+        if np.log(num_records) / np.log(self.matrix_size) <= 1.4:
+            return None
+
+        clusters_size = min(self.matrix_size, num_records)
+        leaders = ids[random.sample(range(num_records), clusters_size)]
+        root = self.distance_type(sparse_features[leaders],
+                                  np.arange(clusters_size))
+
+        assignment = []
+        rng_step = self.matrix_size
+        for rng in range(0, num_records, rng_step):
+            records_rng = sparse_features[ids[rng:rng + rng_step]]
+            _, nearest = root.nearest_search(records_rng, k=1,
+                                             return_arrays=True,
+                                             prepared=True)
+            assignment.append(nearest[:, 0])
+        assignment = np.concatenate(assignment)
+        # records that can not be compared to any leader (e.g. NaN
+        # distances) go to the first cluster instead of being lost
+        assignment[assignment < 0] = 0
+
+        if len(np.unique(assignment)) < 2:
+            # every record is closest to the same leader (i.e. the records
+            # are duplicates). splitting again would recurse forever
+            return None
+        return leaders, assignment
+
+    def _search(self, sparse_features, k=1, max_distance=None, k_clusters=1):
+        """Find the closest records for each query, one level at a time.
+
+        Returns:
+            A tuple of (distances, rows) arrays in the format of
+            MatrixMetricSearch.nearest_search(return_arrays=True). rows are
+            rows of the reordered records (see record_ids).
+        """
+        num_queries = sparse_features.shape[0]
+        query_ids = np.arange(num_queries)
+        node_ids = np.zeros(num_queries, dtype=np.intp)
+
+        found_queries, found_distances, found_rows = [], [], []
+        while len(query_ids) > 0:
+            next_queries, next_nodes = [], []
+            for node, queries in group_by(node_ids, query_ids):
+                features = sparse_features[queries]
+                if self.is_terminal[node]:
+                    distances, rows = self.records._nearest(
+                        features, k, max_distance,
+                        self.node_row_start[node], self.node_row_stop[node])
+                    found_queries.append(np.repeat(queries, rows.shape[1]))
+                    found_distances.append(distances.reshape(-1))
+                    found_rows.append(rows.reshape(-1))
+                else:
+                    _, children = self.leaders._nearest(
+                        features, k_clusters, None,
+                        self.node_child_start[node],
+                        self.node_child_stop[node])
+                    query, _ = np.nonzero(children >= 0)
+                    next_queries.append(queries[query])
+                    next_nodes.append(children[children >= 0])
+            query_ids = np.concatenate(next_queries or [[]]).astype(np.intp)
+            node_ids = np.concatenate(next_nodes or [[]]).astype(np.intp)
+
+        rows = np.concatenate(found_rows)
+        found = rows >= 0
+        return pysparnn.matrix_distance.sparse_top_k(
+            np.concatenate(found_queries)[found], rows[found],
+            np.concatenate(found_distances)[found], num_queries, k)
+
+    def search(self, sparse_features, k=1, max_distance=None, k_clusters=1,
+               return_distance=True):
+        """Find the closest item(s) for each feature_list in the index.
+
+        Args:
+            sparse_features: A csr_matrix with rows that represent records
+                (corresponding to the elements in records_data) and columns
+                that describe a point in space for each row.
+            k: Return the k closest results.
+            max_distance: Return items no more than max_distance away from the
+                query point. Defaults to any distance.
+            k_clusters: number of branches (clusters) to search at each level.
+                This increases recall at the cost of some speed.
+
+        Returns:
+            For each element in features_list, return the k-nearest items
+            and (optionally) their distance score
+            [[(score1_1, item1_1), ..., (score1_k, item1_k)],
+             [(score2_1, item2_1), ..., (score2_k, item2_k)], ...]
+
+            Note: if return_distance == False then the scores are omitted
+            [[item1_1, ..., item1_k],
+             [item2_1, ..., item2_k], ...]
+        """
+        # search no more than 1k records at once
+        # helps keap the matrix multiplies small
+        batch_size = 1000
+        sparse_features = self.distance_type._prepare(sparse_features)
+        results = []
+        for rng in range(0, sparse_features.shape[0], batch_size):
+            records_rng = sparse_features[rng:rng + batch_size]
+            distances, rows = self._search(records_rng, k=k,
+                                           max_distance=max_distance,
+                                           k_clusters=k_clusters)
+            records = self.records_data[np.maximum(rows, 0)]
+            for i in range(rows.shape[0]):
+                found = rows[i] >= 0
+                results.append(list(zip(distances[i][found],
+                                        records[i][found])))
+
+        return [filter_distance(res, return_distance) for res in results]
+
+    def _max_depth(self):
+        """Return the max depth of the tree index"""
+        depth = np.ones(len(self.node_parent), dtype=int)
+        # parents always have smaller ids than their children
+        for node in range(1, len(self.node_parent)):
+            depth[node] = depth[self.node_parent[node]] + 1
+        return depth.max()
+
+    def _matrix_sizes(self):
+        """Return the matrix size of every node (number of records for a leaf
+        and number of children otherwise)"""
+        return np.where(self.is_terminal,
+                        self.node_row_stop - self.node_row_start,
+                        self.node_child_stop - self.node_child_start)
@@ -0,0 +1,148 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Trains cluster leaders with k-means++ seeding and mini-batch k-means.
+
+Distances, assignments and centroids all go through a distance_type (see
+pysparnn.matrix_distance) so the leaders suit the metric of the index:
+with CosineDistance this is spherical k-means.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import numpy as np
+import scipy.sparse
+
+
+def _nearest(distance_type, centroids, sparse_features):
+    """Index of and distance to the nearest centroid of every row. Rows that
+    can not be compared to any centroid get -1 and inf."""
+    search = distance_type(centroids, np.arange(centroids.shape[0]))
+    distances, nearest = search.nearest_search(sparse_features, k=1,
+                                               return_arrays=True,
+                                               prepared=True)
+    return nearest[:, 0], distances[:, 0]
+
+
+def _keep_top(matrix, max_features):
+    """Copy of a csr_matrix with only the max_features largest (absolute)
+    values of every row."""
+    matrix = scipy.sparse.csr_matrix(matrix)
+    lengths = np.diff(matrix.indptr)
+    if len(lengths) == 0 or lengths.max() <= max_features:
+        return matrix
+    rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+    # rank of every value within its row, largest first
+    order = np.lexsort((-np.abs(matrix.data), rows))
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order)) - np.repeat(matrix.indptr[:-1],
+                                                    lengths)
+    keep = rank < max_features
+    return scipy.sparse.csr_matrix(
+        (matrix.data[keep], (rows[keep], matrix.indices[keep])),
+        shape=matrix.shape)
+
+
+def kmeans_plus_plus(distance_type, sparse_features, num_clusters, rng):
+    """Pick num_clusters rows of sparse_features with k-means++: each row is
+    picked with probability proportional to its squared distance to the
+    nearest row picked so far.
+
+    Args:
+        distance_type: Class that defines the distance measure to use.
+        sparse_features: A csr_matrix of records, prepared by
+            distance_type._prepare.
+        num_clusters: Number of rows to pick.
+        rng: A numpy RandomState.
+    Returns:
+        Array of the picked rows.
+    """
+    num_records = sparse_features.shape[0]
+    num_clusters = min(num_clusters, num_records)
+    picked = [rng.randint(num_records)]
+    nearest = np.full(num_records, np.inf)
+    for _ in range(num_clusters - 1):
+        _, distances = _nearest(distance_type,
+                                sparse_features[picked[-1:]],
+                                sparse_features)
+        nearest = np.minimum(nearest, distances)
+
+        # distances may be negative (e.g. InnerProductDistance); rows that
+        # can not be compared (inf) are never picked
+        finite = np.isfinite(nearest)
+        weights = np.zeros(num_records)
+        if finite.any():
+            weights[finite] = (nearest[finite] - nearest[finite].min()) ** 2
+        weights[picked] = 0
+        if weights.sum() > 0:
+            picked.append(rng.choice(num_records, p=weights / weights.sum()))
+        else:
+            # every remaining row is as close as it can be (duplicates)
+            remaining = np.setdiff1d(np.arange(num_records), picked)
+            picked.append(rng.choice(remaining))
+    return np.array(picked)
+
+
+def minibatch_kmeans(distance_type, sparse_features, num_clusters, rng,
+                     iterations=5, batch_size=None, max_features=None):
+    """Train num_clusters centroids with mini-batch k-means.
+
+    The centroids are seeded with k-means++ on a sample of the rows. Every
+    iteration assigns a random batch of rows to their nearest centroid and
+    moves each centroid to the mean of every row it was assigned so far
+    (per centroid learning rate of 1 / count). distance_type defines the
+    mean, see MatrixMetricSearch._centroids. The means of many sparse rows
+    are nearly dense so after every update only the max_features largest
+    weights of each centroid are kept.
+
+    Args:
+        distance_type: Class that defines the distance measure to use.
+        sparse_features: A csr_matrix of records, prepared by
+            distance_type._prepare.
+        num_clusters: Number of centroids.
+        rng: A numpy RandomState.
+        iterations: Number of mini-batches.
+        batch_size: Rows per mini-batch. Defaults to 10 per centroid (at
+            least 1000).
+        max_features: Most nonzero weights of a centroid. Defaults to 10
+            times the mean number of features of a row.
+    Returns:
+        A csr_matrix of centroids.
+    """
+    num_records = sparse_features.shape[0]
+    num_clusters = min(num_clusters, num_records)
+    if batch_size is None:
+        batch_size = max(10 * num_clusters, 1000)
+    batch_size = min(batch_size, num_records)
+    if max_features is None:
+        max_features = max(int(np.ceil(
+            10.0 * sparse_features.nnz / max(num_records, 1))), 1)
+
+    sample = sparse_features[rng.choice(num_records, batch_size,
+                                        replace=False)]
+    seeds = kmeans_plus_plus(distance_type, sample, num_clusters, rng)
+    sums = _keep_top(scipy.sparse.csr_matrix(
+        distance_type._centroid_features(sample[seeds]), dtype=float),
+                     max_features)
+    counts = np.ones(num_clusters)
+    centroids = distance_type._centroids(sums, counts)
+
+    for _ in range(iterations):
+        batch = sparse_features[rng.choice(num_records, batch_size,
+                                           replace=False)]
+        nearest, _ = _nearest(distance_type, centroids, batch)
+        assigned = nearest >= 0
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(np.count_nonzero(assigned)),
+             (nearest[assigned], np.flatnonzero(assigned))),
+            shape=(num_clusters, batch_size))
+        sums = _keep_top(sums + membership.dot(
+            distance_type._centroid_features(batch)), max_features)
+        counts += np.asarray(membership.sum(axis=1)).reshape(-1)
+        centroids = distance_type._centroids(sums, counts)
+    return centroids
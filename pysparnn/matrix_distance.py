@@ -11,15 +11,217 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 import abc
+import timeit
+import warnings
 import numpy as np
 import scipy.sparse
 import scipy.spatial.distance
+from pysparnn.stats import timer
+
+def top_k(dist_matrix, k, max_distance=None):
+    """Select the k smallest distances in each row of a dense matrix.
+
+    Args:
+        dist_matrix: A dense (queries x records) array of distances.
+        k: Number of results to select per row.
+        max_distance: Ignore distances greater than max_distance. NaN
+            distances are always ignored.
+
+    Returns:
+        A tuple of (distances, indices) arrays of shape
+        (queries, min(k, records)) sorted by distance. Ties are broken by
+        the lower index. Rows with fewer valid entries are padded with a
+        distance of inf and an index of -1.
+    """
+    dist_matrix = np.asarray(dist_matrix)
+    n_rows, n_cols = dist_matrix.shape
+    k = min(int(k), n_cols)
+
+    if max_distance is None:
+        valid = ~np.isnan(dist_matrix)
+    else:
+        with np.errstate(invalid='ignore'):
+            valid = dist_matrix <= max_distance
+    # NaN sorts after everything (including inf) in both the partition and
+    # the sort below so invalid entries fall to the end of each row
+    keys = np.where(valid, dist_matrix, np.nan)
+
+    rows = np.arange(n_rows)[:, np.newaxis]
+    if k == 0:
+        candidates = np.zeros((n_rows, 0), dtype=np.intp)
+    elif k < n_cols:
+        candidates = np.argpartition(keys, k - 1, axis=1)[:, :k]
+
+        # argpartition picks arbitrary entries among those tied for the
+        # k-th place. re-pick the lowest indices for rows with such ties.
+        kth = keys[rows, candidates].max(axis=1)[:, np.newaxis]
+        is_kth = keys == kth
+        kth_count = is_kth.sum(axis=1)
+        tied = np.flatnonzero(kth_count >
+                              (keys[rows, candidates] == kth).sum(axis=1))
+        if len(tied) > 0:
+            is_kth = is_kth[tied]
+            with np.errstate(invalid='ignore'):
+                better = keys[tied] < kth[tied]
+            need = k - better.sum(axis=1)[:, np.newaxis]
+            take = better | (is_kth & (np.cumsum(is_kth, axis=1) <= need))
+            candidates[tied] = np.nonzero(take)[1].reshape(len(tied), k)
+    else:
+        candidates = np.tile(np.arange(n_cols), (n_rows, 1))
+
+    keys = keys[rows, candidates]
+    order = np.lexsort((candidates, keys), axis=-1)
+    candidates = candidates[rows, order]
+    keys = keys[rows, order]
+
+    missing = np.isnan(keys)
+    keys[missing] = np.inf
+    candidates[missing] = -1
+    return keys, candidates
+
+
+def csr_rows(matrix, start, stop):
+    """Rows [start, stop) of a csr_matrix. Unlike matrix[start:stop] the
+    data and indices arrays of the result are views into matrix; only the
+    index pointers are copied.
+    """
+    indptr = matrix.indptr[start:stop + 1]
+    first, last = indptr[0], indptr[-1]
+    return scipy.sparse.csr_matrix(
+        (matrix.data[first:last], matrix.indices[first:last], indptr - first),
+        shape=(stop - start, matrix.shape[1]), copy=False)
+
+
+def csr_take(matrix, rows):
+    """Rows of a csr_matrix, in order. Unlike matrix[rows] this keeps the
+    dtypes of the arrays (scipy can not gather float16 rows).
+    """
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    indptr = np.zeros(len(rows) + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(lengths, out=indptr[1:])
+    positions = np.arange(indptr[-1]) + \
+            np.repeat(starts - indptr[:-1], lengths)
+    return scipy.sparse.csr_matrix(
+        (matrix.data[positions], matrix.indices[positions], indptr),
+        shape=(len(rows), matrix.shape[1]), copy=False)
+
+
+def select_k(distances, indices, k):
+    """Select the k smallest distances in each row of padded result arrays.
+
+    Args:
+        distances: A (queries x n) array of distances.
+        indices: A (queries x n) array of record indices. Negative indices
+            mark missing entries.
+        k: Number of results to select per row.
+
+    Returns:
+        A tuple of (distances, indices) arrays of shape (queries, min(k, n))
+        in the same format as top_k.
+    """
+    order = np.lexsort((indices, distances, indices < 0), axis=-1)[:, :k]
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    return distances[rows, order], indices[rows, order]
+
+
+def sparse_top_k(rows, cols, distances, n_rows, k):
+    """Select the k smallest distances per row from a list of entries.
+
+    Args:
+        rows: Row (query) of each entry.
+        cols: Column (record index) of each entry.
+        distances: Distance of each entry.
+        n_rows: Number of rows (queries).
+        k: Number of results to select per row. This is also the width of
+            the returned arrays.
+
+    Returns:
+        A tuple of (distances, indices) arrays in the same format as top_k.
+    """
+    order = np.lexsort((cols, distances, rows))
+    rows = rows[order]
+    cols = cols[order]
+    distances = distances[order]
+
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+
+    ret_distances = np.full((n_rows, k), np.inf)
+    ret_indices = np.full((n_rows, k), -1, dtype=np.intp)
+    ret_distances[rows[keep], rank[keep]] = distances[keep]
+    ret_indices[rows[keep], rank[keep]] = cols[keep]
+    return ret_distances, ret_indices
+
+
+def _result_lists(distances, indices, records):
+    """Lists of (distance, record) tuples from the arrays of
+    nearest_search(return_arrays=True).
+
+    Args:
+        distances: see MatrixMetricSearch.nearest_search
+        indices: see MatrixMetricSearch.nearest_search
+        records: Array of the record of every index. Missing results may
+            hold any record.
+    """
+    found = indices >= 0
+    return [list(zip(distances[i][found[i]], records[i][found[i]]))
+            for i in range(indices.shape[0])]
+
+
+def _append_array(buffers, name, array, values):
+    """array followed by values (along the first axis).
+
+    The result is a view of a buffer with spare room at the end. The buffer
+    is kept in buffers[name] and reused when the result is appended to again
+    so n appends of m rows cost O(n * m) rather than O(n ** 2 * m).
+
+    Args:
+        buffers: dict of name -> (buffer, view) from earlier appends.
+        name: Key of array in buffers.
+        array: The array to append to.
+        values: The values to append.
+    """
+    size = len(array) + len(values)
+    dtype = np.result_type(array, values)
+    buffer, view = buffers.get(name, (None, None))
+    if view is None or array.ctypes.data != view.ctypes.data or \
+            len(array) != len(view) or array.dtype != dtype or \
+            len(buffer) < size:
+        buffer = np.empty((max(size, 2 * len(array)),) + array.shape[1:],
+                          dtype=dtype)
+        buffer[:len(array)] = array
+    buffer[len(array):size] = values
+    view = buffer[:size]
+    buffers[name] = (buffer, view)
+    return view
+
 
 class MatrixMetricSearch(object):
     """A sparse matrix representation out of features."""
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, sparse_features, records_data):
+    # approximate number of bytes a single block of distances may use
+    memory_budget = 256 * 1024 ** 2
+    # names of the per record arrays that __init__ computes from the
+    # feature matrix. they are saved with the index so that loading it does
+    # not have to recompute them
+    row_stats = ()
+    # (order, key) pairs of row_stats where order is the stable argsort of
+    # key. they are recomputed, not gathered, when records are taken and
+    # they are only recomputed when needed after records are appended
+    row_orders = ()
+    # boolean array marking the deleted records, None if there are none.
+    # see delete
+    tombstones = None
+    # True if the distance satisfies the triangle inequality, see
+    # _lower_bound
+    is_metric = False
+    # name of the dtype the feature values and float row stats are stored
+    # as; None keeps the dtype of the features. see _set_dtype
+    dtype = None
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
         """
         Args:
             sparse_features: A csr_matrix with rows that represent records
@@ -27,9 +229,36 @@ class MatrixMetricSearch(object):
                 that describe a point in space for each row.
             records_data: Data to return when a doc is matched. Index of
                 corresponds to sparse_features.
+            memory_budget: Approximate number of bytes to use for a block
+                of distances. Searches split the records into blocks of at
+                most memory_budget / (8 * num_queries) rows. Defaults to
+                MatrixMetricSearch.memory_budget.
         """
         self.matrix = sparse_features
         self.records_data = np.array(records_data)
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+
+    @classmethod
+    def from_arrays(cls, sparse_features, records_data, row_stats,
+                    memory_budget=None):
+        """Recreate a search structure from its saved arrays. Nothing is
+        copied or recomputed so the arrays may be memory mapped.
+
+        Args:
+            sparse_features: A csr_matrix, see __init__.
+            records_data: A numpy array, see __init__.
+            row_stats: A dict with an array for each name in row_stats.
+            memory_budget: see __init__
+        """
+        search = cls.__new__(cls)
+        search.matrix = sparse_features
+        search.records_data = records_data
+        if memory_budget is not None:
+            search.memory_budget = memory_budget
+        for name in cls.row_stats:
+            setattr(search, name, row_stats[name])
+        return search
 
     def get_feature_matrix(self):
         return self.matrix
@@ -37,6 +266,210 @@ class MatrixMetricSearch(object):
     def get_records(self):
         return self.records_data
 
+    def _set_dtype(self, dtype):
+        """Store the feature values and the float row stats as dtype (e.g.
+        'float32' or 'float16') and the index arrays and integer row stats
+        as int32 where they fit. Searches compute in dtype, or float32 for
+        float16 which scipy can not multiply.
+
+        Args:
+            dtype: A numpy dtype or its name. None keeps the current dtypes.
+        """
+        if dtype is None:
+            return
+        dtype = np.dtype(dtype)
+        self.dtype = dtype.name
+        if scipy.sparse.issparse(self.matrix):
+            matrix = self.matrix
+            index_dtype = np.int32 if matrix.nnz < 2 ** 31 else np.int64
+            self.matrix = scipy.sparse.csr_matrix(
+                (matrix.data.astype(dtype, copy=False),
+                 matrix.indices.astype(index_dtype, copy=False),
+                 matrix.indptr.astype(index_dtype, copy=False)),
+                shape=matrix.shape, copy=False)
+        elif self.matrix.dtype.kind == 'f':
+            self.matrix = self.matrix.astype(dtype, copy=False)
+        for name in self.row_stats:
+            value = getattr(self, name)
+            if value is None:
+                # see get_row_stat
+                continue
+            if value.dtype.kind == 'f':
+                setattr(self, name, value.astype(dtype, copy=False))
+            elif value.dtype.kind in 'iu' and len(value) < 2 ** 31 and \
+                    (len(value) == 0 or np.abs(value).max() < 2 ** 31):
+                setattr(self, name, value.astype(np.int32, copy=False))
+
+    def _cast_queries(self, sparse_features):
+        """Queries in the dtype searches compute in, see _set_dtype."""
+        if self.dtype is None:
+            return sparse_features
+        dtype = np.dtype(self.dtype)
+        if dtype == np.float16:
+            dtype = np.dtype(np.float32)
+        if sparse_features.dtype == dtype:
+            return sparse_features
+        return scipy.sparse.csr_matrix(sparse_features, dtype=dtype)
+
+    @classmethod
+    def _prepare(cls, sparse_features):
+        """Records or queries as this distance compares them. Indexes call
+        this once on the records they are built from and once on the
+        queries of a search, not at every level; nearest_search calls it
+        unless the queries are already prepared. Defaults to no change.
+        """
+        return sparse_features
+
+    @classmethod
+    def _centroid_features(cls, sparse_features):
+        """Records as they are summed into centroids, see _centroids."""
+        return scipy.sparse.csr_matrix(sparse_features)
+
+    @classmethod
+    def _centroids(cls, sums, counts):
+        """Centroids (cluster representatives) for this distance.
+
+        Args:
+            sums: A csr_matrix with, for each cluster, the sum of the
+                _centroid_features of its records.
+            counts: Number of records in each cluster.
+        Returns:
+            A csr_matrix with the centroid of each cluster. Defaults to the
+            mean of the records.
+        """
+        return scipy.sparse.diags(1.0 / np.maximum(counts, 1)).dot(
+            sums).tocsr()
+
+    @classmethod
+    def _lower_bound(cls, distances, radii):
+        """Lower bound of the distance from a query to any record of a
+        cluster (see ClusterIndex.search radius_scale).
+
+        Args:
+            distances: Array of distances from queries to cluster leaders.
+            radii: Array of the same shape with the largest distance from
+                each leader to a record of its cluster.
+        Returns:
+            Array of lower bounds. For a metric the triangle inequality
+            gives distance - radius; otherwise there is no bound (-inf).
+        """
+        if cls.is_metric:
+            return distances - radii
+        return np.full(np.shape(distances), -np.inf)
+
+    def get_row_stat(self, name):
+        """The row stat name. Row orders dropped by append are recomputed.
+        """
+        value = getattr(self, name)
+        if value is None:
+            key = dict(self.row_orders)[name]
+            value = np.argsort(getattr(self, key), kind='mergesort')
+            setattr(self, name, value)
+        return value
+
+    def take(self, rows):
+        """A search structure over some of the records. The row stats are
+        gathered instead of recomputed.
+
+        Args:
+            rows: Integer array of record positions.
+        Returns:
+            A search structure of the same type whose record i is record
+            rows[i] of this one.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        orders = dict(self.row_orders)
+        row_stats = dict((name, getattr(self, name)[rows])
+                         for name in self.row_stats if name not in orders)
+        for order, key in self.row_orders:
+            row_stats[order] = np.argsort(row_stats[key], kind='mergesort')
+        if scipy.sparse.issparse(self.matrix):
+            matrix = csr_take(self.matrix, rows)
+        else:
+            matrix = self.matrix[rows]
+        search = self.from_arrays(matrix, self.records_data[rows],
+                                  row_stats, self.memory_budget)
+        search.dtype = self.dtype
+        if self.tombstones is not None:
+            search.tombstones = self.tombstones[rows]
+        return search
+
+    def delete(self, records_data):
+        """Mark the records equal to any of records_data as deleted. They
+        are not returned by searches but stay in the matrix until it is
+        rebuilt without them (see drop_deleted).
+
+        Args:
+            records_data: Records to delete.
+        """
+        deleted = np.isin(self.records_data, records_data)
+        if self.tombstones is not None:
+            deleted |= self.tombstones
+        if deleted.any():
+            self.tombstones = deleted
+
+    def drop_deleted(self):
+        """A search structure without the deleted records (or this one if
+        there are none)."""
+        if self.tombstones is None:
+            return self
+        search = self.take(np.flatnonzero(~self.tombstones))
+        search.tombstones = None
+        return search
+
+    def append(self, sparse_features, records_data):
+        """Add records after the existing ones. Only the row stats of the
+        new records are computed and the arrays grow geometrically so
+        appending is amortized O(new records).
+
+        Args:
+            sparse_features: A csr_matrix, see __init__.
+            records_data: see __init__
+        Returns:
+            The positions of the new records.
+        """
+        new = type(self)(sparse_features, records_data, self.memory_budget)
+        new._set_dtype(self.dtype)
+        if not hasattr(self, '_append_buffers'):
+            self._append_buffers = {}
+        buffers = self._append_buffers
+
+        first = self.matrix.shape[0]
+        num_records = first + new.matrix.shape[0]
+        if scipy.sparse.issparse(self.matrix):
+            nnz = self.matrix.indptr[-1]
+            data = _append_array(buffers, 'data', self.matrix.data,
+                                 new.matrix.data)
+            indices = _append_array(buffers, 'indices', self.matrix.indices,
+                                    new.matrix.indices)
+            indptr = _append_array(buffers, 'indptr', self.matrix.indptr,
+                                   new.matrix.indptr[1:] + nnz)
+            self.matrix = scipy.sparse.csr_matrix(
+                (data, indices, indptr),
+                shape=(num_records, max(self.matrix.shape[1],
+                                        new.matrix.shape[1])),
+                copy=False)
+        else:
+            self.matrix = _append_array(buffers, 'matrix', self.matrix,
+                                        new.matrix)
+        self.records_data = _append_array(buffers, 'records_data',
+                                          self.records_data,
+                                          new.records_data)
+        orders = dict(self.row_orders)
+        for name in self.row_stats:
+            if name in orders:
+                # see get_row_stat
+                setattr(self, name, None)
+            else:
+                setattr(self, name, _append_array(buffers, name,
+                                                  getattr(self, name),
+                                                  getattr(new, name)))
+        if self.tombstones is not None:
+            self.tombstones = _append_array(
+                buffers, 'tombstones', self.tombstones,
+                np.zeros(num_records - first, dtype=bool))
+        return np.arange(first, num_records)
+
     @abc.abstractmethod
     def _transform_value(self, val):
         """
@@ -60,7 +493,117 @@ class MatrixMetricSearch(object):
         """
         return
 
-    def nearest_search(self, sparse_features, k=1, max_distance=None):
+    def _query_stats(self, a_matrix):
+        """Per query values (e.g. norms) shared by every block of a search.
+
+        Args:
+            a_matrix: A csr_matrix with rows that represent records
+                to search against.
+        Returns:
+            Anything; it is passed through to _distance_block.
+        """
+        return None
+
+    def _distance_block(self, a_matrix, a_stats, start, stop):
+        """Distances between a_matrix and the records in [start, stop).
+
+        Subclasses should override this to avoid computing the distances to
+        every record.
+
+        Args:
+            a_matrix: A csr_matrix with rows that represent records
+                to search against.
+            a_stats: The result of _query_stats(a_matrix).
+            start: First record of the block.
+            stop: End (exclusive) of the block.
+        Returns:
+            A dense (queries x (stop - start)) array representing distance.
+        """
+        return self._distance(a_matrix)[:, start:stop]
+
+    def _block_size(self, num_queries):
+        """Number of records to score at once for num_queries queries."""
+        return max(1, int(self.memory_budget // (8 * max(num_queries, 1))))
+
+    def _blocks(self, num_queries, start, stop):
+        """Split the records in [start, stop) into (start, stop) ranges that
+        fit the memory budget."""
+        step = self._block_size(num_queries)
+        for block_start in range(start, stop, step):
+            yield block_start, min(block_start + step, stop)
+
+    def _block_nearest(self, a_matrix, a_stats, start, stop, k,
+                       max_distance, stats=None):
+        """Find the k closest records in [start, stop) for each query.
+
+        Args:
+            stats: A pysparnn.stats.SearchStats to add the distance time
+                to, or None.
+        Returns:
+            A tuple of (distances, indices) arrays. Indices are relative to
+            start.
+        """
+        with timer(stats, 'distance_time'):
+            distances = self._distance_block(a_matrix, a_stats, start, stop)
+        return top_k(distances, k, max_distance)
+
+    def _nearest(self, sparse_features, k, max_distance, start=0,
+                 stop=None, stats=None):
+        """Find the k closest records for each row of sparse_features.
+
+        Args:
+            sparse_features: see nearest_search
+            k: see nearest_search
+            max_distance: see nearest_search
+            start: Only search the records in [start, stop).
+            stop: Defaults to every record.
+            stats: see nearest_search
+        Returns:
+            A tuple of (distances, indices) arrays. See nearest_search.
+        """
+        if stop is None:
+            stop = self.matrix.shape[0]
+        if stats is not None:
+            start_time = timeit.default_timer()
+            distance_time = stats.distance_time
+        sparse_features = self._cast_queries(sparse_features)
+        num_queries = sparse_features.shape[0]
+        k = min(int(k), stop - start)
+        a_stats = self._query_stats(sparse_features)
+
+        # find enough records to still have k after dropping deleted ones
+        num_deleted = 0
+        if self.tombstones is not None:
+            num_deleted = np.count_nonzero(self.tombstones[start:stop])
+        search_k = min(k + num_deleted, stop - start)
+
+        distances = np.zeros((num_queries, 0))
+        indices = np.zeros((num_queries, 0), dtype=np.intp)
+        for block_start, block_stop in self._blocks(num_queries, start, stop):
+            block_distances, block_indices = self._block_nearest(
+                sparse_features, a_stats, block_start, block_stop, search_k,
+                max_distance, stats)
+            block_indices = np.where(block_indices >= 0,
+                                     block_indices + block_start, -1)
+            distances, indices = select_k(
+                np.hstack([distances, block_distances]),
+                np.hstack([indices, block_indices]), search_k)
+
+        if num_deleted > 0:
+            deleted = (indices >= 0) & \
+                    self.tombstones[np.maximum(indices, 0)]
+            distances, indices = select_k(np.where(deleted, np.inf, distances),
+                                          np.where(deleted, -1, indices), k)
+
+        if stats is not None:
+            # everything but the distances is selecting the top k
+            stats.top_k_time += timeit.default_timer() - start_time - \
+                    (stats.distance_time - distance_time)
+            stats.rows_scored += num_queries * (stop - start)
+        return distances, indices
+
+    def nearest_search(self, sparse_features, k=1, max_distance=None,
+                       return_arrays=False, stats=None, prepared=False):
         """Find the closest item(s) for each set of features in features_list.
 
         Args:
@@ -70,6 +613,16 @@ class MatrixMetricSearch(object):
             k: Return the k closest results.
             max_distance: Return items at most max_distance from the query
                 point.
+            return_arrays: Return (distances, indices) numpy arrays instead
+                of lists of tuples. Both arrays have one row per query and
+                min(k, num_records) columns sorted by distance. indices are
+                positions in records_data; missing results (fewer than k
+                records within max_distance) are padded with an index of -1
+                and a distance of inf.
+            stats: A pysparnn.stats.SearchStats to add the number of
+                distances computed and the time spent to, or None.
+            prepared: The queries already went through _prepare (e.g. the
+                indexes prepare them once at the top of a search).
 
         Returns:
             For each element in features_list, return the k-nearest items
@@ -77,38 +630,329 @@ class MatrixMetricSearch(object):
             [[(score1_1, item1_1), ..., (score1_k, item1_k)],
              [(score2_1, item2_1), ..., (score2_k, item2_k)], ...]
         """
+        if not prepared:
+            sparse_features = self._prepare(sparse_features)
+        distances, indices = self._nearest(sparse_features, k, max_distance,
+                                           stats=stats)
 
-        dist_matrix = self._distance(sparse_features)
+        if return_arrays:
+            return distances, indices
 
-        if max_distance is None:
-            max_distance = float("inf")
+        return _result_lists(distances, indices,
+                             self.records_data[np.maximum(indices, 0)])
 
-        dist_filter = (dist_matrix <= max_distance)
 
-        ret = []
-        for i in range(dist_matrix.shape[0]):
-            # these arrays are the length of the sqrt(index)
-            # replacing the for loop by matrix ops could speed things up
+class MatrixMetricSubset(object):
+    """Some of the records of a MatrixMetricSearch (the store).
 
-            index = dist_filter[i]
-            scores = dist_matrix[i][index]
-            records = self.records_data[index]
+    Only the positions of the records in the store are kept so several
+    search structures can share one copy of the data. A subset whose
+    records are a contiguous range of the store (see
+    ClusterIndex._order_store) is searched in place. Otherwise its
+    features, records and row stats are gathered from the store for every
+    search, see keep_gathered.
+    """
 
-            if scores.sum() < 0.0001 and len(scores) > 0:
-                # they are all practically the same
-                # we have to do this to prevent infinite recursion
-                # TODO: would love an alternative solution, this is a critical loop
-                arg_index = np.random.choice(len(scores), k, replace=False)
-            else:
-                arg_index = np.argsort(scores)[:k]
+    # keep the rows gathered by a search until the rows or the store
+    # change. This saves the copy at every search but costs a copy of the
+    # features of every leaf searched, so it is off by default
+    keep_gathered = False
+
+    def __init__(self, store, rows):
+        """
+        Args:
+            store: A MatrixMetricSearch.
+            rows: Integer array of positions in store.
+        """
+        self.store = store
+        self.rows = rows
+
+    @property
+    def store(self):
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        self._store = store
+        self._gathered = None
 
-            curr_ret = zip(scores[arg_index], records[arg_index])
+    @property
+    def rows(self):
+        return self._rows
 
-            ret.append(curr_ret)
+    @rows.setter
+    def rows(self, rows):
+        rows = np.asarray(rows, dtype=np.intp)
+        self._rows = rows
+        self._gathered = None
+        # first row of a subset that is a contiguous range of the store
+        self._start = None
+        if len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1 and \
+                (np.diff(rows) == 1).all():
+            self._start = int(rows[0])
 
+    def __getstate__(self):
+        # processes that get a copy gather their own rows
+        state = self.__dict__.copy()
+        state['_gathered'] = None
+        return state
+
+    @property
+    def memory_budget(self):
+        return self.store.memory_budget
+
+    @property
+    def records_data(self):
+        return self.store.records_data[self.rows]
+
+    def _search_structure(self, keep=False):
+        """A search structure over the rows of the subset. Reuses the
+        kept rows, with the current tombstones of the store.
+
+        Args:
+            keep: Keep the gathered rows if keep_gathered.
+        """
+        search = self._gathered
+        if search is None:
+            search = self.store.take(self.rows)
+            if keep and self.keep_gathered:
+                self._gathered = search
+        elif search.tombstones is not None or \
+                self.store.tombstones is not None:
+            # records deleted since the rows were gathered
+            tombstones = self.store.tombstones
+            search.tombstones = None if tombstones is None else \
+                    tombstones[self.rows]
+        return search
+
+    def get_feature_matrix(self):
+        return self._search_structure().get_feature_matrix()
+
+    def get_records(self):
+        return self.records_data
+
+    def drop_deleted(self):
+        """A search structure over the records of the subset that are not
+        deleted in the store."""
+        return self._search_structure().drop_deleted()
+
+    def nearest_search(self, sparse_features, k=1, max_distance=None,
+                       return_arrays=False, stats=None, prepared=False):
+        """See MatrixMetricSearch.nearest_search. Indices are positions in
+        the subset."""
+        if not prepared:
+            sparse_features = self.store._prepare(sparse_features)
+        if self._start is None or self._gathered is not None:
+            search, start = self._search_structure(keep=True), 0
+        else:
+            search, start = self.store, self._start
+        distances, indices = search._nearest(
+            sparse_features, k, max_distance, start, start + len(self.rows),
+            stats=stats)
+        if start > 0:
+            indices = np.where(indices >= 0, indices - start, -1)
+        if return_arrays:
+            return distances, indices
+        return _result_lists(
+            distances, indices,
+            self.store.records_data[self.rows[np.maximum(indices, 0)]])
+
+class SparseMatrixMetricSearch(MatrixMetricSearch):
+    """A metric where the distance between a query and a record that share
+    no features only depends on per row values (e.g. norms) and ranks the
+    records the same way for every query. For cosine distance it is simply
+    1.0.
+
+    Distances are only computed for the (query, record) pairs in the sparse
+    product of the two matrices. The dense queries x records distance
+    matrix is never built; the k best results are selected from the sparse
+    entries plus, where needed, the best non-overlapping records.
+    """
+
+    # distance between a query and a record with no overlapping features
+    implicit_distance = 1.0
+
+    @abc.abstractmethod
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Distances for pairs of queries and records that share features.
+
+        Args:
+            a_matrix: A csr_matrix with rows that represent records
+                to search against.
+            a_stats: The result of _query_stats(a_matrix).
+            start: First record of the block.
+            stop: End (exclusive) of the block.
+        Returns:
+            A tuple of (rows, cols, distances) arrays. cols are relative
+            to start. Pairs that are not listed are implicit distance apart.
+        """
+        return
+
+    def _implicit_distance(self, a_stats, rows, cols):
+        """Distances for pairs of queries and records that share no features.
+
+        Args:
+            a_stats: The result of _query_stats(a_matrix).
+            rows: Query of each pair.
+            cols: Record of each pair.
+        Returns:
+            An array of distances.
+        """
+        return np.full(len(rows), self.implicit_distance)
+
+    def _implicit_order(self, start, stop):
+        """Records in [start, stop) (relative to start) sorted by increasing
+        implicit distance."""
+        return np.arange(stop - start)
+
+    def _block(self, start, stop):
+        """Rows [start, stop) of the feature matrix."""
+        if start == 0 and stop == self.matrix.shape[0]:
+            return self.matrix
+        return csr_rows(self.matrix, start, stop)
+
+    def _distance_block(self, a_matrix, a_stats, start, stop):
+        rows, cols = np.indices((a_matrix.shape[0], stop - start))
+        ret = self._implicit_distance(a_stats, rows.reshape(-1),
+                                      start + cols.reshape(-1))
+        ret = ret.reshape(rows.shape)
+        rows, cols, distances = self._overlap_distance(a_matrix, a_stats,
+                                                       start, stop)
+        ret[rows, cols] = distances
         return ret
 
-class CosineDistance(MatrixMetricSearch):
+    def _distance(self, a_matrix):
+        return self._distance_block(a_matrix, self._query_stats(a_matrix),
+                                    0, self.matrix.shape[0])
+
+    def _block_nearest(self, a_matrix, a_stats, start, stop, k,
+                       max_distance, stats=None):
+        num_queries = a_matrix.shape[0]
+        k = min(k, stop - start)
+        with timer(stats, 'distance_time'):
+            rows, cols, distances = self._overlap_distance(a_matrix, a_stats,
+                                                           start, stop)
+
+        if max_distance is None:
+            keep = ~np.isnan(distances)
+        else:
+            with np.errstate(invalid='ignore'):
+                keep = distances <= max_distance
+        ret_rows, ret_cols = rows[keep], cols[keep]
+        ret_distances = distances[keep]
+
+        if k > 0:
+            # queries with fewer than k overlapping records closer than the
+            # best non-overlapping record are topped up with the best
+            # non-overlapping records
+            order = self._implicit_order(start, stop)
+            queries = np.arange(num_queries)
+            nearest_implicit = self._implicit_distance(
+                a_stats, queries, np.full(num_queries, start + order[0]))
+            better = np.bincount(
+                ret_rows[ret_distances < nearest_implicit[ret_rows]],
+                minlength=num_queries)
+            needy = better < k
+            if max_distance is not None:
+                needy &= nearest_implicit <= max_distance
+            needy = np.flatnonzero(needy)
+
+            if len(needy) > 0:
+                fill_rows, fill_cols = self._implicit_records(
+                    rows, cols, order, needy, num_queries, k)
+                fill_distances = self._implicit_distance(a_stats, fill_rows,
+                                                         start + fill_cols)
+                if max_distance is not None:
+                    fill = fill_distances <= max_distance
+                    fill_rows, fill_cols = fill_rows[fill], fill_cols[fill]
+                    fill_distances = fill_distances[fill]
+                ret_rows = np.concatenate([ret_rows, fill_rows])
+                ret_cols = np.concatenate([ret_cols, fill_cols])
+                ret_distances = np.concatenate([ret_distances,
+                                                fill_distances])
+
+        return sparse_top_k(ret_rows, ret_cols, ret_distances, num_queries, k)
+
+    @staticmethod
+    def _implicit_records(rows, cols, order, needy, num_queries, k):
+        """Find the k best records per needy query that do not overlap it.
+
+        Args:
+            rows: Row (query) of each overlapping pair.
+            cols: Column (record) of each overlapping pair.
+            order: Records sorted by increasing implicit distance.
+            needy: Queries that need to be topped up.
+            num_queries: Number of queries.
+            k: Number of records to find per query.
+        Returns:
+            A tuple of (rows, cols) arrays.
+        """
+        is_needy = np.zeros(num_queries, dtype=bool)
+        is_needy[needy] = True
+        position = np.zeros(num_queries, dtype=np.intp)
+        position[needy] = np.arange(len(needy))
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[order] = np.arange(len(order))
+
+        # the first k + nnz records always contain k free records
+        overlaps = np.bincount(rows, minlength=num_queries)
+        width = min(len(order), k + overlaps[needy].max())
+        taken = np.zeros((len(needy), width), dtype=bool)
+        ranks = rank[cols]
+        sel = is_needy[rows] & (ranks < width)
+        taken[position[rows[sel]], ranks[sel]] = True
+
+        free = ~taken
+        free &= np.cumsum(free, axis=1) <= k
+        fill_rows, fill_ranks = np.nonzero(free)
+        return needy[fill_rows], order[fill_ranks]
+
+
+def _binarize(matrix):
+    """Copy of a csr_matrix with every nonzero value set to 1."""
+    matrix = scipy.sparse.csr_matrix(matrix, copy=True)
+    matrix.eliminate_zeros()
+    matrix.data = np.ones(len(matrix.data), dtype=np.int32)
+    return matrix
+
+
+def _binary_centroids(sums, counts):
+    """Binary centroids: the features set in at least half of the records
+    of a cluster. A cluster keeps its most common feature when none is.
+
+    Args:
+        sums: see MatrixMetricSearch._centroids
+        counts: see MatrixMetricSearch._centroids
+    """
+    sums = scipy.sparse.csr_matrix(sums)
+    sums.eliminate_zeros()
+    rows = np.repeat(np.arange(sums.shape[0]), np.diff(sums.indptr))
+    keep = sums.data >= 0.5 * counts[rows]
+
+    most_common = np.zeros(sums.shape[0])
+    np.maximum.at(most_common, rows, sums.data)
+    keep |= sums.data == most_common[rows]
+
+    return scipy.sparse.csr_matrix(
+        (np.ones(np.count_nonzero(keep), dtype=np.int32),
+         (rows[keep], sums.indices[keep])), shape=sums.shape)
+
+
+def _block_order(keys, order, start, stop):
+    """Records in [start, stop) sorted by keys, relative to start.
+
+    Args:
+        keys: Sort key of every record.
+        order: np.argsort(keys, kind='mergesort'), used for the full range.
+        start: First record.
+        stop: End (exclusive).
+    """
+    if start == 0 and stop == len(order):
+        return order
+    return np.argsort(keys[start:stop], kind='mergesort')
+
+
+class CosineDistance(SparseMatrixMetricSearch):
     """A matrix that implements cosine distance search against it.
 
     cosine_distance = 1 - cosine_similarity
@@ -118,34 +962,91 @@ class CosineDistance(MatrixMetricSearch):
     and distance metrics can be treated the same way.
     """
 
-    def __init__(self, sparse_features, records_data):
-        super(CosineDistance, self).__init__(sparse_features, records_data)
+    row_stats = ('matrix_root_sum_square',)
 
-        m_c = self.matrix.copy()
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        super(CosineDistance, self).__init__(sparse_features, records_data,
+                                             memory_budget)
+        self.matrix_root_sum_square = self._root_sum_square(self.matrix)
+
+    @staticmethod
+    def _root_sum_square(matrix):
+        """L2 norm of each row of matrix"""
+        m_c = matrix.copy()
         m_c.data **= 2
-        self.matrix_root_sum_square = \
-                np.sqrt(np.asarray(m_c.sum(axis=1)).reshape(-1))
+        return np.sqrt(np.asarray(m_c.sum(axis=1)).reshape(-1))
 
     def _transform_value(self, v):
         return v
 
-    def _distance(self, a_matrix):
+    @classmethod
+    def _centroid_features(cls, sparse_features):
+        """Records scaled to unit length."""
+        sparse_features = scipy.sparse.csr_matrix(sparse_features,
+                                                  dtype=float)
+        norms = cls._root_sum_square(sparse_features)
+        return scipy.sparse.diags(1.0 / np.where(norms > 0, norms, 1)).dot(
+            sparse_features).tocsr()
+
+    @classmethod
+    def _centroids(cls, sums, counts):
+        """Mean directions of the clusters (spherical k-means); the sums
+        scaled to unit length."""
+        return cls._centroid_features(sums)
+
+    @classmethod
+    def _lower_bound(cls, distances, radii):
+        """Cosine distance is not a metric but the angle between two
+        records is: the angle to any record of a cluster is at least the
+        angle to its leader minus the angle of its radius."""
+        angles = np.arccos(np.clip(1 - distances, -1, 1))
+        radii = np.arccos(np.clip(1 - radii, -1, 1))
+        return 1 - np.cos(np.maximum(angles - radii, 0))
+
+    def _query_stats(self, a_matrix):
+        return self._root_sum_square(a_matrix)
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
         """Vectorised cosine distance"""
-        # what is the implmentation of transpose? can i change the order?
-        dprod = self.matrix.dot(a_matrix.transpose()).transpose() * 1.0
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+
+        magnitude = a_stats[dprod.row] * \
+                self.matrix_root_sum_square[start + dprod.col]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = 1 - dprod.data / magnitude
 
-        a_c = a_matrix.copy()
-        a_c.data **= 2
-        a_root_sum_square = np.asarray(a_c.sum(axis=1)).reshape(-1)
-        a_root_sum_square = \
-                a_root_sum_square.reshape(len(a_root_sum_square), 1)
-        a_root_sum_square = np.sqrt(a_root_sum_square)
+        return dprod.row, dprod.col, distances
 
-        magnitude = 1.0 / (a_root_sum_square * self.matrix_root_sum_square)
+class NormalizedCosineDistance(CosineDistance):
+    """Cosine distance over records scaled to unit length.
 
-        return 1 - dprod.multiply(magnitude).toarray()
+    The records are normalized once, when they are added, and no norms are
+    kept. nearest_search normalizes the queries too; the indexes do it once
+    at the top of a search (see _prepare) so every level of the tree only
+    computes a sparse product of the queries and the records, without
+    copying the queries or computing their norms.
+    """
+
+    row_stats = ()
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        MatrixMetricSearch.__init__(self, self._prepare(sparse_features),
+                                    records_data, memory_budget)
+
+    @classmethod
+    def _prepare(cls, sparse_features):
+        """Rows scaled to unit length."""
+        return cls._centroid_features(sparse_features)
+
+    def _query_stats(self, a_matrix):
+        return None
 
-class UnitCosineDistance(MatrixMetricSearch):
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised cosine distance of unit vectors"""
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+        return dprod.row, dprod.col, 1 - dprod.data
+
+class UnitCosineDistance(CosineDistance):
     """A matrix that implements cosine distance search against it.
 
     cosine_distance = 1 - cosine_similarity
@@ -159,43 +1060,459 @@ class UnitCosineDistance(MatrixMetricSearch):
       * 1**2 == 1 so that operation can be skipped
     """
 
-    def __init__(self, sparse_features, records_data):
-        super(UnitCosineDistance, self).__init__(sparse_features, records_data)
-        self.matrix_root_sum_square = \
-                np.sqrt(np.asarray(self.matrix.sum(axis=1)).reshape(-1))
+    @staticmethod
+    def _root_sum_square(matrix):
+        """L2 norm of each row of a binary matrix"""
+        return np.sqrt(np.asarray(matrix.sum(axis=1)).reshape(-1))
 
     def _transform_value(self, v):
         return 1
 
-    def _distance(self, a_matrix):
-        """Vectorised cosine distance"""
-        # what is the implmentation of transpose? can i change the order?
-        dprod = self.matrix.dot(a_matrix.transpose()).transpose() * 1.0
+    @classmethod
+    def _centroid_features(cls, sparse_features):
+        return _binarize(sparse_features)
 
-        a_root_sum_square = np.asarray(a_matrix.sum(axis=1)).reshape(-1)
-        a_root_sum_square = \
-                a_root_sum_square.reshape(len(a_root_sum_square), 1)
-        a_root_sum_square = np.sqrt(a_root_sum_square)
+    @classmethod
+    def _centroids(cls, sums, counts):
+        return _binary_centroids(sums, counts)
+
+class EuclideanDistance(SparseMatrixMetricSearch):
+    """A matrix that implements euclidean distance search against it.
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so only the squared row
+    norms and the sparse product of the two matrices are needed. Records
+    that share no features with a query are sqrt(||a||^2 + ||b||^2) away so
+    the best of them are the records with the smallest norms.
+    """
+
+    row_stats = ('matrix_sum_square', 'matrix_norm_order')
+    row_orders = (('matrix_norm_order', 'matrix_sum_square'),)
+    is_metric = True
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        super(EuclideanDistance, self).__init__(sparse_features,
+                                                records_data, memory_budget)
+        self.matrix_sum_square = self._sum_square(self.matrix)
+        self.matrix_norm_order = np.argsort(self.matrix_sum_square,
+                                            kind='mergesort')
+
+    @staticmethod
+    def _sum_square(matrix):
+        """Squared L2 norm of each row of matrix"""
+        m_c = matrix.copy()
+        m_c.data **= 2
+        return np.asarray(m_c.sum(axis=1)).reshape(-1)
+
+    def _transform_value(self, v):
+        return v
+
+    def _query_stats(self, a_matrix):
+        return self._sum_square(a_matrix)
+
+    def _implicit_distance(self, a_stats, rows, cols):
+        return np.sqrt(a_stats[rows] + self.matrix_sum_square[cols])
+
+    def _implicit_order(self, start, stop):
+        return _block_order(self.matrix_sum_square,
+                            self.get_row_stat('matrix_norm_order'),
+                            start, stop)
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised euclidean distance"""
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+
+        distances = a_stats[dprod.row] + \
+                self.matrix_sum_square[start + dprod.col] - 2 * dprod.data
+        # rounding can push the distance between equal vectors below zero
+        distances = np.sqrt(np.maximum(distances, 0))
+
+        return dprod.row, dprod.col, distances
+
+class JaccardDistance(SparseMatrixMetricSearch):
+    """A matrix that implements jaccard distance search against it.
+
+    jaccard_distance = 1 - |a intersect b| / |a union b|
+
+    Features are treated as binary (any nonzero value is 1). The feature
+    matrix is stored binarized.
+    """
+
+    row_stats = ('matrix_nnz',)
+    is_metric = True
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        super(JaccardDistance, self).__init__(_binarize(sparse_features),
+                                              records_data, memory_budget)
+        self.matrix_nnz = np.diff(self.matrix.indptr)
+
+    def _transform_value(self, v):
+        return 1
+
+    @classmethod
+    def _centroid_features(cls, sparse_features):
+        return _binarize(sparse_features)
+
+    @classmethod
+    def _centroids(cls, sums, counts):
+        return _binary_centroids(sums, counts)
+
+    def _query_stats(self, a_matrix):
+        a_matrix = _binarize(a_matrix)
+        return a_matrix, np.diff(a_matrix.indptr)
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised jaccard distance"""
+        a_matrix, a_nnz = a_stats
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+
+        union = a_nnz[dprod.row] + self.matrix_nnz[start + dprod.col] - \
+                dprod.data
+        distances = 1 - dprod.data / union
+
+        return dprod.row, dprod.col, distances
+
+class HammingDistance(SparseMatrixMetricSearch):
+    """A matrix that implements (binary) hamming distance search against it.
+
+    hamming_distance = |a| + |b| - 2 * |a intersect b|
+
+    i.e. the number of features set in exactly one of a and b. Features are
+    treated as binary (any nonzero value is 1). The feature matrix is
+    stored binarized.
+    """
+
+    row_stats = ('matrix_nnz', 'matrix_nnz_order')
+    row_orders = (('matrix_nnz_order', 'matrix_nnz'),)
+    is_metric = True
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        super(HammingDistance, self).__init__(_binarize(sparse_features),
+                                              records_data, memory_budget)
+        self.matrix_nnz = np.diff(self.matrix.indptr)
+        self.matrix_nnz_order = np.argsort(self.matrix_nnz, kind='mergesort')
+
+    def _transform_value(self, v):
+        return 1
 
-        magnitude = 1.0 / (a_root_sum_square * self.matrix_root_sum_square)
+    @classmethod
+    def _centroid_features(cls, sparse_features):
+        return _binarize(sparse_features)
 
-        return 1 - dprod.multiply(magnitude).toarray()
+    @classmethod
+    def _centroids(cls, sums, counts):
+        return _binary_centroids(sums, counts)
+
+    def _query_stats(self, a_matrix):
+        a_matrix = _binarize(a_matrix)
+        return a_matrix, np.diff(a_matrix.indptr)
+
+    def _implicit_distance(self, a_stats, rows, cols):
+        _, a_nnz = a_stats
+        return (a_nnz[rows] + self.matrix_nnz[cols]).astype(float)
+
+    def _implicit_order(self, start, stop):
+        return _block_order(self.matrix_nnz,
+                            self.get_row_stat('matrix_nnz_order'),
+                            start, stop)
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised hamming distance"""
+        a_matrix, a_nnz = a_stats
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+
+        distances = a_nnz[dprod.row] + self.matrix_nnz[start + dprod.col] - \
+                2.0 * dprod.data
+
+        return dprod.row, dprod.col, distances
+
+class ManhattanDistance(SparseMatrixMetricSearch):
+    """A matrix that implements manhattan (L1) distance search against it.
+
+    Uses |a - b|_1 = |a|_1 + |b|_1 - sum_i(|a_i| + |b_i| - |a_i - b_i|)
+    where the sum only runs over the features that a and b share. Records
+    that share no features with a query are |a|_1 + |b|_1 away.
+    """
+
+    row_stats = ('matrix_l1', 'matrix_l1_order')
+    row_orders = (('matrix_l1_order', 'matrix_l1'),)
+    is_metric = True
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        super(ManhattanDistance, self).__init__(sparse_features,
+                                                records_data, memory_budget)
+        self.matrix_l1 = self._l1_norm(self.matrix)
+        self.matrix_l1_order = np.argsort(self.matrix_l1, kind='mergesort')
+
+    @staticmethod
+    def _l1_norm(matrix):
+        """L1 norm of each row of matrix"""
+        return np.asarray(abs(matrix).sum(axis=1)).reshape(-1)
+
+    def _transform_value(self, v):
+        return v
+
+    def _query_stats(self, a_matrix):
+        return self._l1_norm(a_matrix), a_matrix.tocsc()
+
+    def _implicit_distance(self, a_stats, rows, cols):
+        a_l1, _ = a_stats
+        return a_l1[rows] + self.matrix_l1[cols]
+
+    def _implicit_order(self, start, stop):
+        return _block_order(self.matrix_l1,
+                            self.get_row_stat('matrix_l1_order'),
+                            start, stop)
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised manhattan distance"""
+        a_l1, a_csc = a_stats
+        b_coo = self._block(start, stop).tocoo()
+
+        # pair every nonzero of the records with every query that has the
+        # same feature set
+        counts = np.diff(a_csc.indptr)[b_coo.col]
+        total = counts.sum()
+        firsts = np.cumsum(counts) - counts
+        positions = np.repeat(a_csc.indptr[b_coo.col] - firsts, counts) + \
+                np.arange(total)
+        a_vals = a_csc.data[positions]
+        b_vals = np.repeat(b_coo.data, counts)
+
+        overlap = abs(a_vals) + abs(b_vals) - abs(a_vals - b_vals)
+        overlap = scipy.sparse.coo_matrix(
+            (overlap, (a_csc.indices[positions], np.repeat(b_coo.row, counts))),
+            shape=(a_matrix.shape[0], stop - start)).tocsr().tocoo()
+
+        distances = a_l1[overlap.row] + \
+                self.matrix_l1[start + overlap.col] - overlap.data
+
+        return overlap.row, overlap.col, distances
+
+class InnerProductDistance(SparseMatrixMetricSearch):
+    """A matrix that implements maximum inner product search against it.
+
+    inner_product_distance = -(a . b)
+
+    Note: The inner product is negated so that records with a larger inner
+    product are closer to the query. Records that share no features with the
+    query are 0 away.
+    """
+
+    implicit_distance = 0.0
+
+    def _transform_value(self, v):
+        return v
+
+    def _overlap_distance(self, a_matrix, a_stats, start, stop):
+        """Vectorised inner product"""
+        dprod = a_matrix.dot(self._block(start, stop).transpose()).tocoo()
+
+        return dprod.row, dprod.col, -1.0 * dprod.data
 
 class SlowEuclideanDistance(MatrixMetricSearch):
     """A matrix that implements euclidean distance search against it.
-    WARNING: This is not optimized.
+    WARNING: This is not optimized. Densifies the feature matrix; see
+    EuclideanDistance.
     """
 
-    def __init__(self, sparse_features, records_data):
+    is_metric = True
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
         super(SlowEuclideanDistance, self).__init__(sparse_features,
-                                                    records_data)
+                                                    records_data,
+                                                    memory_budget)
         self.matrix = self.matrix.toarray()
 
     def _transform_value(self, v):
         return v
 
+    @classmethod
+    def from_arrays(cls, sparse_features, records_data, row_stats,
+                    memory_budget=None):
+        search = super(SlowEuclideanDistance, cls).from_arrays(
+            sparse_features, records_data, row_stats, memory_budget)
+        search.matrix = scipy.sparse.csr_matrix(search.matrix).toarray()
+        return search
+
+    def get_feature_matrix(self):
+        return scipy.sparse.csr_matrix(self.matrix)
+
+    def _query_stats(self, a_matrix):
+        return a_matrix.toarray()
+
+    def _distance_block(self, a_matrix, a_stats, start, stop):
+        return scipy.spatial.distance.cdist(a_stats, self.matrix[start:stop],
+                                            'euclidean')
+
     def _distance(self, a_matrix):
         """Euclidean distance"""
 
         return scipy.spatial.distance.cdist(a_matrix.toarray(), self.matrix,
                                             'euclidean')
+
+# number of bits set in every byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class PackedBinarySearch(MatrixMetricSearch):
+    """Stores binary features as packed bitsets (8 features per byte)
+    instead of a csr_matrix and scores records with popcounts of the
+    intersections; see the subclasses for the distances.
+
+    A packed row takes ceil(num_features / 8) bytes whatever its number of
+    features while a binary csr row takes 8 bytes (index and value) per
+    feature, so packing is only smaller when more than 1 in 64 features
+    are set. A warning is issued when the packed rows are larger. The
+    intersections of a block of records with every query are dense so
+    searching sparser features is slower too.
+    """
+
+    row_stats = ('matrix_nnz',)
+    # number of records packed at once, see _pack
+    pack_block_rows = 4096
+
+    def __init__(self, sparse_features, records_data, memory_budget=None):
+        # the csr classes the subclasses derive from only differ in how
+        # they score the records
+        MatrixMetricSearch.__init__(self, _binarize(sparse_features),
+                                    records_data, memory_budget)
+        self.num_features = self.matrix.shape[1]
+        self.matrix_nnz = np.diff(self.matrix.indptr).astype(np.int32)
+        packed_row_bytes = (self.num_features + 7) // 8
+        csr_row_bytes = 8.0 * self.matrix.nnz / max(self.matrix.shape[0], 1)
+        if self.matrix.shape[0] and packed_row_bytes > csr_row_bytes:
+            warnings.warn(
+                'Packed rows take {} bytes, more than the {:.0f} bytes of a '
+                'csr row; with fewer than 1 in 64 features set the csr '
+                'distances (e.g. JaccardDistance) are smaller'.format(
+                    packed_row_bytes, csr_row_bytes))
+        self.matrix = self._pack(self.matrix, self.num_features)
+
+    @classmethod
+    def _pack(cls, sparse_features, num_features):
+        """A (records x bytes) uint8 array of the binarized features. The
+        bits are set from the csr arrays a block of records at a time so no
+        dense (records x features) array is built."""
+        sparse_features = scipy.sparse.csr_matrix(sparse_features)
+        num_records = sparse_features.shape[0]
+        packed = np.zeros((num_records, (num_features + 7) // 8),
+                          dtype=np.uint8)
+        indptr = sparse_features.indptr
+        for start in range(0, num_records, cls.pack_block_rows):
+            stop = min(start + cls.pack_block_rows, num_records)
+            cols = sparse_features.indices[indptr[start]:indptr[stop]]
+            rows = np.repeat(np.arange(start, stop),
+                             np.diff(indptr[start:stop + 1]))
+            keep = cols < num_features
+            rows, cols = rows[keep], cols[keep]
+            np.bitwise_or.at(packed, (rows, cols // 8),
+                             (0x80 >> (cols % 8)).astype(np.uint8))
+        return packed
+
+    @classmethod
+    def from_arrays(cls, sparse_features, records_data, row_stats,
+                    memory_budget=None):
+        search = super(PackedBinarySearch, cls).from_arrays(
+            sparse_features, records_data, row_stats, memory_budget)
+        if scipy.sparse.issparse(sparse_features):
+            search.num_features = sparse_features.shape[1]
+            search.matrix = cls._pack(sparse_features, search.num_features)
+        else:
+            # already packed, see take
+            search.num_features = 8 * sparse_features.shape[1]
+        return search
+
+    def take(self, rows):
+        search = super(PackedBinarySearch, self).take(rows)
+        search.num_features = self.num_features
+        return search
+
+    def get_feature_matrix(self):
+        # only the nonzero bytes are unpacked
+        rows, byte_cols = np.nonzero(self.matrix)
+        bits = np.unpackbits(self.matrix[rows, byte_cols][:, np.newaxis],
+                             axis=1)
+        set_bytes, set_bits = np.nonzero(bits)
+        cols = 8 * byte_cols[set_bytes] + set_bits
+        num_records = self.matrix.shape[0]
+        indptr = np.zeros(num_records + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[set_bytes], minlength=num_records),
+                  out=indptr[1:])
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(cols), dtype=np.int32), cols, indptr),
+            shape=(num_records, self.num_features))
+
+    def _set_dtype(self, dtype):
+        """The features are always bits."""
+
+    def _transform_value(self, v):
+        return 1
+
+    def _query_stats(self, a_matrix):
+        a_matrix = _binarize(a_matrix)
+        return (self._pack(a_matrix, self.num_features),
+                np.diff(a_matrix.indptr))
+
+    def _block_size(self, num_queries):
+        # the intersections take a byte per query, record and packed byte
+        width = max(self.matrix.shape[1], 1)
+        return max(1, int(self.memory_budget //
+                          (2 * width * max(num_queries, 1))))
+
+    def _intersections(self, a_packed, start, stop):
+        """Number of features every query shares with the records in
+        [start, stop)."""
+        both = a_packed[:, np.newaxis, :] & \
+                self.matrix[np.newaxis, start:stop, :]
+        return _POPCOUNT[both].sum(axis=2, dtype=np.int32)
+
+    @abc.abstractmethod
+    def _bitset_distance(self, intersections, a_nnz, b_nnz):
+        """
+        Args:
+            intersections: A (queries x records) array of the number of
+                shared features.
+            a_nnz: Number of features of each query (column vector).
+            b_nnz: Number of features of each record (row vector).
+        Returns:
+            A (queries x records) array of distances.
+        """
+        return
+
+    def _distance_block(self, a_matrix, a_stats, start, stop):
+        a_packed, a_nnz = a_stats
+        intersections = self._intersections(a_packed, start, stop)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = self._bitset_distance(
+                intersections, a_nnz[:, np.newaxis],
+                self.matrix_nnz[np.newaxis, start:stop])
+        # records that share no features are 1 away, as in the csr classes
+        return np.where(intersections > 0, distances, 1.0)
+
+    def _distance(self, a_matrix):
+        return self._distance_block(a_matrix, self._query_stats(a_matrix),
+                                    0, self.matrix.shape[0])
+
+    def _block_nearest(self, a_matrix, a_stats, start, stop, k,
+                       max_distance, stats=None):
+        with timer(stats, 'distance_time'):
+            distances = self._distance_block(a_matrix, a_stats, start, stop)
+        return top_k(distances, k, max_distance)
+
+
+class PackedJaccardDistance(PackedBinarySearch, JaccardDistance):
+    """JaccardDistance over packed bitsets, see PackedBinarySearch."""
+
+    row_stats = ('matrix_nnz',)
+
+    def _bitset_distance(self, intersections, a_nnz, b_nnz):
+        return 1 - intersections / (a_nnz + b_nnz - intersections)
+
+
+class PackedUnitCosineDistance(PackedBinarySearch, UnitCosineDistance):
+    """UnitCosineDistance over packed bitsets, see PackedBinarySearch."""
+
+    row_stats = ('matrix_nnz',)
+
+    def _bitset_distance(self, intersections, a_nnz, b_nnz):
+        return 1 - intersections / np.sqrt(a_nnz * b_nnz.astype(float))
@@ -0,0 +1,79 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Helpers to build and search indexes with a pool of workers"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import contextlib
+import multiprocessing
+import multiprocessing.pool
+
+
+class SerialExecutor(object):
+    """Runs tasks one after another in the calling thread."""
+
+    def map(self, func, iterable):
+        """Same as the builtin map but always returns a list."""
+        return [func(item) for item in iterable]
+
+
+def num_workers(n_jobs):
+    """Number of workers to use for n_jobs.
+
+    Args:
+        n_jobs: Number of workers. None means 1 (no pool). Negative values
+            count back from the number of cpus; -1 uses every cpu.
+    """
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+@contextlib.contextmanager
+def get_executor(n_jobs=None, backend='process', executor=None,
+                 initializer=None, initargs=()):
+    """Context manager that yields an object with a map(func, iterable)
+    method.
+
+    Args:
+        n_jobs: Number of workers, see num_workers.
+        backend: 'process' for a multiprocessing.Pool or 'thread' for a
+            multiprocessing.pool.ThreadPool.
+        executor: An existing pool (anything with a map method) to use
+            instead of creating one. It is not shut down on exit.
+        initializer: Called with initargs once in every worker of a
+            process pool created here. Forked workers inherit initargs;
+            under the spawn and forkserver start methods they are pickled
+            once per worker instead of once per task.
+        initargs: See initializer.
+    """
+    if executor is not None:
+        yield executor
+        return
+
+    workers = num_workers(n_jobs)
+    if workers == 1:
+        yield SerialExecutor()
+        return
+
+    if backend == 'process':
+        pool = multiprocessing.Pool(workers, initializer, initargs)
+    elif backend == 'thread':
+        pool = multiprocessing.pool.ThreadPool(workers)
+    else:
+        raise ValueError('Unknown backend: {}'.format(backend))
+
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,296 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Search one saved index from a pool of worker processes.
+
+Every worker loads the index saved with save (see pysparnn.storage) memory
+mapped, so the feature matrices, norms and records are one read-only copy
+in the page cache that all of the workers share. Forking a process that
+already holds the index would instead slowly copy its pages as the
+workers touch them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import timeit
+import pysparnn.cluster_pruning
+import pysparnn.matrix_distance
+import pysparnn.parallel
+import pysparnn.storage
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+def _load(path):
+    """Load a saved ClusterIndex or MultiClusterIndex memory mapped."""
+    with open(os.path.join(path, pysparnn.storage.METADATA_FILE)) as f:
+        kind = json.load(f)['kind']
+    return getattr(pysparnn.cluster_pruning, kind).load(path, mmap=True)
+
+
+def _worker(path, tasks, results):
+    """Search the batches of tasks until a None task.
+
+    Args:
+        path: Directory the index was saved to.
+        tasks: Queue of (batch id, csr_matrix, search kwargs) tuples.
+        results: Queue of (batch id, results or exception) tuples. The
+            first result has no batch id and tells if the index loaded.
+    """
+    # the leaves search the shared pages instead of keeping private
+    # copies of their rows
+    pysparnn.matrix_distance.MatrixMetricSubset.keep_gathered = False
+    try:
+        index = _load(path)
+    except Exception as e:  # pylint: disable=broad-except
+        results.put((None, e))
+        return
+    results.put((None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batch_id, sparse_features, kwargs = task
+        try:
+            ret = index.search(sparse_features, **kwargs)
+        except Exception as e:  # pylint: disable=broad-except
+            ret = e
+        results.put((batch_id, ret))
+
+
+class WorkerPool(object):
+    """Worker processes that search a shared, read-only index.
+
+    Batches of queries are sent to the workers over a multiprocessing
+    queue and their results are gathered back in order. search can be
+    called from several threads at once. If a worker exits (e.g. it is
+    killed) the batches it may have taken are lost, so every pending
+    search fails and the pool can only be closed.
+
+    Usage:
+        index.save('/path/to/index')
+        with WorkerPool('/path/to/index', num_workers=8) as pool:
+            pool.search(features, k=5)
+    """
+
+    # seconds between checks that the workers are still running
+    poll_interval = 1.0
+
+    def __init__(self, path, num_workers=None, batch_size=100, timeout=None):
+        """Start the workers. Returns once every worker loaded the index.
+
+        Args:
+            path: Directory the index was saved to, see ClusterIndex.save
+                and MultiClusterIndex.save.
+            num_workers: Number of worker processes, see
+                pysparnn.parallel.num_workers. Defaults to every cpu.
+            batch_size: Most queries sent to a worker at once.
+            timeout: Most seconds a search waits for its results, see
+                search. Defaults to no limit.
+        Raises:
+            RuntimeError: A worker exited before it loaded the index.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._batch_ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._temp_dir = None
+        # the error every search fails with once a worker exited
+        self._error = None
+        self._closing = False
+
+        self._workers = [
+            multiprocessing.Process(target=_worker,
+                                    args=(path, self._tasks, self._results))
+            for _ in range(pysparnn.parallel.num_workers(
+                -1 if num_workers is None else num_workers))]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        num_loaded = 0
+        try:
+            while num_loaded < len(self._workers):
+                try:
+                    _, error = self._results.get(timeout=self.poll_interval)
+                except Empty:
+                    error = self._exited_error()
+                if error is not None:
+                    raise error
+                num_loaded += 1
+        except BaseException:
+            for worker in self._workers:
+                worker.terminate()
+            raise
+
+        self._reader = threading.Thread(target=self._read_results)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @classmethod
+    def from_index(cls, index, num_workers=None, batch_size=100,
+                   timeout=None):
+        """Save an index to a temporary directory, removed by close, and
+        start workers that search it. Saving flushes the inserted records
+        of the index and compacts it, see ClusterIndex.save.
+
+        Args:
+            index: A ClusterIndex or MultiClusterIndex.
+            num_workers: see __init__
+            batch_size: see __init__
+            timeout: see __init__
+        """
+        path = tempfile.mkdtemp(prefix='pysparnn-')
+        try:
+            index.save(path)
+            pool = cls(path, num_workers, batch_size, timeout)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        pool._temp_dir = path
+        return pool
+
+    def _exited_error(self):
+        """An error naming the first worker that exited, None if they are
+        all running."""
+        for worker in self._workers or []:
+            if not worker.is_alive():
+                return RuntimeError(
+                    'Worker process {} exited with code {}'.format(
+                        worker.pid, worker.exitcode))
+        return None
+
+    def _check_workers(self):
+        """Fail every pending search if a worker exited. Returns if one
+        did."""
+        error = self._exited_error()
+        if error is None:
+            return False
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            pending, self._pending = self._pending, {}
+        for done, results in pending.values():
+            results.append(self._error)
+            done.set()
+        return True
+
+    def _read_results(self):
+        """Hand the results of the workers to the waiting searches. Fails
+        every pending search once a worker exited."""
+        while True:
+            try:
+                batch_id, ret = self._results.get(timeout=self.poll_interval)
+            except Empty:
+                if self._closing or self._check_workers():
+                    return
+                continue
+            if batch_id is None:
+                return
+            with self._lock:
+                # searches that timed out dropped their batches
+                batch = self._pending.pop(batch_id, None)
+            if batch is not None:
+                done, results = batch
+                results.append(ret)
+                done.set()
+
+    def search(self, sparse_features, batch_size=None, timeout=None,
+               **kwargs):
+        """Search the index with the workers.
+
+        Args:
+            sparse_features: A csr_matrix of queries.
+            batch_size: Most queries sent to a worker at once. Defaults to
+                the batch_size of the pool.
+            timeout: Most seconds to wait for the results. Defaults to the
+                timeout of the pool.
+            kwargs: Arguments of the index's search.
+        Returns:
+            The search results of every query, see ClusterIndex.search.
+        Raises:
+            RuntimeError: A worker exited, see WorkerPool.
+            multiprocessing.TimeoutError: The results took longer than
+                timeout.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if timeout is None:
+            timeout = self.timeout
+        self._check_workers()
+        batches = []
+        for start in range(0, sparse_features.shape[0], batch_size):
+            batch = (threading.Event(), [])
+            with self._lock:
+                if self._error is not None:
+                    raise self._error
+                batch_id = next(self._batch_ids)
+                self._pending[batch_id] = batch
+            self._tasks.put((batch_id, sparse_features[start:start +
+                                                       batch_size], kwargs))
+            batches.append((batch_id, batch))
+
+        if timeout is not None:
+            deadline = timeit.default_timer() + timeout
+        ret = []
+        for _, (done, results) in batches:
+            wait = None
+            if timeout is not None:
+                wait = max(deadline - timeit.default_timer(), 0)
+            if not done.wait(wait):
+                with self._lock:
+                    for batch_id, _ in batches:
+                        self._pending.pop(batch_id, None)
+                raise multiprocessing.TimeoutError(
+                    'Search took longer than {} seconds'.format(timeout))
+            if isinstance(results[0], Exception):
+                raise results[0]
+            ret.extend(results[0])
+        return ret
+
+    def close(self):
+        """Stop the workers and remove the temporary copy of the index, if
+        any."""
+        if self._workers is None:
+            return
+        self._check_workers()
+        self._closing = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            if self._error is not None:
+                # the queued batches of the exited worker are never done
+                worker.terminate()
+            worker.join()
+        self._workers = None
+        if self._error is None:
+            self._results.put((None, None))
+        # else a worker may have exited holding the lock of the results
+        # queue; the reader stops at its next poll instead
+        self._reader.join()
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,116 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Defines counters and timings of searches"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import timeit
+
+
+class SearchStats(object):
+    """What a search did and where its time went.
+
+    Pass one to search (stats=) or set the stats_callback of an index to be
+    called with the stats of every search. Times are in seconds and are
+    summed over the workers of a parallel search, so they can add up to
+    more than the time of the call.
+
+    Attributes:
+        num_queries: Number of queries searched.
+        num_batches: Number of batches the queries were split into (per
+            index, see ClusterIndex.search n_jobs).
+        clusters_visited: For each level below the root, the number of
+            (query, cluster) pairs searched.
+        rows_scored: Number of (query, record) distances computed, leaders
+            included.
+        distance_time: Time spent computing distances.
+        top_k_time: Time spent selecting the nearest records of each
+            matrix.
+        merge_time: Time spent merging the results of several clusters,
+            indexes and the delta.
+        total_time: Time of the whole search.
+    """
+
+    _counters = ('num_queries', 'num_batches', 'rows_scored',
+                 'distance_time', 'top_k_time', 'merge_time', 'total_time')
+
+    def __init__(self):
+        for name in self._counters:
+            setattr(self, name, 0)
+        self.clusters_visited = []
+
+    def visit(self, level, num_clusters):
+        """Count num_clusters (query, cluster) pairs searched at level."""
+        if len(self.clusters_visited) <= level:
+            self.clusters_visited.extend(
+                [0] * (level + 1 - len(self.clusters_visited)))
+        self.clusters_visited[level] += num_clusters
+
+    def merge(self, other):
+        """Add the counts and times of other, e.g. of another batch."""
+        for name in self._counters:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for level, num_clusters in enumerate(other.clusters_visited):
+            self.visit(level, num_clusters)
+
+    def as_dict(self):
+        """The stats as a dict, e.g. to send to a metrics system."""
+        ret = dict((name, getattr(self, name)) for name in self._counters)
+        ret['clusters_visited'] = list(self.clusters_visited)
+        return ret
+
+    def __repr__(self):
+        return 'SearchStats({})'.format(', '.join(
+            '{}={}'.format(name, value)
+            for name, value in sorted(self.as_dict().items())))
+
+
+class _Timer(object):
+    """Context manager adding the time it was entered for to a stat."""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        setattr(self.stats, self.name, getattr(self.stats, self.name) +
+                timeit.default_timer() - self.start)
+
+
+class _NoTimer(object):
+    """_Timer for searches without stats."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(stats, name):
+    """Time a block of code into the stat name of stats.
+
+    Args:
+        stats: A SearchStats or None to not time anything.
+        name: Name of the time attribute.
+    Usage:
+        with timer(stats, 'merge_time'):
+            ...
+    """
+    if stats is None:
+        return _NO_TIMER
+    return _Timer(stats, name)
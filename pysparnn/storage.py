@@ -0,0 +1,331 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Saves indexes as flat binary arrays and loads them memory mapped.
+
+An index is saved to a directory. Every node (level) of every tree is
+numbered and the CSR arrays, row stats (norms) and records of all the nodes
+are concatenated into one .npy file each. The tree topology is stored as
+integer arrays of offsets into those files. Loading memory maps the .npy
+files and rebuilds the nodes around zero copy slices of them so a load
+only reads the topology and processes that load the same index share the
+same pages.
+
+Indexes that share a store (see MultiClusterIndex) save the store once, as
+store_* arrays, and their leaves save only the positions of their records
+in the store (leaf_rows).
+
+Packed bitset metrics (see PackedBinarySearch) save their packed bits
+(packed and store_packed) instead of CSR arrays, so loading memory maps
+them as well.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import importlib
+import json
+import os
+import pickle
+import numpy as np
+import scipy.sparse
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'index.json'
+RECORDS_PICKLE = 'records.pkl'
+
+
+def _class_path(cls):
+    """module:name string for a class."""
+    return '{}:{}'.format(cls.__module__, cls.__name__)
+
+
+def _import_class(path):
+    """Inverse of _class_path."""
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def _nodes(indexes):
+    """Number every node of the trees breadth first.
+
+    Returns:
+        A list of (node, parent number) tuples.
+    """
+    nodes = [(index, -1) for index in indexes]
+    i = 0
+    while i < len(nodes):
+        node, _ = nodes[i]
+        if not node.is_terminal:
+            nodes.extend((child, i) for child in node.root.records_data)
+        i += 1
+    return nodes
+
+
+def _is_packed(distance_type):
+    """True if distance_type keeps its features as packed bits."""
+    # imported here as matrix_distance is imported by cluster_pruning
+    from pysparnn.matrix_distance import PackedBinarySearch
+    return issubclass(distance_type, PackedBinarySearch)
+
+
+def save(path, indexes, kind):
+    """Save ClusterIndexes to the directory path.
+
+    Args:
+        path: Directory to write to. Created if it does not exist.
+        indexes: List of ClusterIndexes that share a distance type.
+        kind: Name of the class being saved ('ClusterIndex' or
+            'MultiClusterIndex').
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    nodes = _nodes(indexes)
+    distance_type = indexes[0].distance_type
+    node_ids = dict((id(node), i) for i, (node, _) in enumerate(nodes))
+
+    num_nodes = len(nodes)
+    topology = dict(
+        parent=np.array([parent for _, parent in nodes], dtype=np.int64),
+        is_terminal=np.array([node.is_terminal for node, _ in nodes]),
+        matrix_size=np.array([node.matrix_size for node, _ in nodes],
+                             dtype=np.int64),
+        desired_matrix_size=np.array(
+            [-1 if node.desired_matrix_size is None
+             else node.desired_matrix_size for node, _ in nodes],
+            dtype=np.int64),
+        row_start=np.zeros(num_nodes + 1, dtype=np.int64),
+        nnz_start=np.zeros(num_nodes + 1, dtype=np.int64),
+        children_start=np.zeros(num_nodes + 1, dtype=np.int64),
+        record_start=np.zeros(num_nodes + 1, dtype=np.int64),
+    )
+
+    store = indexes[0].store
+    packed = _is_packed(distance_type)
+    data, indices, indptr, children, records = [], [], [], [], []
+    packed_bits = []
+    radii = []
+    leaf_rows = []
+    row_stats = dict((name, []) for name in distance_type.row_stats)
+    num_features = 0
+    for i, (node, _) in enumerate(nodes):
+        if node.is_terminal and store is not None:
+            matrix = scipy.sparse.csr_matrix((0, 0))
+            leaf_rows.append(node.root.rows)
+        else:
+            if packed:
+                # the bits are saved as packed; this only keeps the rows
+                matrix = scipy.sparse.csr_matrix(
+                    (node.root.matrix.shape[0], 0))
+                packed_bits.append(node.root.matrix)
+                num_features = max(num_features, node.root.num_features)
+            else:
+                matrix = scipy.sparse.csr_matrix(
+                    node.root.get_feature_matrix())
+            for name in distance_type.row_stats:
+                row_stats[name].append(node.root.get_row_stat(name))
+        num_features = max(num_features, matrix.shape[1])
+        data.append(matrix.data)
+        indices.append(matrix.indices)
+        indptr.append(matrix.indptr)
+
+        node_children = []
+        if node.is_terminal:
+            if store is None:
+                records.append(node.root.get_records())
+        else:
+            node_children = [node_ids[id(child)]
+                             for child in node.root.records_data]
+            # the radius of every child, inf if it is not known
+            radii.append(np.full(len(node_children), np.inf)
+                         if node.radii is None else node.radii)
+        children.extend(node_children)
+
+        topology['row_start'][i + 1] = \
+                topology['row_start'][i] + matrix.shape[0]
+        topology['nnz_start'][i + 1] = topology['nnz_start'][i] + matrix.nnz
+        topology['children_start'][i + 1] = \
+                topology['children_start'][i] + len(node_children)
+        topology['record_start'][i + 1] = topology['record_start'][i] + \
+                (len(node.root.records_data) if node.is_terminal else 0)
+    topology['children'] = np.array(children, dtype=np.int64)
+    topology['radii'] = np.concatenate(radii or [np.zeros(0)])
+
+    arrays = dict(('node_' + name, value)
+                  for name, value in topology.items())
+    arrays['data'] = np.concatenate(data)
+    arrays['indices'] = np.concatenate(indices)
+    arrays['indptr'] = np.concatenate(indptr)
+    if packed:
+        arrays['packed'] = np.concatenate(packed_bits or [
+            np.zeros((0, (num_features + 7) // 8), dtype=np.uint8)])
+    for name, values in row_stats.items():
+        # the leaves of indexes with a store have no row stats
+        arrays['stat_' + name] = np.concatenate(values or [np.zeros(0)])
+    if store is not None:
+        arrays['leaf_rows'] = np.concatenate(leaf_rows)
+        if packed:
+            num_features = max(num_features, store.num_features)
+            arrays['store_packed'] = store.matrix
+        else:
+            matrix = scipy.sparse.csr_matrix(store.get_feature_matrix())
+            num_features = max(num_features, matrix.shape[1])
+            arrays['store_data'] = matrix.data
+            arrays['store_indices'] = matrix.indices
+            arrays['store_indptr'] = matrix.indptr
+        for name in distance_type.row_stats:
+            arrays['store_stat_' + name] = store.get_row_stat(name)
+        records = [store.get_records()]
+    for name, value in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), value)
+
+    records = np.concatenate(records)
+    pickled_records = bool(records.dtype.hasobject)
+    if pickled_records:
+        with open(os.path.join(path, RECORDS_PICKLE), 'wb') as f:
+            pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+    else:
+        np.save(os.path.join(path, 'records.npy'), records)
+
+    metadata = dict(
+        format_version=FORMAT_VERSION,
+        kind=kind,
+        distance_type=_class_path(distance_type),
+        memory_budget=indexes[0].root.memory_budget,
+        num_indexes=len(indexes),
+        num_features=num_features,
+        packed=packed,
+        pickled_records=pickled_records,
+        shared_store=store is not None,
+        build_options=indexes[0]._build_options(),
+        arrays=sorted(arrays),
+    )
+    with open(os.path.join(path, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+
+
+def load(path, mmap=True):
+    """Load ClusterIndexes saved with save.
+
+    Args:
+        path: Directory the index was saved to.
+        mmap: Memory map the arrays instead of reading them into memory.
+
+    Returns:
+        A tuple of (kind, list of root ClusterIndexes).
+    """
+    # imported here as cluster_pruning imports this module
+    from pysparnn.cluster_pruning import ClusterIndex
+    from pysparnn.matrix_distance import MatrixMetricSubset
+
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    if metadata['format_version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported index format version: {}'.format(
+            metadata['format_version']))
+
+    mmap_mode = 'r' if mmap else None
+    arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                 mmap_mode=mmap_mode))
+                  for name in metadata['arrays'])
+    if metadata['pickled_records']:
+        with open(os.path.join(path, RECORDS_PICKLE), 'rb') as f:
+            records = pickle.load(f)
+    else:
+        records = np.load(os.path.join(path, 'records.npy'),
+                          mmap_mode=mmap_mode)
+
+    distance_type = _import_class(metadata['distance_type'])
+    num_features = metadata['num_features']
+    # the topology is small, read it into memory
+    topology = dict((name[len('node_'):], np.array(value))
+                    for name, value in arrays.items()
+                    if name.startswith('node_'))
+    row_start = topology['row_start']
+    nnz_start = topology['nnz_start']
+    num_nodes = len(topology['parent'])
+
+    packed = metadata.get('packed', False)
+
+    store = None
+    if metadata.get('shared_store', False):
+        if packed:
+            matrix = arrays['store_packed']
+        else:
+            matrix = scipy.sparse.csr_matrix(
+                (arrays['store_data'], arrays['store_indices'],
+                 arrays['store_indptr']),
+                shape=(len(arrays['store_indptr']) - 1, num_features),
+                copy=False)
+        row_stats = dict((name, arrays['store_stat_' + name])
+                         for name in distance_type.row_stats)
+        store = distance_type.from_arrays(matrix, records, row_stats,
+                                          metadata['memory_budget'])
+        if packed:
+            store.num_features = num_features
+        # the arrays were saved as dtype; this only records it
+        store._set_dtype(metadata.get('build_options', {}).get('dtype'))
+
+    nodes = [ClusterIndex.__new__(ClusterIndex) for _ in range(num_nodes)]
+    # build the leaves first so every child exists before its parent
+    for i in reversed(range(num_nodes)):
+        node = nodes[i]
+        rows = row_start[i + 1] - row_start[i]
+        first_ptr = row_start[i] + i
+        if packed:
+            matrix = arrays['packed'][row_start[i]:row_start[i + 1]]
+        else:
+            matrix = scipy.sparse.csr_matrix(
+                (arrays['data'][nnz_start[i]:nnz_start[i + 1]],
+                 arrays['indices'][nnz_start[i]:nnz_start[i + 1]],
+                 arrays['indptr'][first_ptr:first_ptr + rows + 1]),
+                shape=(rows, num_features), copy=False)
+        row_stats = dict(
+            (name, arrays['stat_' + name][row_start[i]:row_start[i + 1]])
+            for name in distance_type.row_stats)
+
+        if topology['is_terminal'][i]:
+            if store is not None:
+                rows = arrays['leaf_rows'][topology['record_start'][i]:
+                                           topology['record_start'][i + 1]]
+                node_records = None
+            else:
+                node_records = records[topology['record_start'][i]:
+                                       topology['record_start'][i + 1]]
+        else:
+            node_children = topology['children'][
+                topology['children_start'][i]:
+                topology['children_start'][i + 1]]
+            node_records = np.empty(len(node_children), dtype=object)
+            node_records[:] = [nodes[child] for child in node_children]
+            if 'radii' in topology:
+                node.radii = topology['radii'][
+                    topology['children_start'][i]:
+                    topology['children_start'][i + 1]]
+
+        parent = topology['parent'][i]
+        desired_matrix_size = topology['desired_matrix_size'][i]
+        node.is_terminal = bool(topology['is_terminal'][i])
+        node.parent = nodes[parent] if parent >= 0 else None
+        node.distance_type = distance_type
+        node.matrix_size = int(topology['matrix_size'][i])
+        node.desired_matrix_size = None if desired_matrix_size < 0 \
+                else int(desired_matrix_size)
+        node.store = store
+        for name, value in metadata.get('build_options', {}).items():
+            setattr(node, name, value)
+        if node_records is None:
+            node.root = MatrixMetricSubset(store, rows)
+        else:
+            node.root = distance_type.from_arrays(
+                matrix, node_records, row_stats, metadata['memory_budget'])
+            node.root._set_dtype(node.dtype)
+            if packed:
+                node.root.num_features = num_features
+
+    return metadata['kind'], nodes[:metadata['num_indexes']]
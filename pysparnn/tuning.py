@@ -0,0 +1,241 @@
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Pick matrix_size, num_indexes and k_clusters for a target recall"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import itertools
+import timeit
+import numpy as np
+import scipy.sparse
+import pysparnn.cluster_pruning
+import pysparnn.matrix_distance
+
+
+def query_recalls(results, truth):
+    """Fraction of the true nearest records found for each query.
+
+    Args:
+        results: For each query, a list of the records found.
+        truth: For each query, a list of its true nearest records.
+    Returns:
+        An array with the recall of every query. Queries without true
+        nearest records have a recall of 1.
+    """
+    return np.array([len(set(found) & set(expected)) / len(expected)
+                     if len(expected) else 1.0
+                     for found, expected in zip(results, truth)])
+
+
+def recall(results, truth):
+    """Mean fraction of the true nearest records found for each query, see
+    query_recalls."""
+    recalls = query_recalls(results, truth)
+    return float(recalls.mean()) if len(recalls) else 1.0
+
+
+def _search_bytes(search):
+    """Bytes used by the arrays of a search structure."""
+    if isinstance(search, pysparnn.matrix_distance.MatrixMetricSubset):
+        size = search.rows.nbytes
+        if search._gathered is not None:
+            size += _search_bytes(search._gathered)
+        return size
+    matrix = search.matrix
+    if scipy.sparse.issparse(matrix):
+        size = matrix.data.nbytes + matrix.indices.nbytes + \
+                matrix.indptr.nbytes
+    else:
+        size = matrix.nbytes
+    for name in search.row_stats:
+        value = getattr(search, name)
+        if value is not None:
+            size += value.nbytes
+    return size + search.records_data.nbytes
+
+
+def index_bytes(index, num_indexes=None):
+    """Approximate memory used by the matrices of an index.
+
+    Object records (e.g. strings) only count their pointers. Leaf rows
+    kept by a search (see MatrixMetricSubset.keep_gathered) are counted,
+    so measure after searching.
+
+    Args:
+        index: A ClusterIndex or MultiClusterIndex.
+        num_indexes: Only count the first num_indexes indexes of a
+            MultiClusterIndex.
+    """
+    if isinstance(index, pysparnn.cluster_pruning.ClusterIndex):
+        indexes, store = [index], index.store
+    else:
+        indexes, store = index.indexes[:num_indexes], index.store
+    size = 0 if store is None else _search_bytes(store)
+    for ind in indexes:
+        for node in ind._all_nodes():
+            size += _search_bytes(node.root)
+    return size
+
+
+class Tuning(object):
+    """The index picked by tune and the measurements it was picked from.
+
+    Attributes:
+        index: The MultiClusterIndex built with the picked matrix_size and
+            num_indexes.
+        params: Dict of the picked matrix_size, num_indexes and k_clusters.
+        trials: List of dicts with the params, recall, latency (mean
+            seconds to search one query), memory (bytes, see index_bytes)
+            and build_time of every configuration tried.
+        met_target: False if no configuration within the budget reached
+            the target recall; params then has the highest recall.
+    """
+
+    def __init__(self, index, params, trials, met_target):
+        self.index = index
+        self.params = params
+        self.trials = trials
+        self.met_target = met_target
+
+    def k_clusters_for(self, target_recall):
+        """Smallest k_clusters that reached target_recall on the sample
+        queries with the picked matrix_size and num_indexes, or the
+        largest k_clusters tried if none did."""
+        curve = sorted((trial['k_clusters'], trial['recall'])
+                       for trial in self.trials
+                       if trial['matrix_size'] == self.params['matrix_size']
+                       and trial['num_indexes'] ==
+                       self.params['num_indexes'])
+        for k_clusters, trial_recall in curve:
+            if trial_recall >= target_recall:
+                return k_clusters
+        return curve[-1][0]
+
+    def search(self, sparse_features, target_recall=None, **kwargs):
+        """Search the index with the k_clusters of a recall level.
+
+        Args:
+            sparse_features: see MultiClusterIndex.search
+            target_recall: Desired recall, see k_clusters_for. Defaults to
+                the picked k_clusters.
+            kwargs: Other arguments of MultiClusterIndex.search.
+        """
+        if target_recall is None:
+            k_clusters = self.params['k_clusters']
+        else:
+            k_clusters = self.k_clusters_for(target_recall)
+        return self.index.search(sparse_features, k_clusters=k_clusters,
+                                 **kwargs)
+
+
+def _latency(index, queries, k, k_clusters, num_indexes):
+    """Mean time to search one query."""
+    start = timeit.default_timer()
+    for i in range(queries.shape[0]):
+        index.search(queries[i], k=k, k_clusters=k_clusters,
+                     num_indexes=num_indexes)
+    return (timeit.default_timer() - start) / max(queries.shape[0], 1)
+
+
+def tune(sparse_features, records_data, queries, target_recall=0.9, k=10,
+         max_latency=None, max_memory=None, matrix_sizes=None,
+         num_indexes=(1, 2, 4), k_clusters=(1, 2, 4, 8),
+         distance_type=pysparnn.matrix_distance.CosineDistance,
+         latency_queries=50, **kwargs):
+    """Build the fastest MultiClusterIndex that reaches a recall.
+
+    The true nearest records of the sample queries are found by brute
+    force. An index is built for every matrix_size (with the most
+    num_indexes; fewer are searched with the num_indexes argument of
+    search) and searched with every num_indexes and k_clusters. Of the
+    configurations within the budget that reach target_recall, the one
+    with the lowest latency is picked.
+
+    Args:
+        sparse_features: A csr_matrix of the records, see
+            MultiClusterIndex.
+        records_data: Records to return when a doc is matched.
+        queries: A csr_matrix of sample queries.
+        target_recall: Desired mean recall@k of the sample queries.
+        k: Number of results per query.
+        max_latency: Largest mean time (seconds) to search one query.
+        max_memory: Largest number of bytes of the matrices of the index,
+            see index_bytes.
+        matrix_sizes: matrix_size values to try. Defaults to half, once
+            and twice the default matrix_size.
+        num_indexes: num_indexes values to try.
+        k_clusters: k_clusters values to try.
+        distance_type: Class that defines the distance measure to use.
+        latency_queries: Number of the sample queries searched one at a time
+            to measure the latency.
+        kwargs: Other arguments of MultiClusterIndex (e.g. clustering).
+    Returns:
+        A Tuning.
+    """
+    num_records = sparse_features.shape[0]
+    if matrix_sizes is None:
+        default = max(int(np.sqrt(num_records)), 100)
+        matrix_sizes = sorted(set([max(default // 2, 10), default,
+                                   2 * default]))
+    truth = [[record for _, record in res] for res in
+             distance_type(sparse_features, records_data).nearest_search(
+                 queries, k=k)]
+    latency_queries = queries[:latency_queries]
+
+    trials = []
+    best, best_index = None, None
+    for matrix_size in matrix_sizes:
+        start = timeit.default_timer()
+        index = pysparnn.cluster_pruning.MultiClusterIndex(
+            sparse_features, records_data, distance_type, matrix_size,
+            num_indexes=max(num_indexes), **kwargs)
+        build_time = timeit.default_timer() - start
+
+        for num, k_clust in itertools.product(sorted(num_indexes),
+                                              sorted(k_clusters)):
+            results = index.search(queries, k=k, k_clusters=k_clust,
+                                   return_distance=False, num_indexes=num)
+            latency = _latency(index, latency_queries, k, k_clust, num)
+            # measured after searching, which may cache leaf rows
+            trial = dict(matrix_size=matrix_size, num_indexes=num,
+                         k_clusters=k_clust, recall=recall(results, truth),
+                         memory=index_bytes(index, num),
+                         build_time=build_time, latency=latency)
+            trials.append(trial)
+            if _better(trial, best, target_recall, max_latency, max_memory):
+                best, best_index = trial, index
+        # free the index, unless it is the best, before building the next
+        index = None
+
+    if best is None:
+        raise ValueError('No configuration is within the latency and '
+                         'memory budget')
+    best_index.indexes = best_index.indexes[:best['num_indexes']]
+    params = dict((name, best[name])
+                  for name in ['matrix_size', 'num_indexes', 'k_clusters'])
+    return Tuning(best_index, params, trials,
+                  best['recall'] >= target_recall)
+
+
+def _better(trial, best, target_recall, max_latency, max_memory):
+    """True if trial is within the budget and better than best: it reaches
+    the target recall faster, or gets closer to it."""
+    if max_latency is not None and trial['latency'] > max_latency:
+        return False
+    if max_memory is not None and trial['memory'] > max_memory:
+        return False
+    if best is None:
+        return True
+    met = trial['recall'] >= target_recall
+    best_met = best['recall'] >= target_recall
+    if met != best_met:
+        return met
+    if met:
+        return trial['latency'] < best['latency']
+    return trial['recall'] > best['recall']
@@ -6,12 +6,38 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 """Test pysparn search"""
 
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+import warnings
 import pysparnn.cluster_pruning as cp
+import pysparnn.kmeans
+import pysparnn.matrix_distance
+import pysparnn.parallel
+import pysparnn.serving
+import pysparnn.tuning
+from pysparnn.cache import QueryCache
+from pysparnn.flat_index import FlatClusterIndex
 import numpy as np
+import scipy.spatial.distance
 from scipy.sparse import csr_matrix
+from pysparnn.matrix_distance import CosineDistance
+from pysparnn.matrix_distance import EuclideanDistance
+from pysparnn.matrix_distance import HammingDistance
+from pysparnn.matrix_distance import InnerProductDistance
+from pysparnn.matrix_distance import JaccardDistance
+from pysparnn.matrix_distance import ManhattanDistance
+from pysparnn.matrix_distance import MatrixMetricSubset
+from pysparnn.matrix_distance import NormalizedCosineDistance
+from pysparnn.matrix_distance import PackedJaccardDistance
+from pysparnn.matrix_distance import PackedUnitCosineDistance
 from pysparnn.matrix_distance import SlowEuclideanDistance
 from pysparnn.matrix_distance import UnitCosineDistance
+from pysparnn.matrix_distance import top_k
+from pysparnn.stats import SearchStats
 from sklearn.feature_extraction import DictVectorizer
 
 class PysparnnTest(unittest.TestCase):
@@ -83,3 +109,990 @@ class PysparnnTest(unittest.TestCase):
         ret =  cluster_index.search(features[0:10], k=1, k_clusters=1,
                                     return_distance=False)
         self.assertEqual([[x] for x in data_to_return[:10]], ret)
+
+    def test_nearest_search_arrays(self):
+        """Batched top-k matches a full sort and pads filtered results"""
+        features = csr_matrix(np.random.binomial(1, 0.1, size=(50, 100)))
+        queries = csr_matrix(np.random.binomial(1, 0.1, size=(20, 100)))
+        search = CosineDistance(features, range(50))
+
+        dist_matrix = search._distance(queries)
+        distances, indices = search.nearest_search(queries, k=5,
+                                                   return_arrays=True)
+        self.assertEqual((20, 5), indices.shape)
+        for i in range(20):
+            expected = np.sort(dist_matrix[i][~np.isnan(dist_matrix[i])])
+            np.testing.assert_allclose(expected[:5], distances[i])
+
+        distances, indices = search.nearest_search(queries, k=5,
+                                                   max_distance=-1,
+                                                   return_arrays=True)
+        self.assertTrue((indices == -1).all())
+        self.assertTrue(np.isinf(distances).all())
+        self.assertEqual([[]] * 20, search.nearest_search(queries, k=5,
+                                                          max_distance=-1))
+
+    def test_duplicate_records(self):
+        """Identical records do not split forever"""
+        features = csr_matrix(np.ones((500, 10)))
+        cluster_index = cp.ClusterIndex(features, range(500), matrix_size=10)
+
+        ret = cluster_index.search(features[:3], k=2, return_distance=False)
+        self.assertEqual([2, 2, 2], [len(r) for r in ret])
+
+    def test_batched_traversal(self):
+        """Searching a batch gives the same results as one query at a time"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        cluster_index = cp.ClusterIndex(features, range(1000), matrix_size=10)
+
+        batched = cluster_index.search(features[:50], k=3, k_clusters=2)
+        for i in range(50):
+            single = cluster_index.search(features[i], k=3, k_clusters=2)[0]
+            self.assertEqual([d for d, _ in single],
+                             [d for d, _ in batched[i]])
+
+    def test_sparse_distance_blocks(self):
+        """Sparse top-k over small record blocks matches the dense top-k"""
+        features = csr_matrix(np.random.binomial(1, 0.05, size=(200, 100)))
+        queries = csr_matrix(np.random.binomial(1, 0.05, size=(30, 100)))
+        weights = np.random.randn(100)
+
+        for distance_type, scale in [(CosineDistance, weights),
+                                     (UnitCosineDistance, 1)]:
+            search = distance_type(features.multiply(scale).tocsr(),
+                                   range(200), memory_budget=30 * 8 * 16)
+            scaled_queries = queries.multiply(scale).tocsr()
+            dist_matrix = search._distance(scaled_queries)
+            for max_distance in [None, 0.9, 1.0, 1.5]:
+                expected = top_k(dist_matrix, 7, max_distance)
+                ret = search.nearest_search(scaled_queries, k=7,
+                                            max_distance=max_distance,
+                                            return_arrays=True)
+                np.testing.assert_allclose(expected[0], ret[0])
+                np.testing.assert_array_equal(expected[1], ret[1])
+
+    def test_sparse_euclidean(self):
+        """Sparse euclidean distance matches the dense implementation"""
+        features = csr_matrix(np.random.binomial(1, 0.05, size=(200, 100)) *
+                              np.random.randn(200, 100))
+        queries = csr_matrix(np.random.binomial(1, 0.05, size=(30, 100)) *
+                             np.random.randn(30, 100))
+        slow = SlowEuclideanDistance(features, range(200))
+        fast = EuclideanDistance(features, range(200),
+                                 memory_budget=30 * 8 * 16)
+
+        np.testing.assert_allclose(slow._distance(queries),
+                                   fast._distance(queries), atol=1e-7)
+        for max_distance in [None, 2.0]:
+            expected = slow.nearest_search(queries, k=5,
+                                           max_distance=max_distance,
+                                           return_arrays=True)
+            ret = fast.nearest_search(queries, k=5,
+                                      max_distance=max_distance,
+                                      return_arrays=True)
+            np.testing.assert_allclose(expected[0], ret[0], atol=1e-7)
+
+    def test_sparse_euclidean_index(self):
+        """Index and search with the sparse euclidean distance"""
+        data = [
+            'hello world',
+            'oh hello there',
+            'Play it',
+            'Play it again Sam',
+        ]
+
+        features = [dict([(x, 1) for x in f.split()]) for f in data]
+        features = DictVectorizer().fit_transform(features)
+
+        cluster_index = cp.ClusterIndex(features, data, EuclideanDistance)
+
+        ret = cluster_index.search(features, k=1, k_clusters=1,
+                                   return_distance=False)
+        self.assertEqual([[d] for d in data], ret)
+
+    def test_sparse_metrics(self):
+        """Sparse metrics match brute force dense distances"""
+        features = np.random.binomial(1, 0.05, size=(200, 100)) * \
+                np.random.randn(200, 100)
+        queries = np.random.binomial(1, 0.05, size=(30, 100)) * \
+                np.random.randn(30, 100)
+        # no empty rows; scipy puts two empty rows 0 jaccard distance apart
+        features[np.arange(200), np.random.randint(100, size=200)] = 1.0
+        queries[np.arange(30), np.random.randint(100, size=30)] = 1.0
+        dims = features.shape[1]
+        expected = {
+            JaccardDistance: scipy.spatial.distance.cdist(
+                queries != 0, features != 0, 'jaccard'),
+            HammingDistance: dims * scipy.spatial.distance.cdist(
+                queries != 0, features != 0, 'hamming'),
+            ManhattanDistance: scipy.spatial.distance.cdist(
+                queries, features, 'cityblock'),
+            InnerProductDistance: -queries.dot(features.T),
+            PackedJaccardDistance: scipy.spatial.distance.cdist(
+                queries != 0, features != 0, 'jaccard'),
+            PackedUnitCosineDistance: scipy.spatial.distance.cdist(
+                queries != 0, features != 0, 'cosine'),
+        }
+
+        for distance_type, dist_matrix in expected.items():
+            search = distance_type(csr_matrix(features), range(200),
+                                   memory_budget=30 * 8 * 16)
+            ret = search.nearest_search(csr_matrix(queries), k=5,
+                                        return_arrays=True)
+            np.testing.assert_allclose(
+                np.sort(dist_matrix, axis=1)[:, :5], ret[0], atol=1e-7)
+
+    def test_sparse_metrics_multiindex(self):
+        """Sparse metrics can be used to build a MultiClusterIndex"""
+        features = csr_matrix(np.random.binomial(1, 0.05, size=(500, 2000)))
+        data_to_return = range(500)
+
+        for distance_type in [JaccardDistance, HammingDistance,
+                              ManhattanDistance, PackedJaccardDistance]:
+            cluster_index = cp.MultiClusterIndex(features, data_to_return,
+                                                 distance_type,
+                                                 matrix_size=10)
+            ret = cluster_index.search(features[0:10], k=1, k_clusters=1,
+                                       return_distance=False)
+            self.assertEqual([[x] for x in data_to_return[:10]], ret)
+
+    def test_parallel_build(self):
+        """Indexes built with a process pool return the same results"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        data_to_return = range(1000)
+
+        cluster_index = cp.ClusterIndex(features, data_to_return,
+                                        matrix_size=10, n_jobs=2)
+        ret = cluster_index.search(features[0:10], k=1, k_clusters=1,
+                                   return_distance=False)
+        self.assertEqual([[x] for x in data_to_return[:10]], ret)
+        self.assertTrue(all(index.parent is cluster_index
+                            for index in cluster_index.root.records_data))
+
+        for num_indexes in [1, 2]:
+            cluster_index = cp.MultiClusterIndex(features, data_to_return,
+                                                 matrix_size=10,
+                                                 num_indexes=num_indexes,
+                                                 n_jobs=2)
+            ret = cluster_index.search(features[0:10], k=1, k_clusters=1,
+                                       return_distance=False)
+            self.assertEqual([[x] for x in data_to_return[:10]], ret)
+
+        # the records of a level are assigned in a few large tasks, each
+        # of which carries the leaders
+        class CountingExecutor(pysparnn.parallel.SerialExecutor):
+            num_chunks = []
+
+            def map(self, func, iterable):
+                tasks = list(iterable)
+                if func is cp._nearest_cluster:
+                    self.num_chunks.append(len(tasks))
+                return [func(task) for task in tasks]
+
+        executor = CountingExecutor()
+        cp.ClusterIndex(features, data_to_return, matrix_size=10,
+                        executor=executor)
+        self.assertTrue(1 < max(executor.num_chunks) <=
+                        cp.ClusterIndex.assignment_tasks)
+
+    def test_parallel_search(self):
+        """Concurrent searches return the same results as a serial search"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        cluster_index = cp.MultiClusterIndex(features, range(1000),
+                                             matrix_size=10)
+
+        expected = cluster_index.search(features[:100], k=3, k_clusters=2)
+        for backend in ['thread', 'process']:
+            ret = cluster_index.search(features[:100], k=3, k_clusters=2,
+                                       n_jobs=3, backend=backend)
+            self.assertEqual(expected, ret)
+            ret = cluster_index.indexes[0].search(features[:100], k=3,
+                                                  n_jobs=3, backend=backend)
+            self.assertEqual(cluster_index.indexes[0].search(features[:100],
+                                                             k=3), ret)
+
+        # the workers of a search pool get the indexes once, not per search
+        with cluster_index.search_pool(n_jobs=2) as pool:
+            self.assertEqual([0, 1], pool.targets(cluster_index.indexes))
+            for _ in range(2):
+                ret = cluster_index.search(features[:100], k=3, k_clusters=2,
+                                           executor=pool)
+                self.assertEqual(expected, ret)
+            ret = cluster_index.search(features[:100], k=3, k_clusters=2,
+                                       num_indexes=1, executor=pool)
+            self.assertEqual(cluster_index.search(features[:100], k=3,
+                                                  k_clusters=2,
+                                                  num_indexes=1), ret)
+            other = cp.ClusterIndex(features, range(1000))
+            self.assertRaises(ValueError, other.search, features[:100],
+                              executor=pool)
+        index = cluster_index.indexes[0]
+        with index.search_pool(n_jobs=2) as pool:
+            self.assertEqual(index.search(features[:100], k=3),
+                             index.search(features[:100], k=3, executor=pool))
+
+    def test_save_load(self):
+        """Saved indexes load (memory mapped) and return the same results"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        data = ['doc {}'.format(i) for i in range(1000)]
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        for distance_type in [CosineDistance, EuclideanDistance]:
+            cluster_index = cp.MultiClusterIndex(features, data, distance_type,
+                                                 matrix_size=10)
+            expected = cluster_index.search(features[:20], k=3, k_clusters=2)
+            cluster_index.save(path)
+
+            for mmap in [True, False]:
+                loaded = cp.MultiClusterIndex.load(path, mmap=mmap)
+                self.assertEqual(expected, loaded.search(features[:20], k=3,
+                                                         k_clusters=2))
+                self.assertEqual(cluster_index.indexes[0]._matrix_sizes(),
+                                 loaded.indexes[0]._matrix_sizes())
+            self.assertRaises(ValueError, cp.ClusterIndex.load, path)
+
+        cluster_index = cp.ClusterIndex(features, range(1000), matrix_size=10)
+        cluster_index.save(path)
+        loaded = cp.ClusterIndex.load(path)
+        self.assertEqual(cluster_index.search(features[:20], k=3),
+                         loaded.search(features[:20], k=3))
+
+        # packed bitsets are saved packed and memory mapped
+        for cluster_index in [
+                cp.ClusterIndex(features, data, PackedJaccardDistance,
+                                matrix_size=10),
+                cp.MultiClusterIndex(features, data, PackedJaccardDistance,
+                                     matrix_size=10)]:
+            expected = cluster_index.search(features[:20], k=3)
+            cluster_index.save(path)
+            loaded = type(cluster_index).load(path)
+            self.assertEqual(expected, loaded.search(features[:20], k=3))
+            roots = [node.root for node in loaded._all_nodes()] \
+                    if isinstance(loaded, cp.ClusterIndex) \
+                    else [loaded.store]
+            for root in roots:
+                self.assertTrue(isinstance(root.matrix, np.memmap))
+                self.assertEqual(20000, root.num_features)
+
+    def test_shared_store(self):
+        """The indexes of a MultiClusterIndex share one copy of the data"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        data = ['doc {}'.format(i) for i in range(1000)]
+
+        for distance_type in [CosineDistance, EuclideanDistance]:
+            cluster_index = cp.MultiClusterIndex(features, data, distance_type,
+                                                 matrix_size=10)
+            for index in cluster_index.indexes:
+                rows = np.concatenate(index._get_child_rows())
+                self.assertEqual(list(range(1000)), sorted(rows))
+                self.assertTrue(index.store is cluster_index.store)
+            # the leaves of the first index are ranges of the store
+            self.assertTrue(all(leaf.root._start is not None for leaf in
+                                cluster_index.indexes[0]._all_leaves()))
+
+            # searching every cluster is a brute force search
+            brute_force = distance_type(features, data)
+            ret = cluster_index.search(features[:20], k=5, k_clusters=1000)
+            expected = brute_force.nearest_search(features[:20], k=5)
+            for r, e in zip(ret, expected):
+                np.testing.assert_allclose([d for d, _ in e],
+                                           [d for d, _ in r])
+
+            cluster_index.insert(features[0], 'new doc')
+            cluster_index.flush()
+            self.assertEqual(1001, cluster_index.store.matrix.shape[0])
+            ret = cluster_index.search(features[0], k=2,
+                                       return_distance=False)
+            self.assertEqual(['doc 0', 'new doc'], sorted(ret[0]))
+
+            # no leaf keeps a copy of its rows
+            leaves = [leaf.root for index in cluster_index.indexes
+                      for leaf in index._all_leaves()]
+            self.assertTrue(all(leaf._gathered is None for leaf in leaves))
+            cluster_index.delete(['new doc'])
+            ret = cluster_index.search(features[0], k=2,
+                                       return_distance=False)
+            self.assertEqual(['doc 0'], [x for x in ret[0]
+                                         if x in ('doc 0', 'new doc')])
+
+        # subsets over a range of the store are searched in place, others
+        # gather their rows
+        store = CosineDistance(features, data)
+        for rows in [np.arange(10, 20), np.arange(19, 9, -1)]:
+            subset = MatrixMetricSubset(store, rows)
+            self.assertEqual(rows[0] == 10, subset._start == 10)
+            ret = subset.nearest_search(features[10:15], k=1)
+            self.assertEqual([[data[i]] for i in range(10, 15)],
+                             [[x for _, x in r] for r in ret])
+            self.assertTrue(subset._gathered is None)
+
+        # taking and appending records reuses the row stats
+        search = EuclideanDistance(features[:500], data[:500])
+        search.append(features[500:], data[500:])
+        full = EuclideanDistance(features, data)
+        rows = np.random.permutation(1000)[:100]
+        taken = full.take(rows)
+        for name in EuclideanDistance.row_stats:
+            np.testing.assert_array_equal(full.get_row_stat(name),
+                                          search.get_row_stat(name))
+        self.assertEqual(full.nearest_search(features[:5], k=3),
+                         search.nearest_search(features[:5], k=3))
+        self.assertEqual(list(np.array(data)[rows]), list(taken.get_records()))
+        self.assertEqual(
+            EuclideanDistance(features[rows], taken.get_records())
+            .nearest_search(features[:5], k=3),
+            taken.nearest_search(features[:5], k=3))
+
+    def test_insert_batch(self):
+        """Inserted records are found before and after they are flushed"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1300, 20000)))
+        data = ['doc {}'.format(i) for i in range(1300)]
+
+        for index_type in [cp.ClusterIndex, cp.MultiClusterIndex]:
+            cluster_index = index_type(features[:1000], data[:1000],
+                                       matrix_size=10)
+            cluster_index.delta_size = 200
+            for rng in range(1000, 1300, 50):
+                cluster_index.insert_batch(features[rng:rng + 50],
+                                           data[rng:rng + 50])
+            # 200 records were flushed and 100 are still in the delta
+            self.assertEqual(100, cluster_index.delta.matrix.shape[0])
+            ret = cluster_index.search(features[950:1300], k=1,
+                                       return_distance=False)
+            self.assertEqual([[d] for d in data[950:1300]], ret)
+
+            cluster_index.flush()
+            self.assertTrue(cluster_index.delta is None)
+            ret = cluster_index.search(features[950:1300], k=1,
+                                       return_distance=False)
+            self.assertEqual([[d] for d in data[950:1300]], ret)
+
+            if index_type is cp.ClusterIndex:
+                trees = [cluster_index]
+            else:
+                trees = cluster_index.indexes
+                self.assertEqual(1300, cluster_index.store.matrix.shape[0])
+            for tree in trees:
+                _, records = tree._get_child_data()
+                self.assertEqual(sorted(data),
+                                 sorted(np.concatenate(records)))
+
+        cluster_index.insert(features[0], 'new doc')
+        ret = cluster_index.search(features[0], k=2, return_distance=False)
+        self.assertEqual(['doc 0', 'new doc'], sorted(ret[0]))
+
+    def test_delete(self):
+        """Deleted records are not returned and compact removes them"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        data = ['doc {}'.format(i) for i in range(1000)]
+        deleted = data[:300:2]
+
+        for index_type in [cp.ClusterIndex, cp.MultiClusterIndex]:
+            cluster_index = index_type(features, data, matrix_size=10)
+            cluster_index.insert_batch(features[:10], range(10))
+            cluster_index.delete(deleted + [0, 1])
+
+            ret = cluster_index.search(features[:300], k=5, k_clusters=1000,
+                                       return_distance=False)
+            for res in ret:
+                self.assertEqual(5, len(res))
+                self.assertFalse(set(res) & set(deleted + [0, 1]))
+            self.assertEqual([[d] for d in data[1:300:2]],
+                             cluster_index.search(features[1:300:2], k=1,
+                                                  return_distance=False))
+
+            cluster_index.update('doc 1', features[0])
+            ret = cluster_index.search(features[0], k=1,
+                                       return_distance=False)
+            self.assertEqual([['doc 1']], ret)
+
+            cluster_index.compact()
+            if index_type is cp.ClusterIndex:
+                trees = [cluster_index]
+            else:
+                trees = cluster_index.indexes
+                self.assertTrue(cluster_index.store.tombstones is None)
+            for tree in trees:
+                # 'doc 1' moved to the delta
+                self.assertEqual((849, 0), tree._count_deleted())
+            self.assertEqual(9, cluster_index.delta.matrix.shape[0])
+            ret = cluster_index.search(features[:300], k=5, k_clusters=1000,
+                                       return_distance=False)
+            for res in ret:
+                self.assertFalse(set(res) & set(deleted + [0, 1]))
+            self.assertEqual([[d] for d in data[301:1000:7]],
+                             cluster_index.search(features[301:1000:7], k=1,
+                                                  return_distance=False))
+
+    def test_kmeans_clustering(self):
+        """Indexes can be built with k-means leaders"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        for distance_type in [CosineDistance, UnitCosineDistance,
+                              JaccardDistance, EuclideanDistance]:
+            cluster_index = cp.ClusterIndex(features, data, distance_type,
+                                            matrix_size=10,
+                                            clustering='kmeans')
+            self.assertTrue(cluster_index._max_depth() > 2)
+            ret = cluster_index.search(features[:50], k=1,
+                                       return_distance=False)
+            self.assertEqual([[x] for x in data[:50]], ret)
+
+        cluster_index = cp.MultiClusterIndex(features, data, matrix_size=10,
+                                             clustering='kmeans')
+        self.assertEqual('kmeans', cluster_index.indexes[0].clustering)
+        ret = cluster_index.search(features[:50], k=1, return_distance=False)
+        self.assertEqual([[x] for x in data[:50]], ret)
+        self.assertRaises(ValueError, cp.ClusterIndex, features, data,
+                          clustering='bogus')
+
+        rng = np.random.RandomState(0)
+        seeds = pysparnn.kmeans.kmeans_plus_plus(CosineDistance, features,
+                                                 50, rng)
+        self.assertEqual(50, len(set(seeds)))
+        centroids = pysparnn.kmeans.minibatch_kmeans(JaccardDistance,
+                                                     features, 10, rng)
+        self.assertEqual((10, 2000), centroids.shape)
+        self.assertTrue((centroids.data == 1).all())
+
+        # the centroids only keep their largest weights
+        centroids = pysparnn.kmeans.minibatch_kmeans(
+            CosineDistance, features, 10, rng, max_features=5)
+        self.assertTrue(np.diff(centroids.indptr).max() <= 5)
+        np.testing.assert_allclose(
+            1.0, np.sqrt(centroids.multiply(centroids).sum(axis=1)))
+        centroids = pysparnn.kmeans.minibatch_kmeans(
+            EuclideanDistance, features, 10, rng)
+        self.assertTrue(np.diff(centroids.indptr).max() <=
+                        np.ceil(10.0 * features.nnz / 1000))
+
+    def test_balanced_clusters(self):
+        """max_cluster_size bounds the leaves at build time and on rebalance"""
+        # half of the records are near duplicates of each other
+        dense = np.random.binomial(1, 0.01, size=(2000, 2000))
+        dense[:1000, :5] = 1
+        features = csr_matrix(dense)
+        data = range(2000)
+
+        def leaf_sizes(index):
+            return [len(leaf.root.get_records())
+                    for leaf in index._all_leaves()]
+
+        cluster_index = cp.ClusterIndex(features, data, max_cluster_size=100)
+        self.assertTrue(max(leaf_sizes(cluster_index)) <= 100)
+        self.assertEqual(2000, sum(leaf_sizes(cluster_index)))
+        ret = cluster_index.search(features[1000:1050], k=1,
+                                   return_distance=False)
+        self.assertEqual([[x] for x in data[1000:1050]], ret)
+
+        cluster_index = cp.MultiClusterIndex(features[:1000], data[:1000])
+        cluster_index.insert_batch(features[1000:], data[1000:])
+        cluster_index.flush()
+        cluster_index.rebalance(max_cluster_size=100)
+        for ind in cluster_index.indexes:
+            self.assertEqual(100, ind.max_cluster_size)
+            self.assertTrue(max(leaf_sizes(ind)) <= 100)
+            self.assertEqual(2000, sum(leaf_sizes(ind)))
+        # merged records are no longer under their nearest leader
+        ret = cluster_index.search(features[1000:1050], k=1, k_clusters=5,
+                                   return_distance=False)
+        self.assertEqual([[x] for x in data[1000:1050]], ret)
+        self.assertRaises(ValueError, cp.ClusterIndex(features, data).rebalance)
+
+    def test_soft_assignment(self):
+        """Records can be assigned to several clusters"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        def leaf_records(index):
+            return np.concatenate([leaf.root.get_records()
+                                   for leaf in index._all_leaves()])
+
+        cluster_index = cp.ClusterIndex(features, data, num_assignments=2)
+        self.assertEqual(2000, len(leaf_records(cluster_index)))
+        ret = cluster_index.search(features[:50], k=1, return_distance=False)
+        self.assertEqual([[x] for x in data[:50]], ret)
+        for res in cluster_index.search(features[:50], k=5,
+                                        return_distance=False):
+            self.assertEqual(len(set(res)), len(res))
+
+        cluster_index = cp.ClusterIndex(features, data, num_assignments=2,
+                                        assignment_gap=0.01)
+        self.assertTrue(len(leaf_records(cluster_index)) < 2000)
+
+        # rebuilds gather the records once
+        cluster_index = cp.MultiClusterIndex(features[:800], data[:800],
+                                             num_assignments=2)
+        cluster_index.insert_batch(features[800:], data[800:])
+        cluster_index.flush()
+        for ind in cluster_index.indexes:
+            ind._rebuild()
+            records = leaf_records(ind)
+            self.assertEqual(2000, len(records))
+            self.assertEqual(list(data), sorted(set(records)))
+        ret = cluster_index.search(features[800:850], k=1,
+                                   return_distance=False)
+        self.assertEqual([[x] for x in data[800:850]], ret)
+
+        tree = cp.ClusterIndex(features[:800], data[:800], num_assignments=2)
+        tree.insert_batch(features[800:], data[800:])
+        tree.flush()
+        tree._rebuild()
+        self.assertEqual(2000, len(leaf_records(tree)))
+
+        # copies are told apart from distinct records with the same value
+        labels = np.arange(1000) % 2
+        tree = cp.ClusterIndex(features, labels, num_assignments=2)
+        self.assertEqual(2000, len(leaf_records(tree)))
+        tree._rebuild()
+        self.assertEqual(2000, len(leaf_records(tree)))
+        for res in tree.search(features[:20], k=5, k_clusters=2):
+            self.assertEqual(5, len(res))
+
+        # only the level above the leaves assigns records to several
+        # clusters so small matrix sizes still build quickly
+        features = csr_matrix(np.random.binomial(1, 0.05, size=(600, 500)))
+        for distance_type in [CosineDistance, EuclideanDistance,
+                              JaccardDistance]:
+            tree = cp.ClusterIndex(features, range(600), distance_type,
+                                   matrix_size=10, num_assignments=2)
+            self.assertTrue(tree._max_depth() > 2)
+            self.assertTrue(len(leaf_records(tree)) <= 1200)
+            ret = tree.search(features[:20], k=1, return_distance=False)
+            self.assertEqual([[x] for x in range(20)], ret)
+
+    def test_bounded_search(self):
+        """Searching with the cluster radii finds every result in range"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        features.data = np.random.rand(features.nnz)
+        data = range(1000)
+        queries = features[:20]
+
+        def distances(results):
+            return [[d for d, _ in res] for res in results]
+
+        for distance_type, max_distance in [(EuclideanDistance, None),
+                                            (CosineDistance, 0.9)]:
+            brute_force = distance_type(features, data)
+            expected = brute_force.nearest_search(queries, k=5,
+                                                  max_distance=max_distance)
+            cluster_index = cp.ClusterIndex(features, data, distance_type,
+                                            matrix_size=10)
+            ret = cluster_index.search(queries, k=5, k_clusters=None,
+                                       max_distance=max_distance,
+                                       radius_scale=1.0)
+            for r, e in zip(distances(ret), distances(expected)):
+                np.testing.assert_allclose(e, r, atol=1e-6)
+
+        # the radii grow with inserts and are saved
+        cluster_index = cp.MultiClusterIndex(features[:800], data[:800],
+                                             EuclideanDistance,
+                                             matrix_size=10)
+        cluster_index.insert_batch(features[800:], data[800:])
+        cluster_index.flush()
+        path = tempfile.mkdtemp()
+        try:
+            cluster_index.save(path)
+            cluster_index = cp.MultiClusterIndex.load(path)
+            ret = cluster_index.search(queries, k=5, k_clusters=None,
+                                       radius_scale=1.0)
+        finally:
+            shutil.rmtree(path)
+        expected = EuclideanDistance(features, data).nearest_search(queries,
+                                                                    k=5)
+        for r, e in zip(distances(ret), distances(expected)):
+            np.testing.assert_allclose(e, r, atol=1e-6)
+
+        self.assertTrue(np.isneginf(InnerProductDistance._lower_bound(
+            np.zeros(3), np.zeros(3))).all())
+
+    def test_dtype(self):
+        """Indexes can store their matrices as float32 or float16"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        features.data = np.random.rand(features.nnz)
+        data = range(1000)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        for dtype in ['float32', 'float16']:
+            cluster_index = cp.MultiClusterIndex(features[:900], data[:900],
+                                                 matrix_size=10, dtype=dtype)
+            cluster_index.insert_batch(features[900:], data[900:])
+            cluster_index.flush()
+            cluster_index.save(path)
+            cluster_index = cp.MultiClusterIndex.load(path)
+            for matrix in [cluster_index.store.matrix,
+                           cluster_index.indexes[0].root.matrix]:
+                self.assertEqual(dtype, matrix.dtype.name)
+                self.assertEqual(np.int32, matrix.indices.dtype)
+            self.assertEqual(
+                dtype, cluster_index.store.matrix_root_sum_square.dtype.name)
+            ret = cluster_index.search(features[::20], k=1,
+                                       return_distance=False)
+            self.assertEqual([[x] for x in data[::20]], ret)
+
+            cluster_index = cp.ClusterIndex(features, data, dtype=dtype)
+            for leaf in cluster_index._all_leaves():
+                self.assertEqual(dtype, leaf.root.matrix.dtype.name)
+
+        # the packed bitsets use a bit per feature
+        search = PackedJaccardDistance(features, data)
+        self.assertEqual((1000, 250), search.matrix.shape)
+        self.assertEqual(0, (search.get_feature_matrix() !=
+                             (features != 0)).nnz)
+        np.testing.assert_array_equal(
+            np.packbits((features != 0).toarray(), axis=1), search.matrix)
+
+        class SmallBlocks(PackedJaccardDistance):
+            pack_block_rows = 64
+        np.testing.assert_array_equal(
+            search.matrix, SmallBlocks(features, data).matrix)
+
+        # packing 1 in 100 features takes more space than a csr matrix
+        dense = csr_matrix(np.random.binomial(1, 0.1, size=(1000, 2000)))
+        for matrix, num_warnings in [(features, 1), (dense, 0)]:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                # python 2 skips warnings that were already issued
+                pysparnn.matrix_distance.__dict__.pop('__warningregistry__',
+                                                      None)
+                PackedJaccardDistance(matrix, data)
+            self.assertEqual(num_warnings, len(caught))
+
+    def test_normalized_cosine(self):
+        """Cosine distance over pre-normalized records"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        features.data = np.random.rand(features.nnz)
+        data = range(1000)
+        queries = 3 * features[:20]
+
+        search = NormalizedCosineDistance(features, data)
+        self.assertEqual((), search.row_stats)
+        expected = CosineDistance(features, data).nearest_search(
+            queries, k=5, return_arrays=True)
+        # the queries are normalized unless they are already prepared
+        for ret in [search.nearest_search(queries, k=5, return_arrays=True),
+                    search.nearest_search(
+                        NormalizedCosineDistance._prepare(queries), k=5,
+                        return_arrays=True, prepared=True),
+                    MatrixMetricSubset(search, np.arange(1000)).nearest_search(
+                        queries, k=5, return_arrays=True)]:
+            np.testing.assert_allclose(expected[0], ret[0], atol=1e-7)
+
+        for cluster_index in [
+                cp.ClusterIndex(features, data, NormalizedCosineDistance),
+                cp.MultiClusterIndex(features, data,
+                                     NormalizedCosineDistance),
+                FlatClusterIndex(features, data, NormalizedCosineDistance)]:
+            ret = cluster_index.search(queries, k=1, return_distance=False)
+            self.assertEqual([[x] for x in data[:20]], ret)
+
+        # a build normalizes its records once, not at every level
+        class CountedDistance(NormalizedCosineDistance):
+            num_prepared = 0
+
+            def __init__(self, *args, **kwargs):
+                NormalizedCosineDistance.__init__(self, *args, **kwargs)
+                # not counting the records of the new search structure
+                CountedDistance.num_prepared -= 1
+
+            @classmethod
+            def _prepare(cls, sparse_features):
+                CountedDistance.num_prepared += 1
+                return super(CountedDistance, cls)._prepare(sparse_features)
+
+        for build in [cp.ClusterIndex, cp.MultiClusterIndex]:
+            CountedDistance.num_prepared = 0
+            cluster_index = build(features, data, CountedDistance,
+                                  matrix_size=10)
+            self.assertEqual(1, CountedDistance.num_prepared)
+        self.assertTrue(cluster_index.indexes[0]._max_depth() > 2)
+
+    def test_query_cache(self):
+        """Cached search results"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+        queries = features[[0, 1, 2, 0, 1]]
+
+        for cluster_index in [cp.ClusterIndex(features, data),
+                              cp.MultiClusterIndex(features, data)]:
+            expected = cluster_index.search(queries, k=3, k_clusters=2)
+            cluster_index.cache = QueryCache()
+            # repeated queries of a batch are searched once
+            self.assertEqual(expected, cluster_index.search(queries, k=3,
+                                                            k_clusters=2))
+            self.assertEqual((0, 5, 3), (cluster_index.cache.hits,
+                                         cluster_index.cache.misses,
+                                         len(cluster_index.cache)))
+            self.assertEqual(expected, cluster_index.search(queries, k=3,
+                                                            k_clusters=2))
+            self.assertEqual(5, cluster_index.cache.hits)
+            # the parameters are part of the key
+            cluster_index.search(queries, k=2, k_clusters=2)
+            self.assertEqual(6, len(cluster_index.cache))
+
+            # inserts clear the cache
+            cluster_index.insert(features[0], 'new')
+            self.assertEqual(0, len(cluster_index.cache))
+            ret = cluster_index.search(features[0], k=2, k_clusters=2,
+                                       return_distance=False)
+            self.assertEqual(set([0, 'new']), set(ret[0]))
+
+        cache = QueryCache(max_bytes=2000)
+        cluster_index = cp.ClusterIndex(features, data)
+        cluster_index.cache = cache
+        cluster_index.search(features[:100], k=3)
+        self.assertTrue(0 < len(cache) < 100)
+        self.assertTrue(cache.num_bytes <= 2000)
+
+    def test_search_stats(self):
+        """Per search counters and timings"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        cluster_index = cp.ClusterIndex(features, data, matrix_size=10)
+        expected = cluster_index.search(features[:10], k=2, k_clusters=2)
+        stats = SearchStats()
+        ret = cluster_index.search(features[:10], k=2, k_clusters=2,
+                                   stats=stats)
+        self.assertEqual(expected, ret)
+        self.assertEqual(10, stats.num_queries)
+        self.assertEqual(1, stats.num_batches)
+        self.assertTrue(1 <= len(stats.clusters_visited) <
+                        cluster_index._max_depth())
+        self.assertEqual(20, stats.clusters_visited[0])
+        self.assertTrue(0 < stats.rows_scored < 10 * 1000)
+        self.assertTrue(stats.total_time >= stats.distance_time > 0)
+        self.assertTrue(stats.top_k_time > 0)
+        self.assertTrue(stats.merge_time > 0)
+
+        # the queries only reach the deepest leaves if every cluster is
+        # searched
+        stats = SearchStats()
+        cluster_index.search(features[:10], k=2, k_clusters=1000, stats=stats)
+        self.assertEqual(cluster_index._max_depth() - 1,
+                         len(stats.clusters_visited))
+
+        # the stats of every batch and index are added up
+        calls = []
+        cluster_index = cp.MultiClusterIndex(features, data, num_indexes=2)
+        cluster_index.stats_callback = calls.append
+        cluster_index.search(features[:10], k=2, n_jobs=2)
+        cluster_index.search(features[:10], k=2, n_jobs=2,
+                             backend='process')
+        self.assertEqual(2, len(calls))
+        for stats in calls:
+            self.assertEqual(10, stats.num_queries)
+            self.assertEqual(2, stats.num_batches)
+            self.assertEqual(20, stats.as_dict()['clusters_visited'][0])
+
+        stdout = sys.stdout
+        try:
+            with open(os.devnull, 'w') as sys.stdout:
+                cluster_index.indexes[0]._print_structure()
+        finally:
+            sys.stdout = stdout
+
+    def test_tuning(self):
+        """Pick the fastest configuration that reaches a recall"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+        queries = features[:50]
+
+        tuning = pysparnn.tuning.tune(features, data, queries,
+                                      target_recall=0.4, k=5,
+                                      matrix_sizes=[10, 30],
+                                      num_indexes=[1, 2], k_clusters=[1, 4],
+                                      latency_queries=10)
+        self.assertEqual(8, len(tuning.trials))
+        self.assertTrue(tuning.met_target)
+        best = [trial for trial in tuning.trials
+                if trial['recall'] >= 0.4 and
+                trial['latency'] == min(t['latency'] for t in tuning.trials
+                                        if t['recall'] >= 0.4)][0]
+        self.assertEqual(dict((name, best[name]) for name in tuning.params),
+                         tuning.params)
+        self.assertEqual(tuning.params['num_indexes'],
+                         len(tuning.index.indexes))
+        ret = tuning.search(queries, k=5, return_distance=False)
+        self.assertTrue(pysparnn.tuning.recall(ret, [[x] for x in data[:50]])
+                        >= 0.8)
+
+        # the query time k_clusters grows with the recall
+        self.assertEqual(1, tuning.k_clusters_for(0.0))
+        self.assertEqual(4, tuning.k_clusters_for(1.1))
+        tuning.search(queries, target_recall=1.0, k=5)
+
+        tuning = pysparnn.tuning.tune(features, data, queries,
+                                      target_recall=1.1, k=5,
+                                      matrix_sizes=[30], num_indexes=[1],
+                                      k_clusters=[1, 4])
+        self.assertFalse(tuning.met_target)
+        self.assertEqual(4, tuning.params['k_clusters'])
+        self.assertRaises(ValueError, pysparnn.tuning.tune, features, data,
+                          queries, k=5, max_memory=1, matrix_sizes=[30])
+
+    def test_index_bytes(self):
+        """The measured memory includes the leaf rows kept by a search"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        cluster_index = cp.MultiClusterIndex(features, data, num_indexes=2)
+        before = pysparnn.tuning.index_bytes(cluster_index)
+        cluster_index.search(features[:50], k=5, k_clusters=4)
+        self.assertEqual(before, pysparnn.tuning.index_bytes(cluster_index))
+
+        self.addCleanup(setattr, MatrixMetricSubset, 'keep_gathered', False)
+        MatrixMetricSubset.keep_gathered = True
+        cluster_index.search(features[:50], k=5, k_clusters=4)
+        self.assertTrue(pysparnn.tuning.index_bytes(cluster_index) >
+                        before + features.data.nbytes / 10)
+
+        # tune measures after searching
+        tuning = pysparnn.tuning.tune(features, data, features[:50], k=5,
+                                      target_recall=0.0, matrix_sizes=[30],
+                                      num_indexes=[2], k_clusters=[4])
+        self.assertEqual(pysparnn.tuning.index_bytes(tuning.index),
+                         tuning.trials[0]['memory'])
+
+    def test_search_iter(self):
+        """Search a stream of queries in batches"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        for cluster_index in [cp.ClusterIndex(features, data),
+                              cp.MultiClusterIndex(features, data)]:
+            expected = cluster_index.search(features[:250], k=2,
+                                            return_distance=False)
+            batches = list(cluster_index.search_iter(
+                features[:250], batch_size=100, k=2, return_distance=False))
+            self.assertEqual([100, 100, 50], [len(ret) for ret in batches])
+            self.assertEqual(expected, sum(batches, []))
+
+            # chunks of any size are rebatched
+            chunks = (features[start:min(start + 30, 250)]
+                      for start in range(0, 250, 30))
+            batches = list(cluster_index.search_iter(
+                chunks, batch_size=100, prefetch=True, k=2,
+                return_distance=False))
+            self.assertEqual([100, 100, 50], [len(ret) for ret in batches])
+            self.assertEqual(expected, sum(batches, []))
+
+            # stopping early shuts the prefetch thread down
+            batches = cluster_index.search_iter(features, batch_size=10,
+                                                prefetch=True, k=2)
+            self.assertEqual(10, len(next(batches)))
+            batches.close()
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires asyncio')
+    def test_asearch(self):
+        """Concurrent asyncio searches are batched"""
+        import asyncio
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+        loop = asyncio.new_event_loop()
+
+        class Requests(object):
+            """Makes requests when a coroutine awaits it, so they are made
+            from a running loop (python 2 can not parse async def)."""
+
+            def __init__(self, requests):
+                self.requests = requests
+
+            def __await__(self):
+                return asyncio.gather(*self.requests()).__await__()
+
+        try:
+            for cluster_index in [cp.ClusterIndex(features, data),
+                                  cp.MultiClusterIndex(features, data)]:
+                calls = []
+                cluster_index.stats_callback = calls.append
+                cluster_index.asearch_batch_size = 4
+                # requests need a running loop
+                self.assertRaises(RuntimeError, cluster_index.asearch,
+                                  features[0], k=1)
+
+                ret = loop.run_until_complete(Requests(lambda: [
+                    cluster_index.asearch(features[i], k=1,
+                                          return_distance=False)
+                    for i in range(10)]))
+                self.assertEqual([[[x]] for x in data[:10]], ret)
+                # the batches are searched concurrently
+                self.assertEqual([2, 4, 4], sorted(stats.num_queries
+                                                   for stats in calls))
+
+                # errors are raised by every request of the batch
+                self.assertRaises(ValueError, loop.run_until_complete,
+                                  Requests(lambda: [cluster_index.asearch(
+                                      features[0], k=1, backend='unknown',
+                                      n_jobs=2)]))
+        finally:
+            loop.close()
+
+    def test_worker_pool(self):
+        """Search a shared index with worker processes"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        data = range(1000)
+
+        cluster_index = cp.MultiClusterIndex(features, data)
+        expected = cluster_index.search(features[:25], k=2, k_clusters=2)
+        with pysparnn.serving.WorkerPool.from_index(
+                cluster_index, num_workers=2, batch_size=10) as pool:
+            path = pool.path
+            ret = pool.search(features[:25], k=2, k_clusters=2)
+            self.assertEqual(expected, ret)
+            self.assertRaises(ValueError, pool.search, features[:5],
+                              backend='unknown', n_jobs=2)
+        self.assertFalse(os.path.exists(path))
+
+        path = tempfile.mkdtemp()
+        try:
+            cluster_index = cp.ClusterIndex(features, data)
+            cluster_index.save(path)
+            with pysparnn.serving.WorkerPool(path, num_workers=2) as pool:
+                ret = pool.search(features[:25], k=1, return_distance=False)
+            self.assertEqual([[x] for x in data[:25]], ret)
+        finally:
+            shutil.rmtree(path)
+        self.assertRaises(IOError, pysparnn.serving.WorkerPool, path,
+                          num_workers=1)
+
+    def test_worker_pool_exit(self):
+        """Searches fail instead of hanging when a worker exits"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 2000)))
+        cluster_index = cp.ClusterIndex(features, range(1000))
+        with pysparnn.serving.WorkerPool.from_index(
+                cluster_index, num_workers=2, batch_size=10) as pool:
+            self.assertRaises(multiprocessing.TimeoutError, pool.search,
+                              features[:25], k=1, timeout=0)
+            self.assertEqual(25, len(pool.search(features[:25], k=1)))
+
+            pool._workers[0].terminate()
+            pool._workers[0].join()
+            self.assertRaises(RuntimeError, pool.search, features[:25], k=1)
+            self.assertRaises(RuntimeError, pool.search, features[:25], k=1)
+
+    def test_flat_index(self):
+        """Test the flat array index"""
+        features = csr_matrix(np.random.binomial(1, 0.01, size=(1000, 20000)))
+        data_to_return = range(1000)
+
+        flat_index = FlatClusterIndex(features, data_to_return, matrix_size=10)
+        self.assertTrue(flat_index._max_depth() > 2)
+        ret = flat_index.search(features[0:10], k=1, k_clusters=1,
+                                return_distance=False)
+        self.assertEqual([[x] for x in data_to_return[:10]], ret)
+
+        # leaves cover every record exactly once
+        leaves = flat_index.is_terminal
+        self.assertEqual(1000, flat_index._matrix_sizes()[leaves].sum())
+        self.assertEqual(list(range(1000)), sorted(flat_index.record_ids))
+
+        # searching every cluster is a brute force search
+        brute_force = CosineDistance(features, data_to_return)
+        ret = flat_index.search(features[:20], k=5, k_clusters=1000)
+        expected = brute_force.nearest_search(features[:20], k=5)
+        for r, e in zip(ret, expected):
+            np.testing.assert_allclose([d for d, _ in e], [d for d, _ in r])